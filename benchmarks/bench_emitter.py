@@ -0,0 +1,78 @@
+"""Compares the legacy `Macro.result` path against the streaming emitter and `Macro.compile`.
+
+The peak of the streaming path grows with the macro: the visited set of `Macro.process` holds the id of every
+resource processed during the build (about 2.7 MiB for 3000 blocks and 6.8 MiB for 10000), in exchange for
+processing shared expressions once per build. The times include the overhead of `tracemalloc`.
+
+Usage:
+    python benchmarks/bench_emitter.py [blocks]
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+from eb_macro_gen.syntax import *
+from eb_macro_gen.objects import *
+
+
+def build_macro(blocks:int) -> Macro:
+    macro = Macro("bench_emitter", "Large generated macro")
+    value = vshort("value", 0)
+    selected = vbool("selected", False)
+    with macro:
+        for i in range(blocks):
+            tag = Tag(f"tag{i}", "Local HMI", f"LW, {i}", DataType.S16)
+            macro.write(
+                COMMENT(f"Block {i}"),
+                tag.read(value),
+                IF(selected)(
+                    value.set(value + 1),
+                    tag.write(value),
+                ).ELSE()(
+                    value.set(0),
+                ),
+                EMPTY(),
+            )
+    return macro
+
+
+def legacy(macro:Macro, stream):
+    macro.result = ['']
+    for s in macro.statements:
+        s.process(macro)
+    for s in macro.statements:
+        s.bake(macro)
+    stream.write(''.join(macro.result))
+
+
+def streaming(macro:Macro, stream):
+    macro.render_to(stream)
+
+
+def compiled(macro:Macro, stream):
+    stream.write(''.join(macro.compile()))
+
+
+def measure(name:str, func, macro:Macro):
+    with open(os.devnull, 'w') as stream:
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(macro, stream)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print(f"{name:<10} {elapsed * 1000:>10.1f} ms {peak / 1024:>12.1f} KiB peak")
+
+
+def main():
+    blocks = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    macro = build_macro(blocks)
+    print(f"{blocks} blocks")
+    measure("legacy", legacy, macro)
+    measure("streaming", streaming, macro)
+    measure("compile", compiled, macro)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Measures building and rendering long arithmetic and boolean chains.
+
+`eager` reproduces the previous behaviour, where every operator formatted the
+whole left operand into a new `LITERAL`.
+
+Usage:
+    python benchmarks/bench_expressions.py [terms]
+"""
+import sys
+import time
+
+from eb_macro_gen.syntax import *
+
+
+def lazy_sum(variables):
+    total = variables[0]
+    for v in variables[1:]:
+        total = total + v
+    return str(total)
+
+
+def eager_sum(variables):
+    total = variables[0]
+    for v in variables[1:]:
+        res = LITERAL(f'{total} + {v}')
+        res.resources.add(total)
+        res.resources.add(v)
+        total = res
+    return str(total)
+
+
+def lazy_or(variables):
+    chain = variables[0] | variables[1]
+    for v in variables[2:]:
+        chain = chain | v
+    return str(chain)
+
+
+def eager_or(variables):
+    chain = LITERAL(f'({variables[0]} or {variables[1]})')
+    for v in variables[2:]:
+        res = LITERAL(f'({chain} or {v})')
+        res.resources.add(chain)
+        res.resources.add(v)
+        chain = res
+    return str(chain)
+
+
+def measure(name:str, func, variables, repeat:int = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(variables)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    size = result if isinstance(result, int) else len(result)
+    print(f"{name:<12} {best * 1000:>10.1f} ms {size:>12} chars")
+    return result
+
+
+def main():
+    terms = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    shorts = [vshort(f"value{i}") for i in range(terms)]
+    bools = [vbool(f"flag{i}") for i in range(terms)]
+    print(f"{terms} terms")
+    assert measure("lazy +", lazy_sum, shorts) == measure("eager +", eager_sum, shorts)
+    assert measure("lazy or", lazy_or, bools) == measure("eager or", eager_or, bools)
+
+
+if __name__ == "__main__":
+    main()
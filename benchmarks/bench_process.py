@@ -0,0 +1,71 @@
+"""Measures resource processing over deep, shared expression chains.
+
+Every step of the chain is reused by the next step and by its own `IF`, which is
+typical of generated alarm logic. Without the per-build visited set, each `IF`
+re-processes the whole chain below it.
+
+Usage:
+    python benchmarks/bench_process.py [depth ...]
+"""
+import sys
+import time
+
+from eb_macro_gen.syntax import *
+
+
+def build_macro(depth:int, cls=Macro) -> Macro:
+    macro = cls("bench_process", "Deep expression chains")
+    alarm = vbool("alarm", False)
+    with macro:
+        total = vshort("value0")
+        for i in range(1, depth):
+            total = total + vshort(f"value{i}")
+            macro.write(
+                IF(total > i)(
+                    alarm.set(True),
+                ),
+            )
+    return macro
+
+
+class UnsharedMacro(Macro):
+    """Processes resources like `Macro` but without the visited set"""
+    visits = 0
+
+    def process(self, *resources:Resource):
+        if self._depth >= PROCESS_DEPTH:
+            self._pending.extend(resources)
+            return
+        self._depth += 1
+        try:
+            for r in resources:
+                if isinstance(r, Resource) and r.__class__ is not Resource:
+                    self.visits += 1
+                    r.process(self)
+        finally:
+            self._depth -= 1
+        if self._depth == 0:
+            pending = self._pending
+            while pending:
+                self.process(pending.pop())
+
+
+def measure(macro:Macro):
+    start = time.perf_counter()
+    macro.compile()
+    return time.perf_counter() - start
+
+
+def main():
+    depths = [int(v) for v in sys.argv[1:]] or [250, 500, 1000, 2000]
+    print(f"{'depth':>8} {'visits':>10} {'time':>10} {'unshared':>12} {'time':>10}")
+    for depth in depths:
+        macro = build_macro(depth)
+        elapsed = measure(macro)
+        unshared = build_macro(depth, UnsharedMacro)
+        unshared_elapsed = measure(unshared)
+        print(f"{depth:>8} {len(macro._processed):>10} {elapsed * 1000:>7.1f} ms {unshared.visits:>12} {unshared_elapsed * 1000:>7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+from __future__ import annotations
+from dataclasses import asdict, dataclass, field
+import json
+import math
+from typing import Any, Callable, Dict, List, Optional
+
+from .instructions import REGISTER_WIDTHS
+from .syntax import (
+    ASSIGNMENT, CALL, C_ELIF, C_FOR, C_IF, C_WHILE, CONDITION_BLOCK, DISPATCH, FOR, LOOP, RETURN, STATEMENT, SUB,
+    SUB_CALL, AnyVariable, Macro, Variable, VariableArray, VariableItem, walk,
+)
+
+# Calls waiting for a round trip to a device
+DEVICE_CALLS = {'GetData', 'SetData', 'GetDataEx', 'SetDataEx'}
+
+# Static cost of the instructions, relative to an assignment. Other calls cost 1.
+INSTRUCTION_WEIGHTS:Dict[str, int] = {
+    'GetData' : 10,
+    'SetData' : 10,
+    'GetDataEx' : 10,
+    'SetDataEx' : 10,
+    'DELAY' : 50,
+    'SYNC_TRIG_MACRO' : 20,
+    'ASYNC_TRIG_MACRO' : 5,
+}
+
+# The number of iterations assumed for the loops whose count is only known at runtime
+LOOP_ITERATIONS = 10
+
+
+def statement_weight(statement:STATEMENT) -> int:
+    """The static cost of a statement written as-is
+
+    Calls cost their weight in `INSTRUCTION_WEIGHTS`, assignments, conditions (including the checks of the loops)
+    and returns cost 1, comments and other statements cost nothing.
+    """
+    if isinstance(statement, CALL):
+        return INSTRUCTION_WEIGHTS.get(statement.funcName, 1)
+    if isinstance(statement, (ASSIGNMENT, C_IF, C_ELIF, C_WHILE, C_FOR, RETURN)):
+        return 1
+    return 0
+
+
+def branch_weight(statement:STATEMENT) -> int:
+    """1 for the conditions and the checks of the loops, to count the branches taken with `estimate_cost`"""
+    return 1 if isinstance(statement, (C_IF, C_ELIF, C_WHILE, C_FOR)) else 0
+
+
+def loop_iterations(loop:LOOP) -> Optional[int]:
+    """The number of iterations of a loop, None when it is only known at runtime"""
+    return loop.iterations if isinstance(loop, FOR) else None
+
+
+def estimate_cost(*statements:STATEMENT, weight:Callable[[STATEMENT], int] = statement_weight) -> int:
+    """Statically estimates the cost of executing statements in the worst case
+
+    A condition block costs the conditions tested to reach its most expensive arm, plus that arm. A loop costs
+    its body and its check for each iteration, plus the last check. Loops whose number of iterations is only known
+    at runtime are assumed to run `LOOP_ITERATIONS` times. A call to a `SUB` costs the call plus every statement
+    of the function, the definitions of the functions cost nothing.
+
+    Args:
+        *statements (STATEMENT): The statements
+        weight (Callable[[STATEMENT], int], optional): The cost of a statement written as-is. Defaults to `statement_weight`.
+
+    Returns:
+        int: The estimated cost, see `INSTRUCTION_WEIGHTS`
+    """
+    total = 0
+    for s in statements:
+        if isinstance(s, CONDITION_BLOCK):
+            worst = 0
+            tested = 0
+            for arm in s.arms:
+                if isinstance(arm.header, (C_IF, C_ELIF)):
+                    tested += weight(arm.header)
+                worst = max(worst, tested + estimate_cost(*arm.body, weight=weight))
+            total += max(worst, tested)
+            continue
+        if isinstance(s, LOOP):
+            iterations = loop_iterations(s)
+            if iterations is None:
+                iterations = LOOP_ITERATIONS
+            total += (iterations + 1) * weight(s.header) + iterations * estimate_cost(*s.body, weight=weight)
+            continue
+        if isinstance(s, SUB):
+            continue
+        if isinstance(s, SUB_CALL):
+            total += weight(s) + estimate_cost(*s.sub.body, weight=weight)
+            continue
+        content = s.expand()
+        if content is None:
+            total += weight(s)
+        else:
+            total += estimate_cost(*content, weight=weight)
+    return total
+
+
+def _dtype(var:AnyVariable) -> Optional[str]:
+    if isinstance(var, Variable):
+        return var.dtype
+    if isinstance(var, VariableItem):
+        return var.array.dtype
+    return None
+
+
+def registers_of(call:CALL) -> int:
+    """Estimates the number of 16-bit registers a device call transfers, see `REGISTER_WIDTHS`
+
+    Counts given by a variable, and variables of unknown type, count as a single register.
+    """
+    count = call.params[3] if len(call.params) > 3 else 1
+    if not isinstance(count, int):
+        count = 1
+    return math.ceil(count * REGISTER_WIDTHS.get(_dtype(call.params[0]), 1))
+
+
+@dataclass
+class DeviceCost:
+    """The device calls a macro makes to a device"""
+    reads:int = 0
+    writes:int = 0
+    registers:int = 0
+
+    @property
+    def calls(self) -> int:
+        return self.reads + self.writes
+
+
+@dataclass
+class CostReport:
+    """What a macro costs at runtime, see `Macro.cost_report`"""
+    macro:str
+    devices:Dict[str, DeviceCost] = field(default_factory=dict)
+    statements:int = 0
+    branches:int = 0
+    memory:int = 0
+    lines:int = 0
+    size:int = 0
+
+    @property
+    def calls(self) -> int:
+        """The number of device calls written in the macro"""
+        return sum(d.calls for d in self.devices.values())
+
+    @property
+    def registers(self) -> int:
+        """The estimated number of registers transferred by all the device calls"""
+        return sum(d.registers for d in self.devices.values())
+
+    def to_dict(self) -> Dict[str, Any]:
+        res = asdict(self)
+        res['calls'] = self.calls
+        res['registers'] = self.registers
+        return res
+
+    def to_json(self, **kwargs) -> str:
+        """The report as JSON, `kwargs` are given to `json.dumps`"""
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def __str__(self) -> str:
+        width = max([len('Device')] + [len(d) for d in self.devices])
+        lines = [
+            f"{self.macro}: {self.statements} statements, {self.branches} branches on the worst path, "
+            f"{self.memory} bytes of variables, {self.lines} lines ({self.size} characters)",
+            f"    {'Device':<{width}}  {'Reads':>6}  {'Writes':>6}  {'Registers':>9}",
+        ]
+        for device, d in sorted(self.devices.items()):
+            lines.append(f"    {device:<{width}}  {d.reads:>6}  {d.writes:>6}  {d.registers:>9}")
+        lines.append(f"    {'Total':<{width}}  {sum(d.reads for d in self.devices.values()):>6}  "
+                     f"{sum(d.writes for d in self.devices.values()):>6}  {self.registers:>9}")
+        return '\n'.join(lines)
+
+
+def cost_report(macro:Macro) -> CostReport:
+    """Statically analyses what a macro costs at runtime
+
+    Every device call written in the macro is counted once, whether or not it runs on a given execution.
+    The macro is built to measure its output.
+
+    Args:
+        macro (Macro): The macro, once written
+
+    Returns:
+        CostReport: The device calls and registers transferred per device, the number of statements, of branches
+        taken on the worst path, the memory of the declared variables and the size of the output
+    """
+    output = macro.compile()
+    report = CostReport(macro.name, lines=len(output), size=sum(len(l) for l in output))
+    for s, content in walk(*macro.statements):
+        if content is not None:
+            continue
+        if statement_weight(s):
+            report.statements += 1
+        if isinstance(s, CALL) and s.funcName in DEVICE_CALLS:
+            device = report.devices.setdefault(str(s.params[1]).strip('"'), DeviceCost())
+            if s.funcName.startswith('Get'):
+                device.reads += 1
+            else:
+                device.writes += 1
+            device.registers += registers_of(s)
+    report.branches = estimate_cost(*macro.statements, weight=branch_weight)
+    # The variables declared by the build above, each build collects them again
+    for v in macro._declared():
+        size = v.size if isinstance(v, VariableArray) else 1
+        report.memory += math.ceil(size * REGISTER_WIDTHS.get(v.dtype, 1) * 2)
+    return report
+
+
+@dataclass
+class PathCost:
+    """The cost of the cheapest, the most expensive and an average execution path"""
+    best:int = 0
+    worst:int = 0
+    average:float = 0
+
+    def __add__(self, o:PathCost) -> PathCost:
+        return PathCost(self.best + o.best, self.worst + o.worst, self.average + o.average)
+
+    def repeat(self, best:int, worst:int, average:float) -> PathCost:
+        """The cost of executing the same statements a different number of times on each path"""
+        return PathCost(self.best * best, self.worst * worst, self.average * average)
+
+    @staticmethod
+    def choice(costs:List[PathCost]) -> PathCost:
+        """The cost of executing one of several equally likely alternatives"""
+        return PathCost(min(c.best for c in costs), max(c.worst for c in costs), sum(c.average for c in costs) / len(costs))
+
+    def __str__(self) -> str:
+        return f"{self.best}/{self.worst}/{self.average:g}"
+
+
+@dataclass
+class DispatchReport:
+    """The cost of each case of a `SWITCH` or step of a routine, see `path_costs`"""
+    name:str
+    cases:Dict[Any, PathReport] = field(default_factory=dict)
+
+    @property
+    def outlier(self) -> Any:
+        """The match of the case with the most device calls on its worst path, then the most instructions"""
+        return max(self.cases, key=lambda m: (self.cases[m].calls.worst, self.cases[m].instructions.worst))
+
+
+@dataclass
+class PathReport:
+    """The device calls and instructions executed by statements, on their best, worst and average path"""
+    calls:PathCost = field(default_factory=PathCost)
+    instructions:PathCost = field(default_factory=PathCost)
+    dispatches:List[DispatchReport] = field(default_factory=list)
+
+    def __add__(self, o:PathReport) -> PathReport:
+        return PathReport(self.calls + o.calls, self.instructions + o.instructions, self.dispatches + o.dispatches)
+
+    @staticmethod
+    def choice(reports:List[PathReport]) -> PathReport:
+        """The report of executing one of several equally likely alternatives"""
+        return PathReport(
+            PathCost.choice([r.calls for r in reports]),
+            PathCost.choice([r.instructions for r in reports]),
+            [d for r in reports for d in r.dispatches],
+        )
+
+    def __str__(self) -> str:
+        lines = [f"Device calls (best/worst/average): {self.calls}", f"Instructions (best/worst/average): {self.instructions}"]
+        for d in self.dispatches:
+            lines.append(f"    {d.name}: outlier {d.outlier}")
+            for match, r in d.cases.items():
+                lines.append(f"        {match}: {r.calls} calls, {r.instructions} instructions")
+        return '\n'.join(lines)
+
+
+def _constant(calls:int, instructions:int) -> PathReport:
+    return PathReport(PathCost(calls, calls, calls), PathCost(instructions, instructions, instructions))
+
+
+def _statement_paths(s:STATEMENT) -> PathReport:
+    if isinstance(s, DISPATCH):
+        cases = {match: _constant(0, comparisons) + path_costs(*holder.body) for match, comparisons, holder in s.cases}
+        report = PathReport.choice(list(cases.values()))
+        report.dispatches.insert(0, DispatchReport(s.name, cases))
+        return report
+    if isinstance(s, CONDITION_BLOCK):
+        if not s.arms:
+            return PathReport()
+        arms:List[PathReport] = []
+        tested = 0
+        for arm in s.arms:
+            if isinstance(arm.header, (C_IF, C_ELIF)):
+                tested += 1
+            arms.append(_constant(0, tested) + path_costs(*arm.body))
+        if isinstance(s.arms[-1].header, (C_IF, C_ELIF)):
+            # Every condition is false
+            arms.append(_constant(0, tested))
+        return PathReport.choice(arms)
+    if isinstance(s, LOOP):
+        body = path_costs(*s.body)
+        iterations = loop_iterations(s)
+        counts = (0, LOOP_ITERATIONS, LOOP_ITERATIONS) if iterations is None else (iterations,) * 3
+        # The loop is checked once more than its body runs
+        checks = PathCost(*counts) + PathCost(1, 1, 1)
+        return PathReport(body.calls.repeat(*counts), body.instructions.repeat(*counts) + checks, body.dispatches)
+    if isinstance(s, SUB):
+        # Only runs when it is called
+        return PathReport()
+    if isinstance(s, SUB_CALL):
+        return _constant(0, 1) + path_costs(*s.sub.body)
+    content = s.expand()
+    if content is not None:
+        return path_costs(*content)
+    calls = 1 if isinstance(s, CALL) and s.funcName in DEVICE_CALLS else 0
+    return _constant(calls, 1 if statement_weight(s) else 0)
+
+
+def path_costs(*statements:STATEMENT) -> PathReport:
+    """Computes the device calls and instructions executed by statements on their best, worst and average path
+
+    The arms of a condition block are equally likely, including the path where every condition is false when there
+    is no `else`. The cases of a `SWITCH` and the steps of a routine are equally likely too, whatever the shape of the
+    comparisons selecting them, and the cost of each of them is given in the `dispatches` of the report, to find the
+    case or step that makes a scan slow. Each condition tested counts as an instruction.
+
+    A loop runs its body the same number of times on every path when it is a `FOR` with constant bounds. Other loops
+    don't run on the best path, and run `LOOP_ITERATIONS` times on the worst and average paths. A call to a `SUB`
+    counts as an instruction, plus the costs of the function.
+
+    Args:
+        *statements (STATEMENT): The statements, `Macro.statements` for a whole macro
+
+    Returns:
+        PathReport: The costs of the statements, and of each case of the `SWITCH`s and routines they contain
+    """
+    report = PathReport()
+    for s in statements:
+        report += _statement_paths(s)
+    return report
@@ -68,8 +68,8 @@ class ShapeParamType(IntEnum):
     Y = 1
 
 class ShapeParam(Resource):
-    temp_float = vfloat("p_drawing_param_float_temp", 0)
-    temp_int = vushort("p_drawing_param_int_temp", 0)
+    temp_float = Temporary("p_drawing_param_float_temp", "float", 0)
+    temp_int = Temporary("p_drawing_param_int_temp", "unsigned short", 0)
     def __init__(self, value:Union[AnyFloat, AnyInt, Tag]):
         super().__init__(value)
         if is_int(value):
@@ -167,8 +167,8 @@ class ShapeParam(Resource):
                         )
         
 class SHAPE(Resource):
-    enabled_var = vbool("p_shape_enabled", False)
-    temp_var = vushort("p_shape_temp", 0)
+    enabled_var = Temporary("p_shape_enabled", "bool", False)
+    temp_var = Temporary("p_shape_temp", "unsigned short", 0)
     def __init__(self):
         super().__init__()
     
@@ -228,8 +228,7 @@ class DRAWING(Resource):
     def process(self, macro) -> None:
         super().process(macro)
         
-        for shape in self.shapes:
-            shape.process(macro)
+        macro.process(*self.shapes)
             
     def add(self, shape:SHAPE):
         self.shapes.append(shape)
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 from .syntax import *
 
 def ACOS(source:AnyVariable[DT], result:AnyVariable[DT]) -> CALL:
@@ -808,6 +808,19 @@ ERROR(" a = %d", a)
     """
     return TRACE("[ERROR] " + fmt, *values)
 
+# Number of 16-bit registers used by each element of a variable in `GetData` and `SetData`,
+# see the table in their documentation. 8-bit types pack two elements per register.
+REGISTER_WIDTHS:Dict[str, float] = {
+    'char' : 0.5,
+    'unsigned char' : 0.5,
+    'bool' : 0.5,
+    'short' : 1,
+    'unsigned short' : 1,
+    'int' : 2,
+    'unsigned int' : 2,
+    'float' : 2,
+}
+
 def SetData(send_data:AnyVariable, device_name:str, address:TagAddress, data_count:Optional[AnyInt] = 1, dont_format:bool=False) -> CALL:
     """
     Args:
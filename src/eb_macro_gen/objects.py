@@ -8,6 +8,7 @@ except ImportError:
     from typing_extensions import override
 from .instructions import *
 from .common import DoubleKeyMap, smart_split
+from .analysis import estimate_cost
 from dataclasses import dataclass
 
 class DataType(Enum):
@@ -81,28 +82,29 @@ def is_float(v:Union[DataType, str, Variable, VariableItem, Tag, float]) -> bool
     return isinstance(v, float)
     
 class Tag(Resource):
-    def __init__(self, name:str, device_name:str, address:str, dtype:DataType):
+    def __init__(self, name:str, device_name:str, address:str, dtype:DataType, volatile:bool = False):
         super().__init__()
         self.name = name
         self.device_name = device_name
         self.address = address
         self.dtype = dtype
+        # Volatile tags are always accessed on the device, see `eb_macro_gen.passes.ScanImage`
+        self.volatile = volatile
         
-    def read(self, result:AnyVariable, count:AnyInt = 1) -> STATEMENT:
+    def read(self, result:AnyVariable, count:AnyInt = 1) -> TAG_READ:
         # TODO Add type verification
         if isinstance(count, int) and count != 1 and isinstance(result, Variable):
             raise TypeError(f"Cannot read multiple values into non-array variable {result}")
-        res = GetData(result, self.device_name, self.address, count, dont_format=True)
-        res.resources.add(self)
-        return res
+        return TAG_READ(self, result, count)
     
-    def write(self, var: AnyVariable, count:AnyInt = 1) -> STATEMENT:
+    def write(self, var: AnyVariable, count:AnyInt = 1) -> TAG_WRITE:
         # TODO Add type verification
         if isinstance(count, int) and count != 1 and isinstance(var, Variable):
             raise TypeError(f"Cannot write multiple values from non-array variable {var}")
-        res = SetData(var, self.device_name, self.address, count, True)
-        res.resources.add(self)
-        return res
+        return TAG_WRITE(self, var, count)
+
+    def __deepcopy__(self, memo:Dict[int, Any]) -> Tag:
+        return self
     
     @property
     def address_num(self) -> Optional[int]:
@@ -121,6 +123,58 @@ class Tag(Resource):
     def __hash__(self) -> int:
         return hash(f"{self.device_name}/{self.address}")
     
+class TAG_READ(CALL):
+    """A `GetData` reading a tag into a variable
+    """
+    def __init__(self, tag:Tag, result:AnyVariable, count:AnyInt = 1):
+        """A `GetData` reading a tag into a variable
+
+        Args:
+            tag (Tag): The tag to read
+            result (AnyVariable): The variable in which the data will be stored
+            count (AnyInt, optional): The number of elements to read. Defaults to 1.
+        """
+        super().__init__('GetData', result, string_literal(tag.device_name), tag.address, count)
+        self.tag = tag
+        self.resources.add(tag)
+        
+    @property
+    def result(self) -> AnyVariable:
+        return self.params[0]
+    
+    @property
+    def count(self) -> AnyInt:
+        return self.params[3]
+    
+    def __hash__(self):
+        return super().__hash__()
+
+class TAG_WRITE(CALL):
+    """A `SetData` writing a variable to a tag
+    """
+    def __init__(self, tag:Tag, var:AnyVariable, count:AnyInt = 1):
+        """A `SetData` writing a variable to a tag
+
+        Args:
+            tag (Tag): The tag to write
+            var (AnyVariable): The variable from which the data will be sent
+            count (AnyInt, optional): The number of elements to write. Defaults to 1.
+        """
+        super().__init__('SetData', var, string_literal(tag.device_name), tag.address, count)
+        self.tag = tag
+        self.resources.add(tag)
+        
+    @property
+    def var(self) -> AnyVariable:
+        return self.params[0]
+    
+    @property
+    def count(self) -> AnyInt:
+        return self.params[3]
+    
+    def __hash__(self):
+        return super().__hash__()
+    
 _TT = TypeVar("_TT")
 class TagList(Generic[_TT]):
     @abstractmethod
@@ -176,11 +230,57 @@ class EasyBuilderTagList(TagList[EasyBuilderTag]):
         for _, __, tag in self.map:
             stream.write(f"{tag.export()}\n")
     
+# Routines with more steps use a binary dispatch by default
+BINARY_DISPATCH_ABOVE = 8
+
+def step_dispatch(step_var:Variable[int], steps:List[STATEMENT], dispatch:Optional[str] = None, binary_above:int = BINARY_DISPATCH_ABOVE) -> STATEMENT:
+    """Selects the step of a routine to execute
+
+    The `linear` dispatch compares the step with each index in turn, so step N costs N + 1 comparisons.
+    The `binary` dispatch uses `binary_dispatch`, so every step costs at most ceil(log2(steps)) + 1 comparisons.
+    Steps out of range execute nothing with both.
+
+    Args:
+        step_var (Variable[int]): The variable holding the current step
+        steps (List[STATEMENT]): The steps
+        dispatch (Optional[str], optional): `linear` or `binary`, None to use `binary` above `binary_above` steps. Defaults to None.
+        binary_above (int, optional): The number of steps above which the binary dispatch is used by default. Defaults to BINARY_DISPATCH_ABOVE.
+
+    Returns:
+        STATEMENT: The dispatch statement
+    """
+    if dispatch is None:
+        dispatch = 'binary' if len(steps) > binary_above else 'linear'
+    if dispatch not in ('linear', 'binary'):
+        raise ValueError(f"Unknown dispatch {dispatch}, expected 'linear' or 'binary'")
+    cases = [(i, [COMMENT(f"Step {i}"), step]) for i, step in enumerate(steps)]
+    if dispatch == 'binary':
+        comparisons:Dict[int, int] = {}
+        arms:Dict[int, CONDITION_ARM] = {}
+        statement = binary_dispatch(step_var, cases, comparisons, arms)
+        return DISPATCH(step_var.name, statement, cases=[(i, comparisons[i], arms[i]) for i, _ in cases], expression=step_var)
+    statement = None
+    for i, body in cases:
+        if i == 0:
+            statement = IF(step_var == 0)(*body)
+            continue
+        statement = statement.ELIF(step_var == i)(*body)
+    return DISPATCH(step_var.name, statement, cases=[(i, i + 1, arm) for i, arm in enumerate(statement.arms)], expression=step_var)
+
 class ROUTINE(BLOCK):
-    def __init__(self, name:str, step_tag:Tag, steps:List[STATEMENT]):
+    def __init__(self, name:str, step_tag:Tag, steps:List[STATEMENT], dispatch:Optional[str] = None, binary_above:int = BINARY_DISPATCH_ABOVE):
+        """A sequence of steps, one of them executed each time the macro runs
+
+        Args:
+            name (str): The name of the routine
+            step_tag (Tag): The tag holding the current step
+            steps (List[STATEMENT]): The steps
+            dispatch (Optional[str], optional): How the current step is selected, see `step_dispatch`. Defaults to None.
+            binary_above (int, optional): The number of steps above which the binary dispatch is used by default. Defaults to BINARY_DISPATCH_ABOVE.
+        """
         super().__init__()
         self.step_tag = step_tag
-        self.step_var = Variable(f"{name}_step", "short", 0)
+        self.step_var = Temporary(f"{name}_step", "short", 0)
         self.statements.extend([
             COMMENT(f"---------- START ROUTINE {name} ----------"),
             COMMENT("Get current step"),
@@ -188,20 +288,7 @@ class ROUTINE(BLOCK):
             EMPTY(),
         ])
         
-        statement = None
-        for i, step in enumerate(steps):
-            if i == 0:
-                statement = IF(self.step_var == 0)(
-                    COMMENT("Step 0"),
-                    step
-                )
-                continue
-            
-            statement = statement.ELIF(self.step_var == i)(
-                COMMENT(f"Step {i}"),
-                step
-            )
-        self.statements.append(statement)
+        self.statements.append(step_dispatch(self.step_var, steps, dispatch, binary_above))
         
         self.statements.extend([
             EMPTY(),
@@ -221,12 +308,22 @@ class ROUTINE(BLOCK):
         ])
         
 class ASYNC_ROUTINE(BLOCK):
-    def __init__(self, name:str, step_tag:Tag, delay:AnyInt, steps:List[STATEMENT]):
+    def __init__(self, name:str, step_tag:Tag, delay:AnyInt, steps:List[STATEMENT], dispatch:Optional[str] = None, binary_above:int = BINARY_DISPATCH_ABOVE):
+        """A sequence of steps, executed one after the other by retriggering the macro
+
+        Args:
+            name (str): The name of the routine
+            step_tag (Tag): The tag holding the current step
+            delay (AnyInt): The delay between two steps in ms
+            steps (List[STATEMENT]): The steps
+            dispatch (Optional[str], optional): How the current step is selected, see `step_dispatch`. Defaults to None.
+            binary_above (int, optional): The number of steps above which the binary dispatch is used by default. Defaults to BINARY_DISPATCH_ABOVE.
+        """
         super().__init__()
         self.name = name
         self.step_tag = step_tag
         self.delay = delay
-        self.step_var = Variable(f"{name}_step", "short", 0)
+        self.step_var = Temporary(f"{name}_step", "short", 0)
         self.statements.extend([
             COMMENT(f"---------- START ROUTINE {name} ----------"),
             COMMENT("Get current step"),
@@ -234,20 +331,7 @@ class ASYNC_ROUTINE(BLOCK):
             EMPTY(),
         ])
         
-        statement = None
-        for i, step in enumerate(steps):
-            if i == 0:
-                statement = IF(self.step_var == 0)(
-                    COMMENT("Step 0"),
-                    step
-                )
-                continue
-            
-            statement = statement.ELIF(self.step_var == i)(
-                COMMENT(f"Step {i}"),
-                step
-            )
-        self.statements.append(statement)
+        self.statements.append(step_dispatch(self.step_var, steps, dispatch, binary_above))
         
         self.statements.extend([
             EMPTY(),
@@ -283,42 +367,175 @@ ON = vbool("on", True)
 OFF = vbool("off", False)
 
 class TASK(STATEMENT):
-    def __init__(self, name:str, command_tag:Tag, body:STATEMENT):
+    def __init__(self, name:str, command_tag:Tag, body:STATEMENT, priority:int = 0):
         super().__init__(command_tag, body)
         self.name = name
+        # Higher priorities run first in a `BUDGETED_SCHEDULER`
+        self.priority = priority
         self.command_tag = command_tag
-        self.command_var = vbool("p_task_cmd", False)
-        self.body = BLOCK(
-            COMMENT(f"========== START TASK {name} =========="),
-            self.command_tag.read(self.command_var),
-            IF(self.command_var)(
-                body,
+        self.command_var = Temporary("p_task_cmd", "bool", False)
+        # The command word and bit of the task once its scheduler packs the commands, see `pack_commands`
+        self.command_bit:Optional[Tuple[Tag, int]] = None
+        # The copy of the command word `enable`/`disable` edit, shared by the tasks of the scheduler
+        self.word_var:Optional[Temporary[int]] = None
+        # The macro `enable` triggers when the scheduler of the task parks itself while idle
+        self.trigger:Optional[str] = None
+        # The tag set while the scheduler is parked, `enable` only triggers it then
+        self.parked_tag:Optional[Tag] = None
+        self.parked_var = Temporary("p_task_parked", "bool", False)
+        self._task_body = body
+        self.body = self._build(self.command_var, self.command_tag.read(self.command_var))
+        self.resources.add(self.body)
+    
+    def _build(self, condition:AnyValue, *read:STATEMENT) -> BLOCK:
+        return BLOCK(
+            COMMENT(f"========== START TASK {self.name} =========="),
+            *read,
+            IF(condition)(
+                self._task_body,
                 EMPTY(),
                 COMMENT("Done"),
                 self.disable(),
                 SCHEDULER.done_var.set(True),
             ),
-            COMMENT(f"========== END TASK {name} =========="),
+            COMMENT(f"========== END TASK {self.name} =========="),
         )
+    
+    def pack(self, word_tag:Tag, word:AnyVariable[int], bit:int, word_var:Temporary[int]):
+        """Moves the command of the task to a bit of a command word
+        
+        The task then tests the bit in the copy of the word its scheduler read, and `enable`/`disable`
+        set the bit in the word on the device.
+
+        Args:
+            word_tag (Tag): The tag of the command word
+            word (AnyVariable[int]): The variable holding the command word read by the scheduler
+            bit (int): The bit of the task in the word
+            word_var (Temporary[int]): The variable `enable`/`disable` read the word to and write it from
+        """
+        self.command_bit = (word_tag, bit)
+        self.word_var = word_var
+        self.resources.discard(self.body)
+        self.body = self._build(GETBIT(word, bit))
         self.resources.add(self.body)
     
-    def bake(self, macro:Macro):
-        self.body.bake(macro)
+    def expand(self) -> List[STATEMENT]:
+        return [self.body]
+    
+    def _set_bit(self, on:bool) -> STATEMENT:
+        word_tag, bit = self.command_bit
+        return BLOCK(
+            word_tag.read(self.word_var),
+            SETBITON(self.word_var, bit) if on else SETBITOFF(self.word_var, bit),
+            word_tag.write(self.word_var),
+        )
+    
+    def _command(self, on:bool) -> STATEMENT:
+        """The statements enabling or disabling the task, for the scheduler it currently has, see `TASK_COMMAND`"""
+        if self.command_bit is not None:
+            command = self._set_bit(on)
+        else:
+            command = self.command_tag.write(ON if on else OFF)
+        if not on or self.trigger is None:
+            return command
+        return BLOCK(
+            command,
+            COMMENT("Wake up the scheduler if it is parked"),
+            self.parked_tag.read(self.parked_var),
+            IF(self.parked_var)(
+                self.parked_tag.write(OFF),
+                ASYNC_TRIG_MACRO(self.trigger),
+            ),
+        )
     
     def enable(self) -> STATEMENT:
-        return self.command_tag.write(ON)
+        """Enables the task, see `TASK_COMMAND`"""
+        return TASK_COMMAND(self, True)
         
     def disable(self) -> STATEMENT:
-        return self.command_tag.write(OFF)
+        """Disables the task, see `TASK_COMMAND`"""
+        return TASK_COMMAND(self, False)
+
+class TASK_COMMAND(STATEMENT):
+    def __init__(self, task:TASK, on:bool):
+        """Enables or disables a task
+
+        The statements are chosen when the macro is built: the command is a bit of a command word once the
+        scheduler of the task packs the commands, and enabling wakes up a scheduler that parks while idle.
+        The scheduler can then be created before or after the command.
+
+        Args:
+            task (TASK): The task
+            on (bool): Whether the task is enabled
+        """
+        super().__init__()
+        self.task = task
+        self.on = on
+        # The statements and the state of the task they were chosen for
+        self._content:Optional[List[STATEMENT]] = None
+        self._state:Optional[Tuple[Any, ...]] = None
+    
+    def expand(self) -> List[STATEMENT]:
+        task = self.task
+        state = (task.command_bit, task.word_var, task.trigger, task.parked_tag)
+        if self._content is None or state != self._state:
+            self._content = [task._command(self.on)]
+            self._state = state
+        return self._content
+    
+    def __hash__(self):
+        return super().__hash__()
+
+# Number of task commands in a command word
+COMMAND_WORD_BITS = 16
+
+def pack_commands(tasks:List[TASK], command_words:Tag) -> STATEMENT:
+    """Gives each task a bit of the command words starting at `command_words`
+
+    Task k uses bit k % 16 of the word k // 16 after `command_words`, so the commands of all the tasks
+    are read with a single `GetData`. Enabling or disabling a task reads its word, sets or clears its bit
+    and writes the word back.
+
+    Args:
+        tasks (List[TASK]): The tasks of a scheduler
+        command_words (Tag): The first command word, on a numbered word address
+
+    Returns:
+        STATEMENT: The read of the command words
+    """
+    base = command_words.address_num
+    if base is None:
+        raise ValueError(f"The command words {command_words.name} must be on a numbered address")
+    register = command_words.address_register.strip()
+    count = (len(tasks) + COMMAND_WORD_BITS - 1) // COMMAND_WORD_BITS
+    words = VariableArray(f"p_{command_words.name}", 'unsigned short', count)
+    word_var = Temporary(f"p_{command_words.name}_word", 'unsigned short', 0)
+    for k, task in enumerate(tasks):
+        w, bit = divmod(k, COMMAND_WORD_BITS)
+        word_tag = Tag(f"{command_words.name}{w}", command_words.device_name, f"{register}, {base + w}", command_words.dtype)
+        task.pack(word_tag, words[w], bit, word_var)
+    return BLOCK(
+        COMMENT("Read the task commands"),
+        command_words.read(words[0], count),
+    )
     
 class SCHEDULER(STATEMENT):
     done_var = vbool("p_scheduler_done", False)
-    def __init__(self, *tasks:TASK):
+    def __init__(self, *tasks:TASK, command_words:Optional[Tag] = None):
+        """Runs the first enabled task each time the macro runs
+
+        Args:
+            *tasks (TASK): The tasks, by priority
+            command_words (Optional[Tag], optional): When given, the commands of the tasks are bits of the words
+                starting at this tag, see `pack_commands`. Defaults to None.
+        """
         super().__init__(*tasks)
         self.tasks:Dict[str, TASK] = {task.name : task for task in tasks}
+        commands = [] if command_words is None else [pack_commands(list(self.tasks.values()), command_words)]
         
         self.body = BLOCK(
             COMMENT("********** START SCHEDULER **********"),
+            *commands,
             *[BLOCK(
                 IF(~self.done_var)(
                     task,
@@ -328,49 +545,189 @@ class SCHEDULER(STATEMENT):
         )
         self.resources.add(self.body)
         
-    def bake(self, macro:Macro):
-        self.body.bake(macro)
+    def expand(self) -> List[STATEMENT]:
+        return [self.body]
         
 class ASYNC_SCHEDULER(STATEMENT):
     done_var = vbool("p_scheduler_done", False)
-    def __init__(self, name:str, delay:AnyInt, *tasks:TASK):
+    def __init__(self, name:str, delay:AnyInt, *tasks:TASK, command_words:Optional[Tag] = None, park:bool = False,
+                 parked_tag:Optional[Tag] = None, delay_tag:Optional[Tag] = None, max_delay:Optional[AnyInt] = None):
+        """Runs the first enabled task, then retriggers the macro after a delay
+
+        Args:
+            name (str): The name of the scheduler
+            delay (AnyInt): The delay between two runs in ms
+            *tasks (TASK): The tasks, by priority
+            command_words (Optional[Tag], optional): When given, the commands of the tasks are bits of the words
+                starting at this tag, see `pack_commands`. Defaults to None.
+            park (bool, optional): Whether the scheduler stops retriggering itself when no task is enabled.
+                It then sets `parked_tag`, and `TASK.enable` triggers the loop macro to wake it up when the tag is set.
+                Tasks enabled by writing their command from elsewhere won't wake it up. Defaults to False.
+            parked_tag (Optional[Tag], optional): The bit set while the scheduler is parked, required with `park`.
+                Defaults to None.
+            delay_tag (Optional[Tag], optional): When given, the delay doubles each time no task is enabled, up to `max_delay`,
+                and goes back to `delay` when a task runs. The tag holds the current delay between the macro and its loop macro.
+                Defaults to None.
+            max_delay (Optional[AnyInt], optional): The longest delay with `delay_tag`. Defaults to 16 times `delay`.
+        """
+        if park and parked_tag is None:
+            raise ValueError(f"The scheduler {name} needs a parked_tag to park")
         super().__init__(*tasks)
         self.name = name
         self.delay = delay
+        self.park = park
+        self.parked_tag = parked_tag
+        self.delay_tag = delay_tag
+        self.max_delay = max_delay if max_delay is not None else delay * 16
+        self.delay_var = vint(f"p_{name}_delay", 0)
         self.tasks:Dict[str, TASK] = {task.name : task for task in tasks}
+        commands = [] if command_words is None else [pack_commands(list(self.tasks.values()), command_words)]
+        if park:
+            for task in self.tasks.values():
+                task.trigger = f"{self.name}_loop"
+                task.parked_tag = parked_tag
+        
+        backoff = []
+        if delay_tag is not None:
+            backoff = [
+                COMMENT("Back off while no task is enabled"),
+                delay_tag.read(self.delay_var),
+                IF(self.done_var)(
+                    self.delay_var.set(self.delay),
+                ).ELSE()(
+                    self.delay_var.set(self.delay_var * 2),
+                ),
+                IF(self.delay_var < self.delay)(
+                    self.delay_var.set(self.delay),
+                ),
+                IF(self.delay_var > self.max_delay)(
+                    self.delay_var.set(self.max_delay),
+                ),
+                delay_tag.write(self.delay_var),
+            ]
+        retrigger = ASYNC_TRIG_MACRO(f"{self.name}_loop")
+        if park:
+            retrigger = IF(self.done_var)(
+                retrigger,
+            ).ELSE()(
+                COMMENT("Park until a task is enabled"),
+                parked_tag.write(ON),
+            )
         
         self.body = BLOCK(
             COMMENT(f"********** START SCHEDULER {self.name} **********"),
+            *commands,
             *[BLOCK(
                 IF(~self.done_var)(
                     task,
                 ),
             ) for task in self.tasks.values()],
-            ASYNC_TRIG_MACRO(f"{self.name}_loop"),
+            *backoff,
+            retrigger,
             COMMENT(f"********** END SCHEDULER {self.name} **********"),
         )
         self.resources.add(self.body)
         
-    def bake(self, macro:Macro):
-        self.body.bake(macro)
+    def expand(self) -> List[STATEMENT]:
+        return [self.body]
         
     def loop_macro(self, macro_name:str) -> Macro:
         loop_macro = Macro(f"{self.name}_loop", f"Loop for the {self.name} scheduler")
         with loop_macro as macro:
+            if self.delay_tag is None:
+                delay = [DELAY(self.delay)]
+            else:
+                delay = [self.delay_tag.read(self.delay_var), DELAY(self.delay_var)]
             macro.write(
                 COMMENT("Call original macro"),
-                DELAY(self.delay),
+                *delay,
                 ASYNC_TRIG_MACRO(macro_name),
             )
         return loop_macro
     
+class BUDGETED_SCHEDULER(STATEMENT):
+    def __init__(self, name:str, budget:int, cursor_tag:Tag, *tasks:TASK):
+        """Runs as many enabled tasks as fit in a budget each time the macro runs
+
+        The cost of each task is estimated statically with `estimate_cost`. Tasks run by decreasing priority, and
+        a task runs when its cost fits in what is left of the budget, or when it is the first to run. The first
+        enabled task that doesn't fit ends the scan.
+        
+        Tasks of the same priority take turns: the next scan starts at the task that didn't fit, and the tasks before
+        it wait until the end of the list is reached. The position of each priority is kept in the words starting at
+        `cursor_tag` between two scans.
+
+        Args:
+            name (str): The name of the scheduler
+            budget (int): The cost allowed per scan, see `INSTRUCTION_WEIGHTS`
+            cursor_tag (Tag): The first of the words holding the position of each priority, one word per priority
+            *tasks (TASK): The tasks
+        """
+        super().__init__(*tasks)
+        self.name = name
+        self.budget = budget
+        self.tasks:Dict[str, TASK] = {task.name : task for task in tasks}
+        self.costs:Dict[str, int] = {
+            task.name : estimate_cost(task.command_tag.read(task.command_var), task._task_body, task.disable())
+            for task in tasks
+        }
+        priorities = sorted({task.priority for task in tasks}, reverse=True)
+        self.spent_var = vint(f"p_{name}_spent", 0)
+        self.stop_var = vbool(f"p_{name}_stop", False)
+        self.cursor_var = VariableArray(f"p_{name}_cursor", 'short', len(priorities))
+        
+        levels = []
+        for level, priority in enumerate(priorities):
+            group = [task for task in tasks if task.priority == priority]
+            cursor = self.cursor_var[level]
+            slots = []
+            for i, task in enumerate(group):
+                cost = self.costs[task.name]
+                # A scan resuming at the cursor skips the tasks before it, including the first one
+                condition = ~self.stop_var & (cursor <= i)
+                slots.append(IF(condition)(
+                    task.command_tag.read(task.command_var),
+                    IF(task.command_var)(
+                        IF((self.spent_var == 0) | (self.spent_var <= budget - cost))(
+                            COMMENT(f"========== TASK {task.name} (cost {cost}) =========="),
+                            task._task_body,
+                            task.disable(),
+                            self.spent_var.set(self.spent_var + cost),
+                        ).ELSE()(
+                            COMMENT("Out of budget, resume here on the next scan"),
+                            cursor.set(i),
+                            self.stop_var.set(True),
+                        ),
+                    ),
+                ))
+            levels.append(BLOCK(
+                COMMENT(f"---------- PRIORITY {priority} ----------"),
+                *slots,
+                IF(~self.stop_var)(
+                    COMMENT("Every task had its turn"),
+                    cursor.set(0),
+                ),
+            ))
+        
+        self.body = BLOCK(
+            COMMENT(f"********** START SCHEDULER {self.name} **********"),
+            cursor_tag.read(self.cursor_var[0], len(priorities)),
+            *levels,
+            cursor_tag.write(self.cursor_var[0], len(priorities)),
+            COMMENT(f"********** END SCHEDULER {self.name} **********"),
+        )
+        self.resources.add(self.body)
+        
+    def expand(self) -> List[STATEMENT]:
+        return [self.body]
+    
 class INDIRECT_TAG(Resource):
     def __init__(self, indirect_tag:Tag, indirect_var:AnyVariable, actual_tags:List[Tag]):
         super().__init__(indirect_tag, indirect_var, *actual_tags)
         self.indirect_tag = indirect_tag
         self.actual_tags = actual_tags
         self.indirect_var = indirect_var
-        self.selected_var = vint(f"{indirect_tag.name}_selection", 0)
+        self.selected_var = Temporary(f"{indirect_tag.name}_selection", "int", 0)
         
     def select(self, index:AnyInt) -> STATEMENT:
         return self.selected_var.set(index)
@@ -382,7 +739,54 @@ class INDIRECT_TAG(Resource):
     def write_to_indirect(self) -> STATEMENT:
         return self.indirect_tag.write(self.indirect_var)
     
+    def progression(self) -> Optional[Tuple[str, str, int, int]]:
+        """The device, register, first address and address step of the actual tags
+        
+        Returns:
+            Optional[Tuple[str, str, int, int]]: None unless the actual tags are on numbered addresses of the same register,
+            evenly spaced
+        """
+        if len(self.actual_tags) < 2:
+            return None
+        first = self.actual_tags[0]
+        device, register = first.device_name, first.address_register.strip()
+        addresses = []
+        for tag in self.actual_tags:
+            if tag.address_num is None or tag.device_name != device or tag.address_register.strip() != register:
+                return None
+            addresses.append(tag.address_num)
+        step = addresses[1] - addresses[0]
+        if step == 0 or any(b - a != step for a, b in zip(addresses, addresses[1:])):
+            return None
+        return device, register, addresses[0], step
+    
+    def _computed(self, funcName:str) -> Optional[STATEMENT]:
+        """A single access at the address of the selected tag, None if it can't be computed"""
+        progression = self.progression()
+        if progression is None:
+            return None
+        device, register, base, step = progression
+        offset = self.selected_var if step == 1 else self.selected_var * step
+        if base != 0:
+            offset = offset + base
+        return IF(self.selected_var >= 0)(
+            IF(self.selected_var <= len(self.actual_tags) - 1)(
+                CALL(funcName, self.indirect_var, string_literal(device), LITERAL(register), offset, 1),
+            ),
+        )
+    
     def read_from_actual(self) -> STATEMENT:
+        """Reads the selected actual tag into the indirect variable
+        
+        When the actual tags are evenly spaced (see `progression`), the address is computed from the selection.
+        Otherwise each actual tag has its own `CASE` of a `SWITCH`.
+        """
+        computed = self._computed('GetData')
+        if computed is not None:
+            return BLOCK(
+                COMMENT(f"Reading indirect tag {self.indirect_tag.name} from actual"),
+                computed,
+            )
         return BLOCK(
             COMMENT(f"Reading indirect tag {self.indirect_tag.name} from actual"),
             SWITCH(self.selected_var)(
@@ -391,10 +795,16 @@ class INDIRECT_TAG(Resource):
         )
     
     def write_to_actual(self) -> STATEMENT:
+        """Writes the indirect variable to the selected actual tag, see `read_from_actual`"""
+        computed = self._computed('SetData')
+        if computed is not None:
+            return BLOCK(
+                COMMENT(f"Writing indirect tag {self.indirect_tag.name} to actual"),
+                computed,
+            )
         return BLOCK(
             COMMENT(f"Writing indirect tag {self.indirect_tag.name} to actual"),
             SWITCH(self.selected_var)(
                 *[CASE(i)(tag.write(self.indirect_var)) for i, tag in enumerate(self.actual_tags)]
             )
         )
-        
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""eb_macro_gen.passes — Opt-in optimization passes over the statements of a macro.
+
+Each pass is a function taking the `Macro` and returning a report of what it changed.
+Passes run with `Macro.optimize`, once the macro is written and before it is built:
+
+>>> with macro:
+...     macro.write(...)
+>>> report, = macro.optimize(fold_constants)
+>>> macro.display()
+
+Public API
+----------
+from eb_macro_gen.passes.folding import fold_constants, ConstantFolder, FoldingReport
+from eb_macro_gen.passes.coalescing import coalesce_reads, coalesce_writes, CoalescingReport
+from eb_macro_gen.passes.planning import plan_reads, ReadPlanner, ReadPlan, ReadBlock
+from eb_macro_gen.passes.scan_image import scan_image, ScanImage, ScanImageReport
+from eb_macro_gen.passes.redundancy import eliminate_redundant_reads, RedundantReadReport
+from eb_macro_gen.passes.temporaries import allocate_temporaries, AllocationReport
+from eb_macro_gen.passes.loops import roll_loops, LoopRoller, RollingReport
+from eb_macro_gen.passes.outlining import outline_blocks, Outliner, OutliningReport
+"""
+
+from eb_macro_gen.passes.folding import fold_constants, ConstantFolder, FoldingReport
+from eb_macro_gen.passes.coalescing import coalesce_reads, coalesce_writes, CoalescingReport
+from eb_macro_gen.passes.planning import plan_reads, ReadPlanner, ReadPlan, ReadBlock
+from eb_macro_gen.passes.scan_image import scan_image, ScanImage, ScanImageReport
+from eb_macro_gen.passes.redundancy import eliminate_redundant_reads, RedundantReadReport
+from eb_macro_gen.passes.temporaries import allocate_temporaries, AllocationReport
+from eb_macro_gen.passes.loops import roll_loops, LoopRoller, RollingReport
+from eb_macro_gen.passes.outlining import outline_blocks, Outliner, OutliningReport
+
+__all__ = [
+    "fold_constants",
+    "ConstantFolder",
+    "FoldingReport",
+    "coalesce_reads",
+    "coalesce_writes",
+    "CoalescingReport",
+    "plan_reads",
+    "ReadPlanner",
+    "ReadPlan",
+    "ReadBlock",
+    "scan_image",
+    "ScanImage",
+    "ScanImageReport",
+    "eliminate_redundant_reads",
+    "RedundantReadReport",
+    "allocate_temporaries",
+    "AllocationReport",
+    "roll_loops",
+    "LoopRoller",
+    "RollingReport",
+    "outline_blocks",
+    "Outliner",
+    "OutliningReport",
+]
@@ -0,0 +1,317 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Type
+
+from eb_macro_gen.instructions import REGISTER_WIDTHS
+from eb_macro_gen.objects import TAG_READ, TAG_WRITE, DataType, Tag
+from eb_macro_gen.syntax import (
+    AND, ASSIGNMENT, BINARY, BLOCK, CALL, COMMENT, EMPTY, EVAL, OR, STATEMENT, UNARY,
+    AnyVariable, Macro, Resource, Variable, VariableArray, VariableItem, iter_bodies, walk,
+)
+
+
+@dataclass
+class CoalescingReport:
+    """What a coalescing pass changed"""
+    calls:int = 0
+    blocks:int = 0
+
+    @property
+    def saved(self) -> int:
+        """The number of device round trips saved per scan"""
+        return self.calls - self.blocks
+
+    def __str__(self) -> str:
+        return f"{self.calls} calls merged into {self.blocks} bulk calls, {self.saved} round trips saved"
+
+
+@dataclass(eq=False)
+class Access:
+    """A single element read or written by a `TAG_READ` or `TAG_WRITE`"""
+    statement:STATEMENT
+    body:List[STATEMENT]
+    index:int
+    var:AnyVariable
+    device:str
+    register:str
+    address:int
+    width:int
+    dtype:str
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        """Accesses sharing a key can be merged into the same bulk call"""
+        return (self.device, self.register, self.dtype)
+
+
+def _dtype(var:AnyVariable) -> Optional[str]:
+    if isinstance(var, Variable):
+        return var.dtype
+    if isinstance(var, VariableItem):
+        return var.array.dtype
+    return None
+
+
+def access_of(statement:STATEMENT, var:AnyVariable, tag:Tag, count, body:List[STATEMENT], index:int) -> Optional[Access]:
+    """Describes the element accessed by a tag read or write, None if it can't be merged
+
+    Only single elements on a numbered address are merged. On bit devices, `bool` variables use one bit each.
+    On word devices, variables use the number of registers given by `REGISTER_WIDTHS`.
+    """
+    dtype = _dtype(var)
+    address = tag.address_num
+    if count != 1 or dtype is None or address is None:
+        return None
+    if tag.dtype == DataType.Bit:
+        if dtype != 'bool':
+            return None
+        width = 1
+    else:
+        width = REGISTER_WIDTHS.get(dtype)
+        if width is None or width != int(width):
+            return None
+    return Access(statement, body, index, var, tag.device_name, tag.address_register.strip(), address, int(width), dtype)
+
+
+def straight_line(body:List[STATEMENT], inlined:Set[int]) -> Iterator[Tuple[List[STATEMENT], int, STATEMENT]]:
+    """Iterates over a list of statements, going through the nested `BLOCK`s
+
+    Args:
+        body (List[STATEMENT]): The statements
+        inlined (Set[int]): Filled with the ids of the nested lists that were gone through
+
+    Yields:
+        Tuple[List[STATEMENT], int, STATEMENT]: The list holding each statement, its index in the list and the statement
+    """
+    stack = [(body, 0)]
+    while stack:
+        current, i = stack.pop()
+        while i < len(current):
+            s = current[i]
+            if type(s) is BLOCK:
+                inlined.add(id(s.statements))
+                stack.append((current, i + 1))
+                current, i = s.statements, 0
+                continue
+            yield current, i, s
+            i += 1
+
+
+def segments(accesses:List[Access]) -> List[List[Access]]:
+    """Splits accesses into runs of contiguous addresses
+
+    Accesses are grouped by device, register and variable type, then sorted by address.
+    An address accessed more than once stays in the same run.
+
+    Args:
+        accesses (List[Access]): The accesses, in statement order
+
+    Returns:
+        List[List[Access]]: The runs of at least two distinct addresses, each sorted by address
+    """
+    groups:Dict[Tuple[str, str, str], List[Access]] = {}
+    for a in accesses:
+        groups.setdefault(a.key, []).append(a)
+    runs:List[List[Access]] = []
+    for group in groups.values():
+        group.sort(key=lambda a: a.address)
+        run = [group[0]]
+        for a in group[1:]:
+            last = run[-1]
+            if a.address == last.address or a.address == last.address + last.width:
+                run.append(a)
+                continue
+            runs.append(run)
+            run = [a]
+        runs.append(run)
+    return [run for run in runs if run[0].address != run[-1].address]
+
+
+def used_names(macro:Macro) -> Set[str]:
+    """The names of the variables and arrays the statements of a macro use"""
+    names:Set[str] = set()
+    values:List[Any] = []
+    for s, content in walk(*macro.statements):
+        if content is None:
+            s.map_expressions(lambda v, _: values.append(v) or v)
+            if isinstance(s, ASSIGNMENT):
+                values.append(s.var)
+    seen:Set[int] = set()
+    while values:
+        v = values.pop()
+        if id(v) in seen:
+            continue
+        seen.add(id(v))
+        if isinstance(v, (Variable, VariableArray)):
+            names.add(v.name)
+        if isinstance(v, VariableItem):
+            values.append(v.index)
+        if isinstance(v, Resource):
+            values.extend(v.resources)
+    return names
+
+
+class ScratchArrays:
+    """The arrays bulk calls use, one per variable type, sized to the largest use
+
+    An array never takes the name of a variable the macro already uses, the arrays of an earlier run of the
+    pass for example: it would be declared once, with the size of only one of them.
+    """
+    def __init__(self, prefix:str, macro:Macro):
+        self.prefix = prefix
+        self.arrays:Dict[str, VariableArray] = {}
+        self.taken = used_names(macro)
+
+    def get(self, dtype:str, size:int) -> VariableArray:
+        array = self.arrays.get(dtype)
+        if array is None:
+            base = f"{self.prefix}_{dtype.replace(' ', '_')}"
+            name, k = base, 1
+            while name in self.taken:
+                k += 1
+                name = f"{base}_{k}"
+            self.taken.add(name)
+            array = VariableArray(name, dtype, size)
+            self.arrays[dtype] = array
+        array.size = max(array.size, size)
+        return array
+
+
+def bulk_tag(run:List[Access]) -> Tag:
+    """A tag covering every address of a run"""
+    first = run[0]
+    return Tag(f"{first.register}_{first.address}_{run[-1].address}", first.device, f"{first.register}, {first.address}", first.statement.tag.dtype)
+
+
+def is_pure(value) -> bool:
+    """Whether evaluating a value can't call a function"""
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, EVAL):
+            return False
+        if isinstance(v, BINARY):
+            stack.extend((v.left, v.right))
+        elif isinstance(v, UNARY):
+            stack.append(v.expression)
+        elif isinstance(v, (AND, OR)):
+            stack.extend(v._expressions)
+        elif isinstance(v, VariableItem):
+            stack.append(v.index)
+    return True
+
+
+def windows(body:List[STATEMENT], kind:Type[CALL], inlined:Set[int]) -> Iterator[List[Access]]:
+    """Iterates over the windows of tag accesses of a kind that are only separated by comments and assignments
+
+    Assignments calling functions, and any other statement, end a window.
+
+    Args:
+        body (List[STATEMENT]): The statements
+        kind (Type[CALL]): `TAG_READ` or `TAG_WRITE`
+        inlined (Set[int]): Filled with the ids of the nested lists that were gone through
+
+    Yields:
+        List[Access]: The accesses of each window of at least two accesses, in statement order
+    """
+    window:List[Access] = []
+    for current, i, s in straight_line(body, inlined):
+        if isinstance(s, (COMMENT, EMPTY)):
+            continue
+        if isinstance(s, ASSIGNMENT) and is_pure(s.var) and is_pure(s.value):
+            continue
+        access = None
+        if isinstance(s, kind):
+            access = access_of(s, s.params[0], s.tag, s.count, current, i)
+        if access is not None:
+            window.append(access)
+            continue
+        if len(window) > 1:
+            yield window
+        window = []
+    if len(window) > 1:
+        yield window
+
+
+def coalesce_reads(macro:Macro) -> CoalescingReport:
+    """Optimization pass merging tag reads on contiguous addresses into bulk reads
+
+    In each straight-line list of statements (going through nested `BLOCK`s), tag reads only separated by
+    comments and assignments are grouped by device, register and variable type. Reads of contiguous addresses are replaced
+    by a single `GetData` into a scratch array, followed by an assignment at the place of each original read.
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        CoalescingReport: The number of merged reads and of bulk reads
+    """
+    report = CoalescingReport()
+    scratch = ScratchArrays("p_read", macro)
+    inlined:Set[int] = set()
+    for body in iter_bodies(macro.statements):
+        if id(body) in inlined:
+            continue
+        for window in list(windows(body, TAG_READ, inlined)):
+            # The runs of a window are interleaved, each one gets its own elements of the scratch arrays
+            offsets:Dict[str, int] = {}
+            for run in segments(window):
+                first = run[0]
+                count = (run[-1].address - first.address) // first.width + 1
+                offset = offsets.get(first.dtype, 0)
+                offsets[first.dtype] = offset + count
+                array = scratch.get(first.dtype, offset + count)
+                read = bulk_tag(run).read(array[offset], count)
+                for a in run:
+                    # Each variable is still assigned where it was read
+                    a.body[a.index] = a.var.set(array[offset + (a.address - first.address) // first.width])
+                members = {id(a) for a in run}
+                a = next(a for a in window if id(a) in members)
+                a.body[a.index] = BLOCK(read, a.body[a.index])
+                report.calls += len(run)
+                report.blocks += 1
+    return report
+
+
+coalesce_reads.reads_tags = True
+
+
+def coalesce_writes(macro:Macro) -> CoalescingReport:
+    """Optimization pass merging tag writes on contiguous addresses into bulk writes
+
+    The mirror of `coalesce_reads`: each value is copied into a scratch array where it was written,
+    and a single `SetData` sends the whole array at the place of the last write.
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        CoalescingReport: The number of merged writes and of bulk writes
+    """
+    report = CoalescingReport()
+    scratch = ScratchArrays("p_write", macro)
+    inlined:Set[int] = set()
+    for body in iter_bodies(macro.statements):
+        if id(body) in inlined:
+            continue
+        for window in list(windows(body, TAG_WRITE, inlined)):
+            # The runs of a window are interleaved, each one gets its own elements of the scratch arrays
+            offsets:Dict[str, int] = {}
+            for run in segments(window):
+                first = run[0]
+                count = (run[-1].address - first.address) // first.width + 1
+                offset = offsets.get(first.dtype, 0)
+                offsets[first.dtype] = offset + count
+                array = scratch.get(first.dtype, offset + count)
+                write = bulk_tag(run).write(array[offset], count)
+                for a in run:
+                    a.body[a.index] = array[offset + (a.address - first.address) // first.width].set(a.var)
+                members = {id(a) for a in run}
+                a = next(a for a in reversed(window) if id(a) in members)
+                a.body[a.index] = BLOCK(a.body[a.index], write)
+                report.calls += len(run)
+                report.blocks += 1
+    return report
+
+
+coalesce_writes.reads_tags = True
@@ -0,0 +1,249 @@
+from __future__ import annotations
+import copy
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from eb_macro_gen.syntax import (
+    AND, BINARY, C_ELIF, C_ELSE, C_IF, CONDITION_BLOCK, EVAL, EXPRESSION, NOT, OR, UNARY,
+    Macro, Resource, iter_bodies,
+)
+
+# Binding strength of the binary operators. Expressions are rendered without parentheses,
+# so a sub expression can only be folded when its text is parsed as a whole.
+PRECEDENCE:Dict[str, int] = {
+    '*' : 3, '/' : 3, '%' : 3,
+    '+' : 2, '-' : 2,
+    '==' : 1, '<>' : 1, '<' : 1, '<=' : 1, '>' : 1, '>=' : 1,
+}
+
+
+def is_constant(value:Any) -> bool:
+    """Whether a value is a number known when generating the macro"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _compute(operator:str, a:Any, b:Any) -> Optional[Any]:
+    """Computes a binary operation the way the HMI would, None if it can't be done safely"""
+    if operator == '+':
+        return a + b
+    if operator == '-':
+        return a - b
+    if operator == '*':
+        return a * b
+    if operator == '/':
+        if b == 0:
+            return None
+        if isinstance(a, int) and isinstance(b, int):
+            # Only exact integer divisions, the rounding of the HMI is not assumed
+            return a // b if a % b == 0 else None
+        return a / b
+    if operator == '%':
+        if b == 0 or not isinstance(a, int) or not isinstance(b, int):
+            return None
+        return int(math.fmod(a, b))
+    if operator == '==':
+        return int(a == b)
+    if operator == '<>':
+        return int(a != b)
+    if operator == '<':
+        return int(a < b)
+    if operator == '<=':
+        return int(a <= b)
+    if operator == '>':
+        return int(a > b)
+    if operator == '>=':
+        return int(a >= b)
+    return None
+
+
+def _is_unit(parent:BINARY, child:Any, left:bool) -> bool:
+    """Whether the text of `child` is parsed as a whole inside the text of `parent`"""
+    if not isinstance(child, BINARY):
+        return True
+    p = PRECEDENCE.get(parent.operator)
+    c = PRECEDENCE.get(child.operator)
+    if p is None or c is None or (p == 1 and c == 1):
+        return False
+    return c >= p if left else c > p
+
+
+@dataclass
+class FoldingReport:
+    """What `fold_constants` changed"""
+    expressions:int = 0
+    arms:int = 0
+
+    def __str__(self) -> str:
+        return f"{self.expressions} expressions folded, {self.arms} condition arms removed"
+
+
+class ConstantFolder:
+    """Folds constant sub expressions
+
+    Arithmetic and comparisons between numbers are computed. Where only the truth of a value matters
+    (conditions and operands of `and`, `or` and `not`), `1 and x` and `0 or x` become `x`, and `not not x` becomes `x`.
+    """
+    def __init__(self):
+        self.folded = 0
+        self._memo:Dict[Tuple[int, bool, bool], Any] = {}
+        # Keeps the folded expressions alive so their ids can't be reused
+        self._keep:List[Any] = []
+
+    def _children(self, e:EXPRESSION, unit:bool) -> List[Tuple[Any, bool, bool]]:
+        """The operands of an expression with whether each is parsed as a whole and used as a condition"""
+        if isinstance(e, BINARY):
+            return [(e.left, unit and _is_unit(e, e.left, True), False), (e.right, unit and _is_unit(e, e.right, False), False)]
+        if isinstance(e, UNARY):
+            # The binding strength of `not` is not assumed
+            return [(e.expression, False, e.operator == 'not')]
+        if isinstance(e, (AND, OR)):
+            return [(o, True, True) for o in e._expressions]
+        if isinstance(e, EVAL):
+            return [(p, True, False) for p in e.params]
+        return []
+
+    def _group(self, value:Any, unit:bool) -> Any:
+        """Keeps a value parsed as a whole where it replaces a parenthesized expression"""
+        if not unit and isinstance(value, BINARY):
+            return AND(value)
+        return value
+
+    def _rebuild(self, e:EXPRESSION, unit:bool, condition:bool, operands:List[Any], children:List[Tuple[Any, bool, bool]]) -> Any:
+        changed = any(o is not c[0] for o, c in zip(operands, children))
+        if isinstance(e, BINARY):
+            left, right = operands
+            if unit and is_constant(left) and is_constant(right):
+                value = _compute(e.operator, left, right)
+                if value is not None:
+                    self.folded += 1
+                    return value
+            return BINARY(e.operator, left, right) if changed else e
+        if isinstance(e, UNARY):
+            operand, = operands
+            if e.operator == 'not':
+                if is_constant(operand):
+                    self.folded += 1
+                    return int(not operand)
+                if condition and isinstance(operand, NOT):
+                    self.folded += 1
+                    return self._group(operand.expression, unit)
+                return NOT(operand) if changed else e
+            return UNARY(e.operator, operand) if changed else e
+        if isinstance(e, (AND, OR)):
+            absorbing = isinstance(e, OR)
+            if any(is_constant(o) and bool(o) == absorbing for o in operands):
+                # `0 and x` or `1 or x`
+                self.folded += 1
+                return int(absorbing)
+            kept = [o for o in operands if not is_constant(o)]
+            if not kept:
+                self.folded += 1
+                return int(not absorbing)
+            if len(kept) < len(operands) and (condition or len(kept) > 1):
+                # `1 and x` or `0 or x`
+                self.folded += 1
+                if len(kept) == 1:
+                    return self._group(kept[0], unit)
+                return type(e)(*kept)
+            return type(e)(*operands) if changed else e
+        if isinstance(e, EVAL):
+            if not changed:
+                return e
+            res = copy.copy(e)
+            res.params = operands
+            res.resources = {p for p in operands if isinstance(p, Resource)}
+            res._rendered = None
+            return res
+        return e
+
+    def fold(self, value:Any, condition:bool = False) -> Any:
+        """Folds the constant parts of an expression
+
+        The expression tree is walked with an explicit stack and is not modified, folded parts are new expressions.
+
+        Args:
+            value (Any): The expression
+            condition (bool, optional): Whether only the truth of the value matters. Defaults to False.
+
+        Returns:
+            Any: The folded expression, or a number if the whole expression is constant
+        """
+        results:List[Any] = []
+        stack:List[Tuple[Any, bool, bool, Optional[List[Tuple[Any, bool, bool]]]]] = [(value, True, condition, None)]
+        while stack:
+            e, unit, cond, children = stack.pop()
+            if not isinstance(e, EXPRESSION):
+                results.append(e)
+                continue
+            key = (id(e), unit, cond)
+            if children is None:
+                if key in self._memo:
+                    results.append(self._memo[key])
+                    continue
+                children = self._children(e, unit)
+                stack.append((e, unit, cond, children))
+                stack.extend((c, u, b, None) for c, u, b in reversed(children))
+                continue
+            operands = results[len(results) - len(children):]
+            del results[len(results) - len(children):]
+            res = self._rebuild(e, unit, cond, operands, children)
+            self._memo[key] = res
+            self._keep.append(e)
+            results.append(res)
+        return results[0]
+
+
+def _prune_arms(block:CONDITION_BLOCK) -> int:
+    """Removes the arms of a condition block whose condition is constant
+
+    Returns:
+        int: The number of removed arms
+    """
+    arms = []
+    for arm in block.arms:
+        header = arm.header
+        if isinstance(header, (C_IF, C_ELIF)) and is_constant(header.condition):
+            if not header.condition:
+                continue
+            arm.header = C_ELSE()
+        arms.append(arm)
+        if isinstance(arm.header, C_ELSE):
+            break
+    removed = len(block.arms) - len(arms)
+    if arms and isinstance(arms[0].header, C_ELIF):
+        arms[0].header = C_IF(arms[0].header.condition)
+    # The list is shared by every container of the chain
+    block.arms[:] = arms
+    return removed
+
+
+def fold_constants(macro:Macro) -> FoldingReport:
+    """Optimization pass folding constant expressions and removing the `if` arms they make unreachable
+
+    An arm whose condition is always true becomes the `else` of its block, and a block left with only
+    an `else` is replaced by its body.
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        FoldingReport: The number of folded expressions and removed arms
+    """
+    report = FoldingReport()
+    folder = ConstantFolder()
+    done:Set[int] = set()
+    for body in iter_bodies(macro.statements):
+        for s in body:
+            if id(s) in done:
+                continue
+            done.add(id(s))
+            s.map_expressions(folder.fold)
+            if isinstance(s, CONDITION_BLOCK):
+                for arm in s.arms:
+                    if id(arm.header) not in done:
+                        done.add(id(arm.header))
+                        arm.header.map_expressions(folder.fold)
+                report.arms += _prune_arms(s)
+    report.expressions = folder.folded
+    return report
@@ -0,0 +1,285 @@
+from __future__ import annotations
+from dataclasses import dataclass
+import re
+from typing import Any, Iterator, List, Optional, Set, Tuple
+
+from eb_macro_gen.passes.coalescing import straight_line
+from eb_macro_gen.syntax import (
+    AND, ASSIGNMENT, BINARY, CALL, COMMENT, EMPTY, FOR, LITERAL, STATEMENT, Macro, Temporary, Variable,
+    VariableArray, VariableItem, _size, iter_bodies,
+)
+
+# A numbered tag address, `LW, 100`
+_ADDRESS = re.compile(r'^\s*([A-Za-z_]\w*)\s*,\s*(\d+)\s*$')
+
+# Operations nested deeper than this are compared as a whole
+_MAX_DEPTH = 16
+
+
+@dataclass
+class RollingReport:
+    """What `roll_loops` changed"""
+    loops:int = 0
+    statements:int = 0
+    arrays:int = 0
+    lines:int = 0
+
+    def __str__(self) -> str:
+        return (f"{self.statements} statements rolled into {self.loops} loops with {self.arrays} value arrays, "
+                f"{self.lines} lines saved")
+
+
+def _shape(value:Any, constants:List[int], depth:int = 0) -> Any:
+    """The structure of a value, with its integer constants moved to `constants`"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        constants.append(int(value))
+        return '#'
+    if isinstance(value, Variable):
+        return ('var', value.name)
+    if isinstance(value, VariableItem):
+        return ('item', value.array.name, _shape(value.index, constants, depth + 1))
+    if isinstance(value, BINARY) and depth < _MAX_DEPTH:
+        return ('op', value.operator, _shape(value.left, constants, depth + 1), _shape(value.right, constants, depth + 1))
+    return ('text', str(value))
+
+
+def _build(value:Any, values:Iterator[Any], operand:bool = False, depth:int = 0) -> Any:
+    """Rebuilds a value with its integer constants replaced by `values`, in the order of `_shape`"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        v = next(values)
+        # The operators are written without parentheses
+        return AND(v) if operand and isinstance(v, BINARY) else v
+    if isinstance(value, VariableItem):
+        return value.array[_build(value.index, values, False, depth + 1)]
+    if isinstance(value, BINARY) and depth < _MAX_DEPTH:
+        return BINARY(value.operator, _build(value.left, values, True, depth + 1), _build(value.right, values, True, depth + 1))
+    return value
+
+
+class _Template:
+    """A statement with its integer constants taken out, statements with the same key only differ by these constants"""
+    def __init__(self, statement:STATEMENT):
+        self.statement = statement
+        self.constants:List[int] = []
+        if isinstance(statement, ASSIGNMENT):
+            self.key = ('=', _shape(statement.var, self.constants), _shape(statement.value, self.constants))
+            return
+        params = []
+        for p in statement.params:
+            address = _ADDRESS.match(p) if isinstance(p, str) else None
+            if address is not None:
+                self.constants.append(int(address.group(2)))
+                params.append(('address', address.group(1)))
+            else:
+                params.append(_shape(p, self.constants))
+        self.key = (statement.funcName, tuple(params))
+
+    @staticmethod
+    def of(statement:STATEMENT) -> Optional[_Template]:
+        """The template of a statement, None if it can't be repeated by a loop"""
+        if not isinstance(statement, (ASSIGNMENT, CALL)) or statement.expand() is not None:
+            return None
+        return _Template(statement)
+
+    def build(self, values:List[Any]) -> STATEMENT:
+        """The statement with its constants replaced"""
+        s = self.statement
+        it = iter(values)
+        if isinstance(s, ASSIGNMENT):
+            return ASSIGNMENT(_build(s.var, it), _build(s.value, it))
+        params = []
+        for p in s.params:
+            address = _ADDRESS.match(p) if isinstance(p, str) else None
+            if address is None:
+                params.append(_build(p, it))
+                continue
+            v = next(it)
+            if isinstance(v, int):
+                params.append(p if v == int(address.group(2)) else f"{address.group(1)}, {v}")
+            else:
+                # The address is computed like the one of an `INDIRECT_TAG`
+                params.extend((LITERAL(address.group(1)), v))
+        return CALL(s.funcName, *params)
+
+
+@dataclass
+class _Run:
+    """Repetitions of templates found in a straight-line list of statements, and the loop executing them"""
+    start:int
+    stop:int
+    statements:int
+    saved:int
+    loop:FOR
+    templates:List[_Template]
+    values:List[Any]
+    arrays:List[Tuple[int, ...]]
+
+
+class LoopRoller:
+    """Optimization pass rewriting repeated statements as a `FOR` loop
+
+    In each straight-line list of statements (going through nested `BLOCK`s), a group of assignments and calls
+    repeated at least `min_repeats` times in a row, whose repetitions only differ by integer constants (array
+    indexes, tag addresses, values...), becomes a `FOR` over a counter. A constant that changes by the same step
+    at each repetition is computed from the counter, the other ones are read from an array declared with their
+    values. Comments between the rolled statements are dropped.
+
+    A loop is only written when it makes the macro shorter, counting the declarations it adds. Reads and writes of
+    tags become plain `GetData`/`SetData` calls computing their address, so `Macro.optimize` refuses to run the passes
+    looking at the tags after this one.
+    """
+    # Rolled tag accesses become plain calls, see `Macro.optimize`
+    hides_tags = True
+    def __init__(self, min_repeats:int = 3, max_period:int = 8, counter:str = "p_loop_index"):
+        """Optimization pass rewriting repeated statements as a `FOR` loop
+
+        Args:
+            min_repeats (int, optional): The minimum number of repetitions rolled into a loop. Defaults to 3.
+            max_period (int, optional): The maximum number of statements repeated by a loop. Defaults to 8.
+            counter (str, optional): The name of the counter of the loops. Defaults to "p_loop_index".
+        """
+        self.min_repeats = min_repeats
+        self.max_period = max_period
+        self.counter = Temporary(counter, 'int')
+        self._names:Set[str] = set()
+        self._declared = False
+
+    def _array(self, values:Tuple[int, ...]) -> VariableArray:
+        """A new array declared with values"""
+        k = 0
+        while f"p_rolled{k}" in self._names:
+            k += 1
+        self._names.add(f"p_rolled{k}")
+        dtype = 'short' if all(-32768 <= v <= 32767 for v in values) else 'int'
+        return VariableArray(f"p_rolled{k}", dtype, len(values), list(values))
+
+    def _plan(self, items:List[STATEMENT], templates:List[Tuple[int, _Template]], first:int, period:int, repeats:int) -> _Run:
+        """The loop executing repetitions of templates, and the lines it saves"""
+        group = [t for _, t in templates[first:first + period * repeats]]
+        columns:List[Tuple[int, ...]] = list(zip(*[
+            [c for t in group[r * period:(r + 1) * period] for c in t.constants] for r in range(repeats)
+        ]))
+        steps = {b[1] - b[0] for b in columns if b[0] != b[1] and all(y - x == b[1] - b[0] for x, y in zip(b, b[1:]))}
+        arithmetic = [c for c in columns if all(y - x == c[1] - c[0] for x, y in zip(c, c[1:]))]
+        counter = self.counter
+        if len(steps) == 1 and len(arithmetic) == len(columns):
+            # The counter goes through the values of the first constant changing
+            step, = steps
+            base = next(c[0] for c in columns if c[0] != c[1])
+            loop = FOR(counter, base, base + step * (repeats - 1), step)
+        else:
+            step, base = 1, 0
+            loop = FOR(counter, 0, repeats - 1)
+
+        values:List[Any] = []
+        arrays:List[Tuple[int, ...]] = []
+        for column in columns:
+            if all(v == column[0] for v in column):
+                values.append(column[0])
+            elif column in arithmetic:
+                # column[i] = column[0] + i * change, with counter = base + i * step
+                scale = (column[1] - column[0]) // step
+                offset = column[0] - base * scale
+                value = counter if scale == 1 else counter * scale
+                if offset > 0:
+                    value = value + offset
+                elif offset < 0:
+                    value = value - (-offset)
+                values.append(value)
+            else:
+                if column not in arrays:
+                    arrays.append(column)
+                values.append(column)
+
+        start, stop = templates[first][0], templates[first + period * repeats - 1][0] + 1
+        before = sum(_size(s) for s in items[start:stop])
+        after = period + 2 + len(arrays) + (0 if self._declared else 1)
+        return _Run(start, stop, period * repeats, before - after, loop, group[:period], values, arrays)
+
+    def _roll(self, items:List[STATEMENT]) -> List[_Run]:
+        """Finds the repetitions worth rolling in a straight-line list of statements"""
+        templates = [(i, _Template.of(s)) for i, s in enumerate(items) if not isinstance(s, (COMMENT, EMPTY))]
+        runs:List[_Run] = []
+        i = 0
+        while i < len(templates):
+            best:Optional[_Run] = None
+            for period in range(1, self.max_period + 1):
+                keys = [t.key if t is not None else None for _, t in templates[i:i + period]]
+                if len(keys) < period or None in keys:
+                    break
+                repeats = 1
+                while all(
+                    i + repeats * period + j < len(templates) and templates[i + repeats * period + j][1] is not None
+                    and templates[i + repeats * period + j][1].key == keys[j] for j in range(period)
+                ):
+                    repeats += 1
+                if repeats < self.min_repeats:
+                    continue
+                run = self._plan(items, templates, i, period, repeats)
+                if run.saved > 0 and (best is None or run.saved > best.saved):
+                    best = run
+            if best is None:
+                i += 1
+                continue
+            runs.append(best)
+            self._declared = True
+            i += best.statements
+        return runs
+
+    def _write(self, run:_Run) -> FOR:
+        """Fills the loop of a run with its templates"""
+        arrays = {column: self._array(column) for column in run.arrays}
+        values = [arrays[v][self.counter] if isinstance(v, tuple) else v for v in run.values]
+        k = 0
+        for t in run.templates:
+            run.loop.body.append(t.build(values[k:k + len(t.constants)]))
+            k += len(t.constants)
+        return run.loop
+
+    def __call__(self, macro:Macro) -> RollingReport:
+        report = RollingReport()
+        probe = Macro("")
+        probe.process(*macro.statements)
+        self._names = {v.name for v in probe.variables}
+        self._declared = self.counter.name in self._names
+        inlined:Set[int] = set()
+        rolled:Set[int] = set()
+        for body in iter_bodies(macro.statements):
+            if id(body) in inlined or id(body) in rolled:
+                continue
+            nested:Set[int] = set()
+            items = [s for _, _, s in straight_line(body, nested)]
+            runs = self._roll(items)
+            if not runs:
+                continue
+            inlined.update(nested)
+            res:List[STATEMENT] = []
+            position = 0
+            for run in runs:
+                res.extend(items[position:run.start])
+                res.append(self._write(run))
+                position = run.stop
+                rolled.add(id(run.loop.body))
+                report.loops += 1
+                report.statements += run.statements
+                report.arrays += len(run.arrays)
+                report.lines += run.saved
+            res.extend(items[position:])
+            # The nested blocks are inlined into the list of statements
+            body[:] = res
+        return report
+
+
+def roll_loops(macro:Macro) -> RollingReport:
+    """Optimization pass rewriting statements repeated with different constants as `FOR` loops, see `LoopRoller`
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        RollingReport: The number of loops written, of statements they replace, of value arrays declared and of lines saved
+    """
+    return LoopRoller()(macro)
+
+
+roll_loops.hides_tags = True
@@ -0,0 +1,287 @@
+from __future__ import annotations
+import copy
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from eb_macro_gen.passes.loops import _ADDRESS, _MAX_DEPTH
+from eb_macro_gen.splitting import _written
+from eb_macro_gen.syntax import (
+    BEGIN_MACRO, BINARY, BREAK, C_END_SUB, C_FOR, C_SUB, CALL, CASE_CONTENT, COMMENT, CONTINUE, DISPATCH, EMPTY,
+    END_MACRO, LITERAL, RETURN, STATEMENT, SUB, SUB_BLOCK, SUB_CALL, VARIABLE_BLOCK, ASSIGNMENT, Macro, Parameter,
+    Variable, VariableItem, _size, iter_bodies, walk,
+)
+
+# Statements a sub function can't execute for the macro
+_UNFIT = (RETURN, BREAK, CONTINUE, VARIABLE_BLOCK, BEGIN_MACRO, END_MACRO, C_SUB, C_END_SUB)
+
+
+@dataclass
+class OutliningReport:
+    """What `outline_blocks` changed"""
+    subs:int = 0
+    calls:int = 0
+    lines:int = 0
+
+    def __str__(self) -> str:
+        return f"{self.calls} repeated blocks replaced by calls to {self.subs} sub functions, {self.lines} lines saved"
+
+
+def _shape(value:Any, holes:List[Any], written:Set[str], depth:int = 0) -> Any:
+    """The structure of a value, with the integer constants and the variables it only reads moved to `holes`"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        holes.append(int(value))
+        return '#'
+    if isinstance(value, Variable):
+        if value.name in written:
+            return ('var', value.name)
+        holes.append(value)
+        return ('$', value.dtype)
+    if isinstance(value, VariableItem):
+        return ('item', value.array.name, _shape(value.index, holes, written, depth + 1))
+    if isinstance(value, BINARY) and depth < _MAX_DEPTH:
+        return ('op', value.operator, _shape(value.left, holes, written, depth + 1), _shape(value.right, holes, written, depth + 1))
+    return ('text', str(value))
+
+
+def _fill(value:Any, args:Iterator[Any], written:Set[str], depth:int = 0) -> Any:
+    """Rebuilds a value with its holes replaced by `args`, in the order of `_shape`"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return next(args)
+    if isinstance(value, Variable):
+        return value if value.name in written else next(args)
+    if isinstance(value, VariableItem):
+        return value.array[_fill(value.index, args, written, depth + 1)]
+    if isinstance(value, BINARY) and depth < _MAX_DEPTH:
+        return BINARY(value.operator, _fill(value.left, args, written, depth + 1), _fill(value.right, args, written, depth + 1))
+    return value
+
+
+def _leaf_key(s:STATEMENT, holes:List[Any], written:Set[str]) -> Any:
+    """The structure of a statement written as-is, with its holes moved to `holes`"""
+    if isinstance(s, CALL):
+        params = []
+        for p in s.params:
+            address = _ADDRESS.match(p) if isinstance(p, str) else None
+            if address is not None:
+                holes.append(int(address.group(2)))
+                params.append(('address', address.group(1)))
+            else:
+                params.append(_shape(p, holes, written))
+        return ('call', s.funcName, id(s.sub) if isinstance(s, SUB_CALL) else None, tuple(params))
+    shapes:List[Any] = []
+    s.map_expressions(lambda v, _: shapes.append(_shape(v, holes, written)) or v)
+    if not shapes:
+        return (type(s).__name__, str(s))
+    if isinstance(s, ASSIGNMENT):
+        fixed = str(s.var)
+    elif isinstance(s, C_FOR):
+        fixed = (str(s.counter), s.step)
+    else:
+        fixed = None
+    return (type(s).__name__, fixed, tuple(shapes))
+
+
+def _fill_leaf(s:STATEMENT, args:Iterator[Any], written:Set[str]):
+    """Replaces the holes of a statement written as-is by `args`, in the order of `_leaf_key`"""
+    if isinstance(s, CALL):
+        params = []
+        for p in s.params:
+            address = _ADDRESS.match(p) if isinstance(p, str) else None
+            if address is None:
+                params.append(_fill(p, args, written))
+                continue
+            v = next(args)
+            if isinstance(v, int):
+                params.append(p if v == int(address.group(2)) else f"{address.group(1)}, {v}")
+            else:
+                # The address is computed like the one of an `INDIRECT_TAG`
+                params.extend((LITERAL(address.group(1)), v))
+        s.params = params
+        return
+    s.map_expressions(lambda v, _: _fill(v, args, written))
+
+
+class _Occurrence:
+    """A statement containing other statements, with its holes taken out"""
+    def __init__(self, body:List[STATEMENT], statement:STATEMENT):
+        self.body = body
+        self.statement = statement
+        self.holes:List[Any] = []
+        self.written = _written([statement])
+        keys = []
+        for s, content in walk(statement):
+            if content is not None or isinstance(s, (COMMENT, EMPTY)):
+                continue
+            if isinstance(s, _UNFIT):
+                self.key = None
+                return
+            keys.append(_leaf_key(s, self.holes, self.written))
+        self.key = tuple(keys) if keys else None
+
+
+@dataclass
+class _Group:
+    """Occurrences of the same structure, and the sub function executing them"""
+    occurrences:List[_Occurrence]
+    saved:int
+    body:STATEMENT
+    params:List[Parameter]
+    values:List[Tuple[Any, ...]]
+
+
+def _candidates(statements:List[STATEMENT]) -> Iterator[Tuple[List[STATEMENT], STATEMENT]]:
+    """Iterates over the statements containing other statements, with the list holding them, parents first
+
+    Only the statements held by a list the passes can edit are yielded, a list built by `STATEMENT.expand`
+    when it is called can't be.
+    """
+    stack:List[Tuple[List[STATEMENT], bool]] = [(statements, True)]
+    while stack:
+        body, owned = stack.pop()
+        for s in reversed(body):
+            if isinstance(s, (SUB_BLOCK, SUB)):
+                continue
+            bodies = s.bodies()
+            if not bodies:
+                continue
+            again = s.bodies()
+            stack.extend((b, b is c) for b, c in zip(reversed(bodies), reversed(again)))
+        if not owned:
+            continue
+        for s in body:
+            if not isinstance(s, (SUB_BLOCK, SUB, DISPATCH, CASE_CONTENT)) and s.bodies():
+                yield body, s
+
+
+class Outliner:
+    """Optimization pass moving repeated blocks of statements into `SUB` functions
+
+    Statements containing other statements (blocks, conditions, loops, the blocks of tasks or shapes...) with the
+    same structure are executed by a single sub function. The integer constants, the tag addresses and the variables
+    only read that differ between the repetitions become the parameters of the function, and each repetition becomes
+    a call, and the comments of the function are dropped. Blocks using `RETURN`, `BREAK` or `CONTINUE` stay where they are, since they act on the macro or on a loop.
+
+    A function is only written when it makes the macro shorter by more than `call_cost` lines per call. Each call
+    adds an instruction at runtime, raise `call_cost` to keep the statements inline unless outlining saves more.
+    Defining sub functions makes the variables of the macro global, see `SUB`.
+    """
+    # Outlined tag accesses take their address from the parameters, see `Macro.optimize`
+    hides_tags = True
+    def __init__(self, call_cost:int = 0, name:str = "p_sub"):
+        """Optimization pass moving repeated blocks of statements into `SUB` functions
+
+        Args:
+            call_cost (int, optional): The lines each call must save on top of its own line. Defaults to 0, outlining whenever the macro gets shorter.
+            name (str, optional): The prefix of the names of the functions. Defaults to "p_sub".
+        """
+        self.call_cost = call_cost
+        self.name = name
+
+    def _plan(self, macro:Macro, occurrences:List[_Occurrence]) -> Optional[_Group]:
+        """The sub function executing occurrences of the same structure, None if it isn't worth it"""
+        # An occurrence nested in another one is executed by the call replacing the outer one
+        kept:List[_Occurrence] = []
+        inside:Set[int] = set()
+        for o in occurrences:
+            if id(o.statement) in inside:
+                continue
+            kept.append(o)
+            inside.update(id(s) for s, _ in walk(o.statement))
+        if len(kept) < 2:
+            return None
+
+        args:List[Any] = []
+        params:List[Parameter] = []
+        values:List[Tuple[Any, ...]] = []
+        keys:List[Tuple[Any, ...]] = []
+        for column in zip(*[o.holes for o in kept]):
+            names = tuple(v.name if isinstance(v, Variable) else v for v in column)
+            if all(n == names[0] for n in names):
+                args.append(column[0])
+                continue
+            # Holes always holding the same values share a parameter
+            if names not in keys:
+                keys.append(names)
+                values.append(column)
+                if isinstance(column[0], Variable):
+                    dtype = column[0].dtype
+                else:
+                    dtype = 'short' if all(-32768 <= v <= 32767 for v in column) else 'int'
+                params.append(Parameter(f"p_arg{len(params)}", dtype))
+            args.append(params[keys.index(names)])
+
+        before = sum(_size(o.statement) for o in kept)
+        # The calls, the header and footer of the definition and the empty line after it
+        extra = len(kept) + 3 + (0 if macro.subs else 1)
+        # The body has at least one line per statement written as-is, no need to copy it when that's already too many
+        if before - extra - len(kept[0].key) <= self.call_cost * len(kept):
+            return None
+        body = self._body(kept[0], args)
+        saved = before - extra - _size(body)
+        if saved <= self.call_cost * len(kept):
+            return None
+        return _Group(kept, saved, body, params, values)
+
+    @staticmethod
+    def _body(first:_Occurrence, args:List[Any]) -> STATEMENT:
+        """The body of the sub function, a copy of the first occurrence with the parameters in its holes"""
+        # The statements of the occurrence may still be used elsewhere, the copy shares its variables and tags
+        body = copy.deepcopy(first.statement)
+        filling = iter(args)
+        for s, content in walk(body):
+            if content is None and not isinstance(s, (COMMENT, EMPTY)):
+                _fill_leaf(s, filling, first.written)
+        # The comments describe the first occurrence only
+        for statements in iter_bodies([body]):
+            statements[:] = [s for s in statements if not isinstance(s, COMMENT)]
+        return body
+
+    def _write(self, macro:Macro, group:_Group) -> SUB:
+        """Writes a new sub function from the body planned for a group, and replaces each occurrence by a call"""
+        names = {s.name for s in macro.subs}
+        k = 0
+        while f"{self.name}{k}" in names:
+            k += 1
+        sub = SUB(f"{self.name}{k}", *group.params)(group.body)
+        for k, o in enumerate(group.occurrences):
+            index = next(i for i, s in enumerate(o.body) if s is o.statement)
+            o.body[index] = sub.call(*[column[k] for column in group.values])
+        macro.define(sub)
+        return sub
+
+    def __call__(self, macro:Macro) -> OutliningReport:
+        report = OutliningReport()
+        while True:
+            groups:Dict[Any, List[_Occurrence]] = {}
+            for body, s in _candidates(macro.statements):
+                o = _Occurrence(body, s)
+                if o.key is not None:
+                    groups.setdefault(o.key, []).append(o)
+            best:Optional[_Group] = None
+            for occurrences in groups.values():
+                if len(occurrences) < 2:
+                    continue
+                group = self._plan(macro, occurrences)
+                if group is not None and (best is None or group.saved > best.saved):
+                    best = group
+            if best is None:
+                return report
+            self._write(macro, best)
+            report.subs += 1
+            report.calls += len(best.occurrences)
+            report.lines += best.saved
+
+
+def outline_blocks(macro:Macro) -> OutliningReport:
+    """Optimization pass moving blocks of statements repeated with different values into `SUB` functions, see `Outliner`
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        OutliningReport: The number of functions defined, of calls replacing the blocks and of lines saved
+    """
+    return Outliner()(macro)
+
+
+outline_blocks.hides_tags = True
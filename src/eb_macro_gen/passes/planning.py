@@ -0,0 +1,249 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Set, Tuple
+
+from eb_macro_gen.objects import TAG_READ, TAG_WRITE, Tag
+from eb_macro_gen.passes.coalescing import Access, ScratchArrays, access_of
+from eb_macro_gen.syntax import (
+    BLOCK, CALL, COMMENT, EMPTY, STATEMENT, Macro, _sub_calls, iter_bodies, repeated_bodies, walk,
+)
+
+# The calls after which a tag may no longer hold the value it had when the macro started: the macro waits, runs
+# another macro, or accesses a device without a tag
+BARRIERS = ('DELAY', 'SYNC_TRIG_MACRO', 'GetData', 'GetDataEx', 'SetData', 'SetDataEx')
+
+
+@dataclass
+class ReadBlock:
+    """A bulk `GetData` of the read plan"""
+    device:str
+    register:str
+    address:int
+    count:int
+    dtype:str
+    used:int
+
+    @property
+    def unused(self) -> int:
+        """The number of elements read only to fill the gaps"""
+        return self.count - self.used
+
+
+@dataclass
+class ReadPlan:
+    """The cost report of `plan_reads` for a macro"""
+    macro:str
+    reads:int = 0
+    blocks:List[ReadBlock] = field(default_factory=list)
+
+    @property
+    def requests(self) -> int:
+        """The number of device requests the planned reads make"""
+        return len(self.blocks)
+
+    @property
+    def saved(self) -> int:
+        """The number of device round trips saved per execution"""
+        return self.reads - self.requests
+
+    @property
+    def unused(self) -> int:
+        """The number of elements read only to fill the gaps"""
+        return sum(b.unused for b in self.blocks)
+
+    def __str__(self) -> str:
+        lines = [f"{self.macro}: {self.reads} reads planned into {self.requests} requests, {self.saved} round trips saved, {self.unused} unused elements read"]
+        for b in self.blocks:
+            lines.append(f"    {b.device} {b.register} {b.address} x{b.count} ({b.dtype}, {b.unused} unused)")
+        return '\n'.join(lines)
+
+
+def insert_prologue(macro:Macro, *statements:STATEMENT):
+    """Inserts statements at the start of the body of a macro, after the variable declarations"""
+    index = 0
+    for i, s in enumerate(macro.statements):
+        if s is macro._variable_block:
+            index = i + 1
+            if index < len(macro.statements) and isinstance(macro.statements[index], EMPTY):
+                index += 1
+            break
+    macro.statements.insert(index, BLOCK(*statements, EMPTY()))
+
+
+def _written(macro:Macro) -> Tuple[Set[Tuple[str, str, int]], Set[Tuple[str, str]], Set[str]]:
+    """What the macro may write to
+
+    Returns:
+        Tuple[Set[Tuple[str, str, int]], Set[Tuple[str, str]], Set[str]]: The written addresses, the registers written
+        at an unknown address or count, and the devices written to through untyped calls
+    """
+    addresses:Set[Tuple[str, str, int]] = set()
+    registers:Set[Tuple[str, str]] = set()
+    devices:Set[str] = set()
+    for body in iter_bodies(macro.statements):
+        for s in body:
+            if isinstance(s, TAG_WRITE):
+                tag = s.tag
+                register = tag.address_register.strip()
+                count = s.count
+                if tag.address_num is None or not isinstance(count, int):
+                    registers.add((tag.device_name, register))
+                    continue
+                # Elements are at most 2 registers wide
+                for a in range(tag.address_num, tag.address_num + 2 * count):
+                    addresses.add((tag.device_name, register, a))
+            elif isinstance(s, CALL) and s.funcName in ('SetData', 'SetDataEx'):
+                devices.add(s.params[1])
+    return addresses, registers, devices
+
+
+def _is_barrier(statement:STATEMENT) -> bool:
+    """Whether a statement written as-is is one of the `BARRIERS`"""
+    return isinstance(statement, CALL) and not isinstance(statement, (TAG_READ, TAG_WRITE)) and statement.funcName in BARRIERS
+
+
+def _settled_reads(macro:Macro) -> Set[int]:
+    """The tag reads made before anything the macro does may change the tags, see `BARRIERS`
+
+    The statements are looked at in output order, up to the first barrier or the first call of a sub function
+    containing one. The reads of the sub functions are only settled when the macro has no barrier at all.
+
+    Returns:
+        Set[int]: The ids of the settled `TAG_READ` statements
+    """
+    # The sub functions come after the ones they call
+    unsettled:Set[int] = set()
+    for sub in macro.subs:
+        for s, content in walk(*sub.body):
+            if content is None and (_is_barrier(s) or any(id(c) in unsettled for c in _sub_calls(s))):
+                unsettled.add(id(sub))
+                break
+    reads:Set[int] = set()
+    for s, content in walk(*[s for s in macro.statements if s is not macro._sub_block]):
+        if content is not None:
+            continue
+        if _is_barrier(s) or any(id(c) in unsettled for c in _sub_calls(s)):
+            return reads
+        if isinstance(s, TAG_READ):
+            reads.add(id(s))
+    for sub in macro.subs:
+        reads.update(id(s) for s, content in walk(*sub.body) if isinstance(s, TAG_READ))
+    return reads
+
+
+class ReadPlanner:
+    """Optimization pass reading every tag of a macro once, in as few device requests as possible
+
+    All the tag reads of the macro are grouped by device, register and variable type, and covered by
+    bulk `GetData` calls into scratch arrays, in a prologue at the start of the macro. A gap of unused
+    addresses between two read addresses is read as well when it is small enough, since one larger request
+    costs less than two round trips. Each original read becomes an assignment from the scratch array.
+
+    Tags the macro writes to are left alone, their reads must see the written values. So are the reads in a loop,
+    which may be waiting for a tag to change, the reads after a `DELAY`, a `SYNC_TRIG_MACRO` or a plain
+    `GetData`/`SetData` call (see `BARRIERS`), and the reads of volatile tags.
+    """
+    # Looks at the tags, see `Macro.optimize`
+    reads_tags = True
+    def __init__(self, max_block:int = 64, max_gap:int = 2, volatile:Iterable[Tag] = ()):
+        """Optimization pass reading every tag of a macro once, in as few device requests as possible
+
+        Args:
+            max_block (int, optional): The maximum number of elements of a single request. Defaults to 64.
+            max_gap (int, optional): The maximum number of unused elements read between two read addresses. Defaults to 2.
+            volatile (Iterable[Tag], optional): Tags that must be read where they are, in addition to the tags
+                created with `volatile=True`. Defaults to ().
+        """
+        self.max_block = max_block
+        self.max_gap = max_gap
+        self.volatile = {(tag.device_name, tag.address_register.strip(), tag.address_num) for tag in volatile}
+
+    def _eligible(self, macro:Macro) -> List[Access]:
+        addresses, registers, devices = _written(macro)
+        accesses:List[Access] = []
+        repeated = repeated_bodies(macro.statements)
+        settled = _settled_reads(macro)
+        for body in iter_bodies(macro.statements):
+            if id(body) in repeated:
+                continue
+            for i, s in enumerate(body):
+                if not isinstance(s, TAG_READ) or id(s) not in settled or s.tag.volatile:
+                    continue
+                a = access_of(s, s.result, s.tag, s.count, body, i)
+                if a is None or s.params[1] in devices or (a.device, a.register) in registers:
+                    continue
+                if (a.device, a.register, a.address) in self.volatile:
+                    continue
+                if any((a.device, a.register, a.address + k) in addresses for k in range(a.width)):
+                    continue
+                accesses.append(a)
+        return accesses
+
+    def blocks(self, accesses:List[Access]) -> List[List[Access]]:
+        """Splits accesses into the fewest blocks respecting the maximum block size and gap
+
+        Accesses are grouped by device, register and variable type, then sorted by address. Going up the
+        addresses, a block is extended as long as it stays within the limits, which gives the fewest blocks.
+
+        Args:
+            accesses (List[Access]): The accesses to plan
+
+        Returns:
+            List[List[Access]]: The accesses of each block, sorted by address
+        """
+        groups:Dict[Tuple[str, str, str], List[Access]] = {}
+        for a in accesses:
+            groups.setdefault(a.key, []).append(a)
+        res:List[List[Access]] = []
+        for group in groups.values():
+            group.sort(key=lambda a: a.address)
+            block = [group[0]]
+            for a in group[1:]:
+                first, last = block[0], block[-1]
+                width = first.width
+                offset = a.address - first.address
+                gap = (a.address - last.address) // width - 1
+                if offset % width == 0 and offset // width < self.max_block and gap <= self.max_gap:
+                    block.append(a)
+                    continue
+                res.append(block)
+                block = [a]
+            res.append(block)
+        return res
+
+    def __call__(self, macro:Macro) -> ReadPlan:
+        report = ReadPlan(macro.name)
+        scratch = ScratchArrays("p_plan", macro)
+        offsets:Dict[str, int] = {}
+        prologue = [COMMENT("Read plan")]
+        for block in self.blocks(self._eligible(macro)):
+            first = block[0]
+            count = (block[-1].address - first.address) // first.width + 1
+            offset = offsets.get(first.dtype, 0)
+            offsets[first.dtype] = offset + count
+            array = scratch.get(first.dtype, offset + count)
+            tag = Tag(f"{first.register}_{first.address}_{block[-1].address}", first.device, f"{first.register}, {first.address}", first.statement.tag.dtype)
+            prologue.append(tag.read(array[offset], count))
+            for a in block:
+                a.body[a.index] = a.var.set(array[offset + (a.address - first.address) // first.width])
+            used = len({a.address for a in block})
+            report.blocks.append(ReadBlock(first.device, first.register, first.address, count, first.dtype, used))
+            report.reads += len(block)
+        if report.blocks:
+            insert_prologue(macro, *prologue)
+        return report
+
+
+def plan_reads(macro:Macro) -> ReadPlan:
+    """Optimization pass reading every tag of a macro in a prologue, with the default limits of `ReadPlanner`
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        ReadPlan: The planned requests and what they cost
+    """
+    return ReadPlanner()(macro)
+
+
+plan_reads.reads_tags = True
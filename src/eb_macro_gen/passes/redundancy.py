@@ -0,0 +1,116 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+
+from eb_macro_gen.passes.coalescing import _dtype, is_pure, straight_line
+from eb_macro_gen.syntax import (
+    ASSIGNMENT, CALL, COMMENT, EMPTY, STATEMENT, AnyVariable, Macro, Variable, VariableItem, iter_bodies,
+)
+
+
+@dataclass
+class RedundantReadReport:
+    """What `eliminate_redundant_reads` changed"""
+    removed:int = 0
+    reused:int = 0
+
+    @property
+    def eliminated(self) -> int:
+        """The number of device reads eliminated per execution"""
+        return self.removed + self.reused
+
+    def __str__(self) -> str:
+        return f"{self.eliminated} redundant reads eliminated ({self.removed} removed, {self.reused} replaced by an assignment)"
+
+
+def _root(var:AnyVariable) -> Optional[str]:
+    """The name of the variable or array written through a variable"""
+    if isinstance(var, Variable):
+        return var.name
+    if isinstance(var, VariableItem):
+        return var.array.name
+    return None
+
+
+def _tracked(var:AnyVariable) -> bool:
+    """Whether a variable always designates the same storage"""
+    return isinstance(var, Variable) or (isinstance(var, VariableItem) and isinstance(var.index, int))
+
+
+class _KnownReads:
+    """The variables holding the last value read from each address in a straight-line list of statements"""
+    def __init__(self):
+        self.values:Dict[Tuple[str, str], AnyVariable] = {}
+
+    def forget_var(self, root:Optional[str]):
+        self.values = {k: v for k, v in self.values.items() if _root(v) != root}
+
+    def forget_device(self, device:str):
+        self.values = {k: v for k, v in self.values.items() if k[0] != device}
+
+    def clear(self):
+        self.values.clear()
+
+
+def _read_key(s:CALL) -> Optional[Tuple[str, str]]:
+    """The device and address of a single element `GetData`, None for other calls"""
+    if s.funcName not in ('GetData', 'GetDataEx') or len(s.params) != 4 or s.params[3] != 1:
+        return None
+    return (str(s.params[1]), str(s.params[2]).replace(' ', ''))
+
+
+def eliminate_redundant_reads(macro:Macro) -> RedundantReadReport:
+    """Optimization pass removing the `GetData` of an address whose value was already read
+
+    In each straight-line list of statements (going through nested `BLOCK`s), a read of the same device and address
+    as an earlier read is redundant as long as nothing was written to the device, the variable holding the earlier
+    value wasn't assigned, and no other function was called in between. A redundant read into the same variable is
+    removed, a redundant read into another variable of the same type becomes an assignment from the earlier one.
+
+    Any other statement, a condition for example, ends the straight-line list.
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        RedundantReadReport: The number of removed and replaced reads
+    """
+    report = RedundantReadReport()
+    inlined:Set[int] = set()
+    for body in iter_bodies(macro.statements):
+        if id(body) in inlined:
+            continue
+        known = _KnownReads()
+        removed:List[Tuple[List[STATEMENT], int]] = []
+        for current, i, s in straight_line(body, inlined):
+            if isinstance(s, (COMMENT, EMPTY)):
+                continue
+            if isinstance(s, ASSIGNMENT) and is_pure(s.var) and is_pure(s.value):
+                known.forget_var(_root(s.var))
+                continue
+            if not isinstance(s, CALL):
+                known.clear()
+                continue
+            if s.funcName in ('SetData', 'SetDataEx'):
+                known.forget_device(str(s.params[1]))
+                continue
+            key = _read_key(s)
+            if key is None:
+                known.clear()
+                continue
+            var = s.params[0]
+            previous = known.values.get(key)
+            if previous is not None and str(previous) == str(var):
+                removed.append((current, i))
+                report.removed += 1
+                continue
+            known.forget_var(_root(var))
+            if previous is not None and _dtype(previous) == _dtype(var) and _dtype(var) is not None:
+                current[i] = var.set(previous)
+                report.reused += 1
+                continue
+            if _tracked(var):
+                known.values[key] = var
+        for current, i in reversed(removed):
+            del current[i]
+    return report
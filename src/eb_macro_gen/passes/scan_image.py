@@ -0,0 +1,152 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from eb_macro_gen.objects import TAG_READ, TAG_WRITE, Tag
+from eb_macro_gen.passes.coalescing import _dtype
+from eb_macro_gen.passes.planning import insert_prologue
+from eb_macro_gen.syntax import (
+    BLOCK, CALL, COMMENT, END_MACRO, IF, RETURN, STATEMENT, Macro, Variable, iter_bodies, repeated_bodies,
+)
+
+
+@dataclass
+class ScanImageReport:
+    """What `ScanImage` changed"""
+    inputs:int = 0
+    outputs:int = 0
+    reads:int = 0
+    writes:int = 0
+
+    def __str__(self) -> str:
+        return (f"{self.inputs} tags read once for {self.reads} reads, "
+                f"{self.outputs} tags written once at most for {self.writes} writes")
+
+
+class _ImageTag:
+    """The accesses of a tag and its variables in the image"""
+    def __init__(self, tag:Tag):
+        self.tag = tag
+        self.reads:List[Tuple[List[STATEMENT], int, TAG_READ]] = []
+        self.writes:List[Tuple[List[STATEMENT], int, TAG_WRITE]] = []
+        self.dtypes:Set[Optional[str]] = set()
+        self.devices:Set[str] = set()
+        self.single = True
+        self.looped = False
+
+
+def _key(tag:Tag) -> Optional[Tuple[str, str, int]]:
+    address = tag.address_num
+    if address is None:
+        return None
+    return (tag.device_name, tag.address_register.strip(), address)
+
+
+class ScanImage:
+    """Optimization pass giving a macro the scan cycle of a PLC
+
+    Every tag the macro reads is read once at the start of the macro into an image variable, and every read
+    becomes a use of that variable. Writes update the image variable and mark it dirty, and the dirty tags
+    are written once at the end of the macro. Reads see the values written earlier by the macro, like they
+    would on the device.
+
+    Volatile tags, tags read or written more than one element at a time, tags accessed in a loop (which may be
+    waiting for them to change) and tags of devices accessed through plain `GetData`/`SetData` calls keep their accesses. When the macro can `return` early, the
+    tags it writes keep their accesses as well, so the writes can't be skipped.
+    """
+    # Looks at the tags, see `Macro.optimize`
+    reads_tags = True
+    def __init__(self, volatile:Iterable[Tag] = ()):
+        """Optimization pass giving a macro the scan cycle of a PLC
+
+        Args:
+            volatile (Iterable[Tag], optional): Tags whose reads and writes must reach the device where they are,
+                in addition to the tags created with `volatile=True`. Defaults to ().
+        """
+        self.volatile = {_key(tag) for tag in volatile}
+
+    def _collect(self, macro:Macro) -> Tuple[Dict[Tuple[str, str, int], _ImageTag], Set[str], bool]:
+        tags:Dict[Tuple[str, str, int], _ImageTag] = {}
+        devices:Set[str] = set()
+        returns = False
+        repeated = repeated_bodies(macro.statements)
+        for body in iter_bodies(macro.statements):
+            for i, s in enumerate(body):
+                if isinstance(s, RETURN):
+                    returns = True
+                    continue
+                if not isinstance(s, (TAG_READ, TAG_WRITE)):
+                    if isinstance(s, CALL) and s.funcName in ('GetData', 'GetDataEx', 'SetData', 'SetDataEx'):
+                        devices.add(s.params[1])
+                    continue
+                key = _key(s.tag)
+                if key is None:
+                    continue
+                image = tags.get(key)
+                if image is None:
+                    image = tags[key] = _ImageTag(s.tag)
+                (image.reads if isinstance(s, TAG_READ) else image.writes).append((body, i, s))
+                image.dtypes.add(_dtype(s.params[0]))
+                image.devices.add(s.params[1])
+                image.single = image.single and s.count == 1
+                image.looped = image.looped or id(body) in repeated
+        return tags, devices, returns
+
+    def __call__(self, macro:Macro) -> ScanImageReport:
+        report = ScanImageReport()
+        tags, devices, returns = self._collect(macro)
+        prologue:List[STATEMENT] = [COMMENT("Input image")]
+        flush:List[STATEMENT] = [COMMENT("Output image")]
+        names:Set[str] = set()
+        for key, image in tags.items():
+            tag = image.tag
+            if tag.volatile or key in self.volatile or not image.single or image.looped or image.devices & devices:
+                continue
+            if len(image.dtypes) != 1 or None in image.dtypes or (returns and image.writes):
+                continue
+            dtype, = image.dtypes
+            name = f"p_image_{tag.name}"
+            while name in names:
+                name += "_"
+            names.add(name)
+            var = Variable(name, dtype)
+            if image.reads:
+                prologue.append(tag.read(var))
+                report.inputs += 1
+                report.reads += len(image.reads)
+                for body, i, s in image.reads:
+                    body[i] = s.params[0].set(var)
+            if image.writes:
+                dirty = Variable(f"{name}_dirty", 'bool', False)
+                flush.append(IF(dirty)(tag.write(var)))
+                report.outputs += 1
+                report.writes += len(image.writes)
+                for body, i, s in image.writes:
+                    body[i] = BLOCK(var.set(s.params[0]), dirty.set(True))
+        if report.inputs:
+            insert_prologue(macro, *prologue)
+        if report.outputs:
+            index = len(macro.statements)
+            for i, s in enumerate(macro.statements):
+                if isinstance(s, END_MACRO):
+                    index = i
+                    break
+            macro.statements.insert(index, BLOCK(*flush))
+        return report
+
+
+def scan_image(macro:Macro) -> ScanImageReport:
+    """Optimization pass reading the tags of a macro once at its start and writing them once at its end
+
+    See `ScanImage`, this pass only keeps the tags created with `volatile=True` live.
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        ScanImageReport: The number of image tags and of accesses they replaced
+    """
+    return ScanImage()(macro)
+
+
+scan_image.reads_tags = True
@@ -0,0 +1,171 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from eb_macro_gen.syntax import (
+    ASSIGNMENT, C_FOR, C_NEXT, C_WEND, C_WHILE, CALL, CASE_CONTENT, CONDITION_BLOCK, LOOP, STATEMENT, Macro,
+    Temporary, Variable, walk,
+)
+
+
+@dataclass
+class AllocationReport:
+    """What `allocate_temporaries` changed"""
+    temporaries:int = 0
+    slots:int = 0
+
+    @property
+    def saved(self) -> int:
+        """The number of variables no longer declared"""
+        return self.temporaries - self.slots
+
+    def __str__(self) -> str:
+        return f"{self.temporaries} temporaries packed into {self.slots} slots, {self.saved} variables saved"
+
+
+@dataclass
+class _Lifetime:
+    """Where a temporary is assigned and last used"""
+    dtype:str
+    start:int
+    end:int
+    path:Tuple[int, ...]
+    shared:bool = True
+
+
+def _leaves(statements:List[STATEMENT]) -> Iterator[Tuple[STATEMENT, Tuple[int, ...]]]:
+    """Iterates over the statements written as-is, with the conditional bodies holding each of them
+
+    Args:
+        statements (List[STATEMENT]): The statements
+
+    Yields:
+        Tuple[STATEMENT, Tuple[int, ...]]: Each statement, and the ids of the conditional bodies it is in, outermost first
+    """
+    stack = [(iter(statements), ())]
+    while stack:
+        items, path = stack[-1]
+        for s in items:
+            if isinstance(s, LOOP):
+                # The body of a loop may not run at all
+                segments = [([s.header], path), (s.body, path + (id(s.body),)), ([s.footer], path)]
+                stack.extend((iter(body), p) for body, p in reversed(segments))
+                break
+            if isinstance(s, CONDITION_BLOCK):
+                # The conditions after the first one are only evaluated when the previous ones are false
+                segments = []
+                for i, arm in enumerate(s.arms):
+                    segments.append(([arm.header], path if i == 0 else path + (id(arm),)))
+                    segments.append((arm.body, path + (id(arm.body),)))
+                stack.extend((iter(body), p) for body, p in reversed(segments))
+                break
+            content = s.expand()
+            if content is None:
+                yield s, path
+                continue
+            stack.append((iter(content), path + (id(s),) if isinstance(s, CASE_CONTENT) else path))
+            break
+        else:
+            stack.pop()
+
+
+class _References:
+    """Finds the temporaries a statement uses, the way the macro finds the variables to declare"""
+    def __init__(self):
+        self.probe = Macro("")
+
+    def __call__(self, *values) -> Dict[str, Temporary]:
+        self.probe.variables = set()
+        self.probe._processed.clear()
+        self.probe.process(*values)
+        return {v.name: v for v in self.probe.variables if isinstance(v, Temporary)}
+
+
+def _assigned(s:STATEMENT, references:_References) -> Optional[Temporary]:
+    """The temporary a statement assigns without using its previous value, None if there is none"""
+    if isinstance(s, ASSIGNMENT) and isinstance(s.var, Temporary):
+        return s.var if s.var.name not in references(s.value) else None
+    if isinstance(s, C_FOR) and isinstance(s.counter, Temporary):
+        return s.counter if s.counter.name not in references(s.start, s.end) else None
+    if isinstance(s, CALL) and s.funcName in ('GetData', 'GetDataEx') and isinstance(s.params[0], Temporary):
+        if len(s.params) > 3 and s.params[3] == 1 and s.params[0].name not in references(*s.params[1:]):
+            return s.params[0]
+    return None
+
+
+def allocate_temporaries(macro:Macro) -> AllocationReport:
+    """Optimization pass giving the temporaries whose lifetimes don't overlap the same variable
+
+    The lifetime of a temporary goes from the statement assigning it to the last statement using it. A temporary
+    is only shared when it is assigned before any use, outside of the conditions its uses are in, since the previous
+    value of its slot is whatever another temporary left. Temporaries of the same type whose lifetimes don't overlap
+    then share a slot, going through them in the order they are assigned. A temporary live when a loop starts stays
+    live until the loop ends, since the next iterations may use it again. The temporaries of the sub functions keep
+    their own variable, they are used wherever the functions are called.
+
+    Temporaries with the same name are the same variable of the macro. The slots are declared instead of the
+    temporaries they hold while the macro is built.
+
+    Args:
+        macro (Macro): The macro to optimize
+
+    Returns:
+        AllocationReport: The number of temporaries shared and of slots holding them
+    """
+    references = _References()
+    lifetimes:Dict[str, _Lifetime] = {}
+    temporaries:Dict[str, List[Temporary]] = {}
+    loops:List[Tuple[int, int]] = []
+    starts:List[int] = []
+    for position, (s, path) in enumerate(_leaves(macro.statements)):
+        if isinstance(s, (C_WHILE, C_FOR)):
+            starts.append(position)
+        elif isinstance(s, (C_WEND, C_NEXT)) and starts:
+            loops.append((starts.pop(), position))
+        assigned = _assigned(s, references)
+        for name, temporary in references(s).items():
+            known = temporaries.setdefault(name, [])
+            if not any(t is temporary for t in known):
+                known.append(temporary)
+            lifetime = lifetimes.get(name)
+            if lifetime is None:
+                lifetime = lifetimes[name] = _Lifetime(temporary.dtype, position, position, path, assigned is temporary)
+            lifetime.end = position
+            if path[:len(lifetime.path)] != lifetime.path:
+                lifetime.shared = False
+    for sub in macro.subs:
+        for s, content in walk(*sub.body):
+            if content is None:
+                for name in references(s):
+                    if name in lifetimes:
+                        lifetimes[name].shared = False
+    # Inner loops end first, a lifetime extended to the end of a loop may then cover an outer one
+    for start, end in sorted(loops, key=lambda l: l[1]):
+        for lifetime in lifetimes.values():
+            if lifetime.start < start <= lifetime.end < end:
+                lifetime.end = end
+
+    report = AllocationReport()
+    slots:Dict[str, List[Tuple[int, List[str]]]] = {}
+    for name, lifetime in sorted(lifetimes.items(), key=lambda l: l[1].start):
+        if not lifetime.shared:
+            continue
+        report.temporaries += 1
+        candidates = slots.setdefault(lifetime.dtype, [])
+        for i, (end, names) in enumerate(candidates):
+            if end < lifetime.start:
+                candidates[i] = (lifetime.end, names + [name])
+                break
+        else:
+            candidates.append((lifetime.end, [name]))
+            report.slots += 1
+
+    macro.temporaries = []
+    for dtype, candidates in slots.items():
+        # A temporary alone in its slot keeps its name
+        shared = [names for _, names in candidates if len(names) > 1]
+        for k, names in enumerate(shared):
+            slot = Variable(f"p_temp_{dtype.replace(' ', '_')}{k}", dtype)
+            for name in names:
+                macro.temporaries.extend((t, slot) for t in temporaries[name])
+    return report
@@ -0,0 +1,277 @@
+from __future__ import annotations
+from collections import deque
+import math
+from typing import Dict, List, Optional, Set, Tuple
+
+from .instructions import REGISTER_WIDTHS, SYNC_TRIG_MACRO
+from .objects import DataType, Tag
+from .syntax import (
+    ASSIGNMENT, BLOCK, C_FOR, CALL, COMMENT, CONDITION_ARM, DISPATCH, EMPTY, END_MACRO, STATEMENT, Macro, Variable,
+    VariableArray, VariableItem, _size, binary_dispatch, called_subs, walk,
+)
+
+# The first LW register passing the state between the parts of a split macro
+SPLIT_STATE_ADDRESS = 9000
+
+# The registers passing the state of each split macro, by name: the device, the first register and the one after the last
+_STATE_REGISTERS:Dict[str, Tuple[str, int, int]] = {}
+
+# The number of times the parts are packed again when the declarations make one of them too large
+_ATTEMPTS = 8
+
+
+def _root(var) -> Optional[str]:
+    if isinstance(var, Variable):
+        return var.name
+    if isinstance(var, VariableItem):
+        return var.array.name
+    return None
+
+
+def _free_state_address(name:str, device:str) -> int:
+    """The first register of a macro split without a state address, after the registers of the other split macros"""
+    ends = [end for other, (d, _, end) in _STATE_REGISTERS.items() if other != name and d == device]
+    return max(ends, default=SPLIT_STATE_ADDRESS)
+
+
+def _reserve(name:str, device:str, start:int, end:int):
+    """Reserves the registers passing the state of a split macro, replacing the ones it had
+
+    Raises:
+        ValueError: When another split macro uses some of these registers
+    """
+    for other, (d, first, after) in _STATE_REGISTERS.items():
+        if other != name and d == device and start < after and first < end:
+            raise ValueError(
+                f"The state of {name} (LW {start} to {end - 1}) overlaps the state of {other} "
+                f"(LW {first} to {after - 1}), give it another state_address"
+            )
+    if start < end:
+        _STATE_REGISTERS[name] = (device, start, end)
+    else:
+        _STATE_REGISTERS.pop(name, None)
+
+
+def _written(statements:List[STATEMENT]) -> Set[str]:
+    """The variables statements may write to: assignment targets, loop counters and every variable given to a function,
+    including the ones written by the sub functions called
+    """
+    names:Set[str] = set()
+    for s, content in walk(*statements, *called_subs(*statements)):
+        if content is not None:
+            continue
+        if isinstance(s, ASSIGNMENT):
+            names.add(_root(s.var))
+        elif isinstance(s, C_FOR):
+            names.add(_root(s.counter))
+        elif isinstance(s, CALL):
+            names.update(_root(p) for p in s.params)
+    names.discard(None)
+    return names
+
+
+class MacroSplitter:
+    """Splits a macro exceeding a size budget into parts triggering each other
+
+    The statements of the macro are packed in order into parts of at most `max_lines` lines. Each part ends by
+    triggering the next one with `SYNC_TRIG_MACRO`, so the parts run one after the other like the original macro,
+    and a `return` still ends the whole chain.
+
+    Cuts are made between top-level statements first. A `BLOCK` too large for a part (a `ROUTINE` for example) is
+    split between its statements, and a `SWITCH` or a routine dispatch is split between its cases: the value it
+    matches is copied into a variable where it starts, and each part matches that copy against its own cases.
+    A statement that can't be split, like a large `IF` or a loop, gets a part of its own even when it exceeds the budget.
+
+    A variable written in a part and used by a later part is saved in LW registers at the end of the part, and
+    restored at the start of the parts using it. Each part defines the `SUB` functions it calls.
+
+    Each split macro gets its own registers: without a `state_address`, they start at `SPLIT_STATE_ADDRESS` or
+    after the registers of the macros already split. Splitting a macro whose registers overlap the ones of another
+    split macro raises a `ValueError`.
+    """
+    def __init__(self, max_lines:int, state_address:Optional[int] = None, state_device:str = "Local HMI"):
+        """Splits a macro exceeding a size budget into parts triggering each other
+
+        Args:
+            max_lines (int): The maximum number of lines of each part
+            state_address (Optional[int], optional): The first LW register used to pass variables between parts.
+                Defaults to None, the first register after the ones of the macros already split.
+            state_device (str, optional): The device holding these registers. Defaults to "Local HMI".
+        """
+        self.max_lines = max_lines
+        self.state_address = state_address
+        self.state_device = state_device
+        self._snapshots:Set[str] = set()
+        # The registers of the macro being split
+        self._state_start = 0
+        self._state_end = 0
+
+    def _break(self, s:STATEMENT) -> Optional[List[STATEMENT]]:
+        """Splits a statement into smaller statements executing the same, None if it can't be split"""
+        if isinstance(s, DISPATCH):
+            cases = sorted(s.cases, key=lambda c: c[0])
+            if len(cases) < 2 or s.expression is None or not all(isinstance(c[0], int) for c in cases):
+                return None
+            res:List[STATEMENT] = []
+            selector = s.expression
+            if _root(selector) not in self._snapshots:
+                # A case may change the value matched, the next parts must still match the value of the start
+                selector = Variable(f"p_split_case{len(self._snapshots)}", 'int')
+                self._snapshots.add(selector.name)
+                res.append(selector.set(s.expression))
+            middle = len(cases) // 2
+            for half in (cases[:middle], cases[middle:]):
+                comparisons:Dict[int, int] = {}
+                arms:Dict[int, CONDITION_ARM] = {}
+                tree = binary_dispatch(selector, [(m, holder.body) for m, _, holder in half], comparisons, arms)
+                res.append(DISPATCH(s.name, tree, cases=[(m, comparisons[m], arms[m]) for m, _, _ in half], expression=selector))
+            return res
+        if isinstance(s, BLOCK) and len(s.statements) > 1:
+            return list(s.statements)
+        return None
+
+    def pack(self, statements:List[STATEMENT], capacity:int) -> List[List[STATEMENT]]:
+        """Packs statements in order into parts of at most `capacity` lines, splitting the statements that don't fit
+
+        Args:
+            statements (List[STATEMENT]): The statements
+            capacity (int): The maximum number of lines of the statements of a part
+
+        Returns:
+            List[List[STATEMENT]]: The statements of each part
+        """
+        parts:List[List[STATEMENT]] = [[]]
+        used = 0
+        pending = deque(statements)
+        while pending:
+            s = pending.popleft()
+            size = _size(s)
+            if used + size <= capacity:
+                parts[-1].append(s)
+                used += size
+                continue
+            pieces = self._break(s)
+            if pieces is not None:
+                pending.extendleft(reversed(pieces))
+                continue
+            if parts[-1]:
+                parts.append([])
+            parts[-1].append(s)
+            used = size
+        return parts
+
+    def _body(self, macro:Macro) -> List[STATEMENT]:
+        """The statements of a macro after its variable declarations, up to its end"""
+        statements = macro.statements
+        start = 0
+        for i, s in enumerate(statements):
+            if s is macro._variable_block:
+                start = i + 1
+                if start < len(statements) and isinstance(statements[start], EMPTY):
+                    start += 1
+                break
+        return [s for s in statements[start:] if not isinstance(s, END_MACRO)]
+
+    def _build(self, macro:Macro, parts:List[List[STATEMENT]]) -> List[Macro]:
+        names = [macro.name] + [f"{macro.name}_part{k}" for k in range(1, len(parts))]
+
+        # The variables of each part, and those each part writes
+        variables:Dict[str, Variable|VariableArray] = {}
+        used:List[Set[str]] = []
+        for statements in parts:
+            probe = Macro(macro.name)
+            probe.statements = list(statements)
+            probe.define(*called_subs(*statements))
+            probe.statements.insert(0, probe._sub_block)
+            probe.compile()
+            for v in probe.variables:
+                variables.setdefault(v.name, v)
+            used.append({v.name for v in probe.variables})
+        written = [_written(statements) & names_used for statements, names_used in zip(parts, used)]
+
+        saved:List[Set[str]] = []
+        for k in range(len(parts)):
+            later = set().union(*used[k + 1:])
+            saved.append(written[k] & later)
+        tags:Dict[str, Tag] = {}
+        address = self._state_start
+        for k in range(len(parts)):
+            for name in sorted(saved[k]):
+                if name in tags:
+                    continue
+                v = variables[name]
+                size = v.size if isinstance(v, VariableArray) else 1
+                tags[name] = Tag(f"{macro.name}_{name}", self.state_device, f"LW, {address}", DataType.U16)
+                address += math.ceil(size * REGISTER_WIDTHS.get(v.dtype, 2))
+        self._state_end = address
+
+        def transfer(name:str, save:bool) -> STATEMENT:
+            v = variables[name]
+            if isinstance(v, VariableArray):
+                return tags[name].write(v[0], v.size) if save else tags[name].read(v[0], v.size)
+            return tags[name].write(v) if save else tags[name].read(v)
+
+        res:List[Macro] = []
+        for k, statements in enumerate(parts):
+            description = macro.description if k == 0 else f"Part {k + 1} of {macro.name}, triggered by {names[k - 1]}"
+            part = Macro(names[k], description, release=macro.release)
+            with part:
+                part.define(*called_subs(*statements))
+                restored = sorted(used[k] & set().union(*saved[:k]))
+                if restored:
+                    part.write(COMMENT(f"Restore the state of {names[k - 1]}"), *[transfer(n, False) for n in restored], EMPTY())
+                part.write(*statements)
+                if k + 1 < len(parts):
+                    part.write(
+                        EMPTY(),
+                        COMMENT(f"Continue in {names[k + 1]}"),
+                        *[transfer(n, True) for n in sorted(saved[k])],
+                        SYNC_TRIG_MACRO(names[k + 1]),
+                    )
+            res.append(part)
+        return res
+
+    def __call__(self, macro:Macro) -> List[Macro]:
+        if len(macro.compile()) <= self.max_lines:
+            return [macro]
+        body = self._body(macro)
+        empty = Macro(macro.name, macro.description, release=macro.release)
+        with empty:
+            # Each part defines the functions it calls, counted as if all of them did
+            empty.define(*macro.subs)
+        capacity = self.max_lines - len(empty.compile())
+        if self.state_address is None:
+            self._state_start = _free_state_address(macro.name, self.state_device)
+        else:
+            self._state_start = self.state_address
+        parts:List[Macro] = []
+        for _ in range(_ATTEMPTS):
+            self._snapshots.clear()
+            packed = self.pack(body, max(capacity, 1))
+            parts = self._build(macro, packed)
+            # Declarations and state transfers are only known once the parts are built,
+            # a part holding a single statement that can't be split can't be made smaller
+            excess = [len(part.compile()) - self.max_lines for part, statements in zip(parts, packed) if len(statements) > 1]
+            if not excess or max(excess) <= 0 or capacity <= 1:
+                break
+            capacity -= max(excess)
+        _reserve(macro.name, self.state_device, self._state_start, self._state_end)
+        return parts
+
+
+def split_macro(macro:Macro, max_lines:int, state_address:Optional[int] = None) -> List[Macro]:
+    """Splits a macro into parts of at most `max_lines` lines triggering each other, see `MacroSplitter`
+
+    Args:
+        macro (Macro): The macro, once written
+        max_lines (int): The maximum number of lines of each part
+        state_address (Optional[int], optional): The first LW register used to pass variables between parts.
+            Defaults to None, the first register after the ones of the macros already split.
+
+    Returns:
+        List[Macro]: The macro itself when it fits, otherwise the parts to export, the first one having the name of the macro
+
+    Raises:
+        ValueError: When the registers passing the state overlap the ones of another split macro
+    """
+    return MacroSplitter(max_lines, state_address)(macro)
@@ -1,8 +1,15 @@
 from __future__ import annotations
+import copy
+from itertools import product
+import json
+from pathlib import Path
+import string
+import sys
+from dataclasses import dataclass
 from enum import Enum
 from collections import deque
-from itertools import repeat
-from typing import IO, Any, Callable, Generic, List, Literal, Optional, Set, TextIO, Tuple, TypeVar, Union, overload
+from contextvars import ContextVar
+from typing import IO, Any, Callable, Dict, Generic, Iterator, List, Literal, Optional, Set, TextIO, Tuple, TypeVar, Union, overload
 
 try:
     from typing import TypeAlias
@@ -18,6 +25,13 @@ HEADER = """GENERATED CODE
 This code was generated by a script.
 See https://github.com/IliTheButterfly/EasyBuilderMacroGenerator"""
 
+# The words of the macro language a short name of a release build can't take
+RESERVED_NAMES = {
+    'and', 'or', 'not', 'xor', 'if', 'then', 'else', 'end', 'for', 'to', 'down', 'step', 'next', 'while', 'wend',
+    'break', 'continue', 'return', 'sub', 'select', 'case', 'default', 'macro_command', 'main', 'true', 'false',
+    'bool', 'char', 'short', 'int', 'long', 'float', 'double', 'unsigned',
+}
+
 
 def deboolify(value:Optional[DT]) -> Union[DT, int]:
     if value is None:
@@ -34,30 +48,69 @@ class Resource:
         Args:
             *resources (Resource): Sub resources
         """
-        self.resources:Set[Resource] = set(filter(lambda x: isinstance(x, Resource), resources))
+        self.resources:Set[Resource] = {r for r in resources if isinstance(r, Resource)}
         self._id = Resource.ID_COUNT
         Resource.ID_COUNT += 1
     def process(self, macro:Macro) -> None:
         """Processes the resource
 
+        Sub resources must be processed through `Macro.process` so that each of them
+        is only visited once per build.
+
         Args:
             macro (Macro): The containing macro
         """
-        for r in self.resources:
-            if isinstance(r, Resource) and not r.__class__ is Resource:
-                r.process(macro)
+        if self.resources:
+            macro.process(*self.resources)
+
+    def __deepcopy__(self, memo:Dict[int, Any]) -> Resource:
+        """A copy with its own id, the named resources it uses (variables, tags, sub functions) are shared"""
+        clone = self.__class__.__new__(self.__class__)
+        memo[id(self)] = clone
+        # Given first, the sets holding the copy may be built while its attributes are copied
+        clone._id = Resource.ID_COUNT
+        Resource.ID_COUNT += 1
+        for name, value in vars(self).items():
+            if name != '_id':
+                setattr(clone, name, copy.deepcopy(value, memo))
+        return clone
                 
     def __hash__(self) -> int:
         return hash(self._id)
     
 class STATEMENT(Resource):
     def __init__(self, *resources:Resource):
-        super().__init__(resources)
+        super().__init__(*resources)
         
     def __str__(self) -> str: ...
 
-    def process(self, macro:Macro):
-        super().process(macro)
+    def expand(self) -> Optional[List[STATEMENT]]:
+        """Returns the statements this statement is made of
+
+        Returns:
+            Optional[List[STATEMENT]]: The sub statements in output order, or None if the statement is written as-is
+        """
+        return None
+    
+    def bodies(self) -> List[List[STATEMENT]]:
+        """Returns the lists of statements this statement is made of
+
+        Optimization passes may edit the returned lists in place. Containers owning their statements return
+        the lists they hold, other statements return their expanded content.
+
+        Returns:
+            List[List[STATEMENT]]: The sub statement lists
+        """
+        content = self.expand()
+        return [] if content is None else [content]
+    
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        """Replaces each expression used by the statement with `func(expression, condition)`
+
+        Args:
+            func (Callable[[Any, bool], Any]): Called with each expression and whether it is used as a condition
+        """
+        pass
         
     def bake(self, macro:Macro):
         """Bakes the statement. In other words, writes the statement to the macro buffer
@@ -65,7 +118,13 @@ class STATEMENT(Resource):
         Args:
             macro (Macro): The containing macro
         """
-        macro.write_raw(str(self))
+        content = self.expand()
+        if content is None:
+            macro.write_raw(str(self))
+            return
+        for s, sub in walk(*content):
+            if sub is None:
+                s.bake(macro)
         
     def __hash__(self):
         return super().__hash__()
@@ -80,6 +139,10 @@ class EMPTY(STATEMENT):
         
     def __str__(self) -> str:
         return '\n'
+
+    def bake(self, macro:Macro):
+        if not macro.release:
+            super().bake(macro)
     
     def __hash__(self):
         return super().__hash__()
@@ -118,6 +181,10 @@ class COMMENT(STATEMENT):
         
     def __str__(self) -> str:
         return ''.join([f'// {l}\n' for l in self.text.splitlines(False)])
+
+    def bake(self, macro:Macro):
+        if not macro.release:
+            super().bake(macro)
     
     def __hash__(self):
         return super().__hash__()
@@ -141,9 +208,11 @@ class C_IF(STATEMENT):
         return f'if {str(self.condition)} then\n'
     
     def process(self, macro: Macro):
-        if isinstance(self.condition, Resource):
-            self.condition.process(macro)
+        macro.process(self.condition)
         super().process(macro)
+        
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        self.condition = func(self.condition, True)
     
     def bake(self, macro:Macro):
         super().bake(macro)
@@ -152,17 +221,65 @@ class C_IF(STATEMENT):
     def __hash__(self):
         return super().__hash__()
 
+class CONDITION_ARM:
+    """A single `if`, `else if` or `else` arm of a condition block
+    """
+    def __init__(self, header:STATEMENT, *body:STATEMENT):
+        """A single `if`, `else if` or `else` arm of a condition block
+
+        Args:
+            header (STATEMENT): The `C_IF`, `C_ELIF` or `C_ELSE` opening the arm
+            *body (STATEMENT): The body statements
+        """
+        self.header = header
+        self.body:List[STATEMENT] = list(body)
+
 class CONDITION_BLOCK(STATEMENT):
     """Base class for condition containers
+    
+    Every container of a same `IF(...).ELIF(...).ELSE()` chain shares the same list of arms,
+    so building a chain is linear in its number of arms.
     """
-    def __init__(self, *content:STATEMENT):
+    def __init__(self, arms:Optional[List[CONDITION_ARM]] = None):
         """Base class for condition containers
         
         Args:
-            *content (STATEMENT): The body statements
+            arms (List[CONDITION_ARM], optional): The arms shared with the parent container. Defaults to a new list.
         """
         super().__init__()
-        self.content:List[STATEMENT] = list([*content])
+        self.arms:List[CONDITION_ARM] = [] if arms is None else arms
+        # Made once, so each build visits the same `end if`
+        self._end_if:Optional[C_END_IF] = None
+        
+    @property
+    def content(self) -> List[STATEMENT]:
+        """The arms flattened into statements, without the closing `end if`
+        """
+        content:List[STATEMENT] = []
+        for arm in self.arms:
+            content.append(arm.header)
+            content.extend(arm.body)
+        return content
+    
+    def process(self, macro: Macro):
+        for arm in self.arms:
+            macro.process(arm.header, *arm.body)
+        super().process(macro)
+        
+    def expand(self) -> List[STATEMENT]:
+        if not self.arms:
+            return []
+        if isinstance(self.arms[0].header, C_ELSE):
+            # Every condition was removed by an optimization pass, only the else remains
+            return list(self.arms[0].body)
+        if self._end_if is None:
+            self._end_if = C_END_IF()
+        content = self.content
+        content.append(self._end_if)
+        return content
+    
+    def bodies(self) -> List[List[STATEMENT]]:
+        return [arm.body for arm in self.arms]
     
     def __hash__(self):
         return super().__hash__()
@@ -175,90 +292,49 @@ class COMPLETED_CONTAINER(STATEMENT):
         self._parent = parent
         
     def process(self, macro: Macro):
-        self._parent.process(macro)
+        macro.process(self._parent)
 
-    def bake(self, macro: Macro):
-        self._parent.bake(macro)
+    def expand(self) -> List[STATEMENT]:
+        return [self._parent]
         
     def __hash__(self):
         return super().__hash__()
 
 class ELSE_CONTAINER(CONDITION_BLOCK):
     def __init__(self, parent:CONDITION_BLOCK):
-        super().__init__(*parent.content)
-        self._empty = True
+        super().__init__(parent.arms)
         
     def __call__(self, *body:STATEMENT) -> COMPLETED_CONTAINER:
-        self._empty = False
-        self.content.append(C_ELSE())
-        self.content.extend(body)
-        self.content.append(C_END_IF())
+        self.arms.append(CONDITION_ARM(C_ELSE(), *body))
         return COMPLETED_CONTAINER(self)
-        
-    def process(self, macro: Macro):
-        for s in self.content:
-            s.process(macro)
-        super().process(macro)
-        
-    def bake(self, macro: Macro):
-        for s in self.content:
-            s.bake(macro)
-        if self._empty:
-            C_END_IF().bake(macro)
             
     def __hash__(self):
         return super().__hash__()
 
 class ELIF_CONTAINER(CONDITION_BLOCK):
     def __init__(self, parent:CONDITION_BLOCK):
-        super().__init__(*parent.content)
+        super().__init__(parent.arms)
         self._parent = parent
-        self._empty = True
         
     def __call__(self, *body:STATEMENT) -> IF_CONTAINER:
-        self._empty = False
-        self.content.extend(body)
+        self.arms[-1].body.extend(body)
         return IF_CONTAINER(self)
-    
-    def process(self, macro: Macro):
-        for s in self.content:
-            s.process(macro)
-        super().process(macro)
-        
-    def bake(self, macro: Macro):
-        for s in self.content:
-            s.bake(macro)
-        if self._empty:
-            C_END_IF().bake(macro)
 
     def __hash__(self):
         return super().__hash__()
 
 class IF_CONTAINER(CONDITION_BLOCK):
     def __init__(self, parent:CONDITION_BLOCK):
-        super().__init__(*parent.content)
+        super().__init__(parent.arms)
         self._parent = parent
-        self._ends = True
         
     def ELSE(self) -> ELSE_CONTAINER:
-        self._ends = False
         return ELSE_CONTAINER(self)
     
     def ELIF(self, condition:AnyValue) -> ELIF_CONTAINER:
         condition = deboolify(condition)
-        self.content.append(C_ELIF(condition))
+        self.arms.append(CONDITION_ARM(C_ELIF(condition)))
         return ELIF_CONTAINER(self)
-    
-    def process(self, macro: Macro):
-        for s in self.content:
-            s.process(macro)
-        super().process(macro)
-        
-    def bake(self, macro: Macro):
-        for s in self.content:
-            s.bake(macro)
-        if self._ends:
-            C_END_IF().bake(macro)
 
     def __hash__(self):
         return super().__hash__()
@@ -273,24 +349,11 @@ class IF(CONDITION_BLOCK):
             condition (EXPRESSION): The condition for the if
         """
         condition = deboolify(condition)
-        super().__init__(C_IF(condition))
-        self._empty = True
+        super().__init__([CONDITION_ARM(C_IF(condition))])
         
     def __call__(self, *body:STATEMENT) -> IF_CONTAINER:
-        self._empty = False
-        self.content.extend(body)
+        self.arms[0].body.extend(body)
         return IF_CONTAINER(self)
-    
-    def process(self, macro: Macro):
-        for s in self.content:
-            s.process(macro)
-        super().process(macro)
-        
-    def bake(self, macro: Macro):
-        for s in self.content:
-            s.bake(macro)
-        if self._empty:
-            C_END_IF().bake(macro)
         
     def __hash__(self):
         return super().__hash__()
@@ -333,9 +396,16 @@ class C_ELIF(STATEMENT):
         return f'else if {str(self.condition)} then\n'
     
     def process(self, macro: Macro):
-        if isinstance(self.condition, Resource):
-            self.condition.process(macro)
+        macro.process(self.condition)
         super().process(macro)
+        
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        condition = func(self.condition, True)
+        if condition is not self.condition:
+            self.resources.discard(self.condition)
+            if isinstance(condition, Resource):
+                self.resources.add(condition)
+            self.condition = condition
     
     def bake(self, macro:Macro):
         macro._close_if()
@@ -377,12 +447,10 @@ class BLOCK(STATEMENT):
         
     def process(self, macro):
         super().process(macro)
-        for statement in self.statements:
-            statement.process(macro)
+        macro.process(*self.statements)
     
-    def bake(self, macro):
-        for s in self.statements:
-            s.bake(macro)
+    def expand(self) -> List[STATEMENT]:
+        return self.statements
             
     def __hash__(self):
         return super().__hash__()
@@ -394,8 +462,14 @@ class VARIABLE_BLOCK(STATEMENT):
         super().__init__()
         
     def bake(self, macro: Macro):
-        for v in macro.variables:
-            macro.write_raw(v.declare(), '\n')
+        if self is not macro._declarations:
+            return
+        # One line per type, `short a, b = 1, c`, in the order of the first use of the variables
+        groups:Dict[str, List[str]] = {}
+        for v in macro._declared():
+            groups.setdefault(v.dtype, []).append(v.declarator())
+        for dtype, declarators in groups.items():
+            macro.write_raw(f'{dtype} {", ".join(declarators)}', '\n')
             
     def __hash__(self):
         return super().__hash__()
@@ -444,11 +518,12 @@ class ASSIGNMENT(STATEMENT):
         return f'{self.var} = {str(self.value)}\n'
 
     def process(self, macro: Macro):
-        self.var.process(macro)
-        if isinstance(self.value, Resource):
-            self.value.process(macro)
+        macro.process(self.var, self.value)
         super().process(macro)
         
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        self.value = func(self.value, False)
+        
     def __hash__(self):
         return super().__hash__()
 
@@ -471,11 +546,12 @@ class CALL(STATEMENT):
         return f'{self.funcName}({", ".join([str(p) for p in self.params])})\n'
     
     def process(self, macro: Macro):
-        for p in self.params:
-            if isinstance(p, Resource):
-                p.process(macro)
+        macro.process(*self.params)
         super().process(macro)
         
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        self.params = [func(p, False) for p in self.params]
+        
     def __hash__(self):
         return super().__hash__()
 
@@ -497,10 +573,13 @@ class RETURN(STATEMENT):
         return f'return {str(self.ret)}'
 
     def process(self, macro: Macro):
-        if isinstance(self.ret, Resource):
-            self.ret.process(macro)
+        macro.process(self.ret)
         super().process(macro)
         
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        if self.ret is not None:
+            self.ret = func(self.ret, False)
+        
     def __hash__(self):
         return super().__hash__()
 
@@ -514,7 +593,12 @@ class BREAK(STATEMENT):
         
     def __str__(self) -> str:
         return 'break'
-    
+
+    def bake(self, macro:Macro):
+        if not macro._in_loop():
+            raise SyntaxError('break outside of a loop.')
+        super().bake(macro)
+
     def __hash__(self):
         return super().__hash__()
 
@@ -528,341 +612,921 @@ class CONTINUE(STATEMENT):
         
     def __str__(self) -> str:
         return 'continue'
-    
-    def __hash__(self):
-        return super().__hash__()
 
-class CASE_CONTENT(STATEMENT):
-    def __init__(self, match:AnyValue, *body:STATEMENT):
-        super().__init__(match, *body)
-        self.match = deboolify(match)
-        self.body = body
-        self._end = False
-        self._start = False
-        self.expression:Optional[AnyValue] = None
+    def bake(self, macro:Macro):
+        if not macro._in_loop():
+            raise SyntaxError('continue outside of a loop.')
+        super().bake(macro)
 
-    def bake(self, macro):
-        if self._start:
-            C_IF(self.expression == self.match).bake(macro)
-        else:
-            C_ELIF(self.expression == self.match).bake(macro)
-            
-        for s in self.body:
-            s.bake(macro)
-        if self._end:
-            C_END_IF().bake(macro)
-            
     def __hash__(self):
         return super().__hash__()
 
-class CASE(Resource):
-    """A single case for a `SWITCH`
+class C_WHILE(STATEMENT):
+    """Custom implementation of a `while`
     """
-    def __init__(self, match:AnyValue):
-        """A single case for a `SWITCH`
-        
+    def __init__(self, condition:Union[EXPRESSION, Variable[bool], VariableItem[bool]]):
+        """Custom implementation of a `while`
+
         Args:
-            match (AnyValue): the value to match
+            condition (Union[EXPRESSION, Variable[bool], VariableItem[bool]]): The condition checked before each iteration
         """
-        self.match = deboolify(match)
         super().__init__()
-    
-    def __call__(self, *body:STATEMENT) -> CASE_CONTENT:
-        res = CASE_CONTENT(self.match, *body)
-        self.resources.add(res)
-        return res
-    
+        condition = deboolify(condition)
+        if isinstance(condition, (Variable, VariableItem)):
+            condition = condition.as_literal()
+        self.condition = condition
+
+    def __str__(self) -> str:
+        return f'while {str(self.condition)}\n'
+
+    def process(self, macro: Macro):
+        macro.process(self.condition)
+        super().process(macro)
+
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        self.condition = func(self.condition, True)
+
+    def bake(self, macro:Macro):
+        super().bake(macro)
+        macro._open_while()
+
     def __hash__(self):
         return super().__hash__()
-    
-class SWITCH(Resource):
-    """A series of `if/else if` that act similar to a switch case
-    """
-    def __init__(self, expression:AnyValue):
-        """A series of `if/else if` that act similar to a switch case
 
-        Args:
-            expression (AnyValue): The expression to match for the cases
-        """
-        super().__init__(expression)
-        self.expression = deboolify(expression)
-    
-    def __call__(self, *cases:CASE_CONTENT) -> BLOCK:
-        """The content of the `SWITCH`
-        
-        Args:
-            *cases (CASE_CONTENT): A series of `CASE(match)(...)`
+class C_WEND(STATEMENT):
+    """A custom implementation of the `wend` closing a `while`
+    """
+    def __init__(self):
+        """A custom implementation of the `wend` closing a `while`
         """
-        cases = list(cases)
-        cases[-1]._end = True
-        cases[0]._start = True
-        for c in cases:
-            c.expression = self.expression
-        return BLOCK(*cases)
-    
+        super().__init__()
+
+    def __str__(self) -> str:
+        return 'wend\n'
+
+    def bake(self, macro:Macro):
+        macro._close_while()
+        super().bake(macro)
+
     def __hash__(self):
         return super().__hash__()
-        
-    
-class EXPRESSION(Resource):
-    """Base class for expressions
+
+class C_FOR(STATEMENT):
+    """Custom implementation of a `for`
     """
-    def __init__(self, *exps:EXPRESSION):
-        """Base class for expressions
-        
+    def __init__(self, counter:Union[Variable[int], VariableItem[int]], start:AnyInt, end:AnyInt, step:int = 1):
+        """Custom implementation of a `for`
+
         Args:
-            *exps (EXPRESSION): Sub expressions
-        """
-        super().__init__(*exps)
-    
-    def __and__(self, other:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> EXPRESSION:
-        other = deboolify(other)
-        if isinstance(other, (Variable, VariableItem)):
-            other = other.as_literal()
-        return AND(self, other)
-    
-    def __or__(self, other:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> EXPRESSION:
-        other = deboolify(other)
-        if isinstance(other, (Variable, VariableItem)):
-            other = other.as_literal()
-        return OR(self, other)
-    
-    def __invert__(self) -> EXPRESSION:
-        return NOT(self)
-    
-    @overload
-    def __eq__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self} == {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __eq__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self} == {str(o)}')
-        res.resources.add(self)
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __ne__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self} <> {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __ne__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self} <> {str(o)}')
-        res.resources.add(self)
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __lt__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self} < {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __lt__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self} < {str(o)}')
-        res.resources.add(self)
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+            counter (Union[Variable[int], VariableItem[int]]): The variable counting the iterations
+            start (AnyInt): The first value of the counter
+            end (AnyInt): The last value of the counter
+            step (int, optional): The value added to the counter after each iteration, negative to count down. Defaults to 1.
 
-    @overload
-    def __le__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self} <= {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __le__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self} <= {str(o)}')
-        res.resources.add(self)
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __gt__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self} > {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __gt__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self} > {str(o)}')
-        res.resources.add(self)
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __ge__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self} >= {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __ge__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self} >= {str(o)}')
-        res.resources.add(self)
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __and__(self, o:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> AND:
-        return AND(self, deboolify(o))
-    
-    def __or__(self, o:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> OR:
-        return OR(self, deboolify(o))
-    
-    def __invert__(self) -> NOT:
-        return NOT(self)
-    
-    def __sub__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} - {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+        Raises:
+            ValueError: If the step is 0
+        """
+        super().__init__()
+        if step == 0:
+            raise ValueError("The step of a for can't be 0")
+        self.counter = counter
+        self.start = deboolify(start)
+        self.end = deboolify(end)
+        self.step = step
 
-    def __rsub__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} - {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __add__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} + {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def __str__(self) -> str:
+        direction = 'to' if self.step > 0 else 'down'
+        step = '' if abs(self.step) == 1 else f' step {abs(self.step)}'
+        return f'for {self.counter} = {str(self.start)} {direction} {str(self.end)}{step}\n'
 
-    def __radd__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} + {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __mul__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} * {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def process(self, macro: Macro):
+        macro.process(self.counter, self.start, self.end)
+        super().process(macro)
 
-    def __rmul__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} * {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __truediv__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} / {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        self.start = func(self.start, False)
+        self.end = func(self.end, False)
 
-    def __rtruediv__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} / {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __mod__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} % {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def bake(self, macro:Macro):
+        super().bake(macro)
+        macro._open_for()
 
-    def __rmod__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} % {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __str__(self) -> str: ...
-    
     def __hash__(self):
         return super().__hash__()
-    
-class EVAL(EXPRESSION, Generic[DT]):
-    """A function that evaluates to a value
+
+class C_NEXT(STATEMENT):
+    """A custom implementation of the `next` closing a `for`
     """
-    def __init__(self, funcName: str, *params:Union[Variable, VariableItem, bool, int, float, str]):
-        """A function that evaluates to a value
+    def __init__(self, counter:Union[Variable[int], VariableItem[int]]):
+        """A custom implementation of the `next` closing a `for`
+
         Args:
-            funcName (str): The name of the function
-            *params (Union[Variable, VariableItem, bool, int, float, str]): The parameters for the function
+            counter (Union[Variable[int], VariableItem[int]]): The counter of the `for`
         """
         super().__init__()
-        self.funcName = funcName
-        self.params:List[Union[Variable, VariableItem, bool, int, float, str]] = list([deboolify(p) for p in params])
-        for p in self.params:
-            if isinstance(p, Resource):
-                self.resources.add(p)
-    
+        self.counter = counter
+
     def __str__(self) -> str:
-        return f'{self.funcName}({", ".join([str(p) for p in self.params])})'
-    
+        return f'next {self.counter}\n'
+
     def process(self, macro: Macro):
-        for p in self.params:
-            if isinstance(p, Resource):
-                p.process(macro)
+        macro.process(self.counter)
         super().process(macro)
-        
+
+    def bake(self, macro:Macro):
+        macro._close_for()
+        super().bake(macro)
+
     def __hash__(self):
         return super().__hash__()
-    
-class LITERAL(EXPRESSION):
-    """A literal value
+
+class LOOP(STATEMENT):
+    """Base class for loop containers, a header, the body repeated and the statement closing the loop
     """
-    def __init__(self, literal:str):
-        """A literal value
+    def __init__(self, header:STATEMENT, footer:STATEMENT, *body:STATEMENT):
+        """Base class for loop containers, a header, the body repeated and the statement closing the loop
 
         Args:
-            literal (str): The literal value. This value will be pasted as-is into the generated macro
+            header (STATEMENT): The `C_WHILE` or `C_FOR` opening the loop
+            footer (STATEMENT): The `C_WEND` or `C_NEXT` closing the loop
+            *body (STATEMENT): The body statements
         """
         super().__init__()
-        self.literal = literal
-        
-    def __str__(self) -> str:
-        return self.literal
-    
+        self.header = header
+        self.footer = footer
+        self.body:List[STATEMENT] = list(body)
+
+    def __call__(self, *body:STATEMENT) -> LOOP:
+        self.body.extend(body)
+        return self
+
+    def process(self, macro: Macro):
+        macro.process(self.header, *self.body)
+        super().process(macro)
+
+    def expand(self) -> List[STATEMENT]:
+        return [self.header, *self.body, self.footer]
+
+    def bodies(self) -> List[List[STATEMENT]]:
+        return [self.body]
+
+    def map_expressions(self, func:Callable[[Any, bool], Any]):
+        self.header.map_expressions(func)
+
+    def __hash__(self):
+        return super().__hash__()
+
+class WHILE(LOOP):
+    """A `while` loop, repeating its body as long as its condition is true
+    """
+    def __init__(self, condition:Union[EXPRESSION, Variable[bool], VariableItem[bool]]):
+        """A `while` loop, repeating its body as long as its condition is true
+
+        Args:
+            condition (Union[EXPRESSION, Variable[bool], VariableItem[bool]]): The condition checked before each iteration
+        """
+        super().__init__(C_WHILE(condition), C_WEND())
+
+    def __hash__(self):
+        return super().__hash__()
+
+class FOR(LOOP):
+    """A `for` loop, repeating its body for each value of a counter
+    """
+    def __init__(self, counter:Union[Variable[int], VariableItem[int]], start:AnyInt, end:AnyInt, step:int = 1):
+        """A `for` loop, repeating its body for each value of a counter, `end` included
+
+        Args:
+            counter (Union[Variable[int], VariableItem[int]]): The variable counting the iterations
+            start (AnyInt): The first value of the counter
+            end (AnyInt): The last value of the counter
+            step (int, optional): The value added to the counter after each iteration, negative to count down. Defaults to 1.
+        """
+        super().__init__(C_FOR(counter, start, end, step), C_NEXT(counter))
+
+    @property
+    def iterations(self) -> Optional[int]:
+        """The number of iterations, None when the bounds are only known at runtime"""
+        header:C_FOR = self.header
+        if not isinstance(header.start, int) or not isinstance(header.end, int):
+            return None
+        return max((header.end - header.start) // header.step + 1, 0)
+
+    def __hash__(self):
+        return super().__hash__()
+
+class C_SUB(STATEMENT):
+    """The line opening the definition of a `SUB`
+    """
+    def __init__(self, sub:SUB):
+        super().__init__()
+        self.sub = sub
+
+    def __str__(self) -> str:
+        returns = '' if self.sub.returns is None else f'{self.sub.returns} '
+        return f'sub {returns}{self.sub.name}({", ".join(p.declare() for p in self.sub.params)})\n'
+
+    def bake(self, macro:Macro):
+        super().bake(macro)
+        macro._open_sub()
+
+    def __hash__(self):
+        return super().__hash__()
+
+class C_END_SUB(STATEMENT):
+    """The `end sub` closing the definition of a `SUB`
+    """
+    def __init__(self):
+        super().__init__()
+
+    def __str__(self) -> str:
+        return 'end sub\n'
+
+    def bake(self, macro:Macro):
+        macro._close_sub()
+        super().bake(macro)
+
+    def __hash__(self):
+        return super().__hash__()
+
+class SUB(STATEMENT):
+    """A sub function of the macro, written before `macro_command main()`
+
+    Sub functions only see their parameters and the global variables, so a macro defining sub functions declares
+    all of its variables globally. The sub functions a macro calls are defined when the macro ends, see `Macro.define`.
+    """
+    def __init__(self, name:str, *params:Parameter, returns:Optional[dt] = None):
+        """A sub function of the macro, written before `macro_command main()`
+
+        Args:
+            name (str): The name of the function
+            *params (Parameter): The parameters, passed by value
+            returns (Optional[dt], optional): The type of the value returned with `RETURN`. Defaults to None.
+        """
+        super().__init__()
+        for p in params:
+            if not isinstance(p, Parameter):
+                raise TypeError(f"The parameter {p} of {name} must be a Parameter")
+        self.name = name
+        self.params:List[Parameter] = list(params)
+        self.returns = returns
+        self.body:List[STATEMENT] = []
+        self.header = C_SUB(self)
+        self.footer = C_END_SUB()
+
+    def __call__(self, *body:STATEMENT) -> SUB:
+        self.body.extend(body)
+        return self
+
+    def call(self, *args:AnyValue) -> SUB_CALL:
+        """Calls the sub function as a statement
+
+        Args:
+            *args (AnyValue): The value of each parameter
+
+        Returns:
+            SUB_CALL: The call
+        """
+        return SUB_CALL(self, *args)
+
+    def eval(self, *args:AnyValue) -> SUB_EVAL:
+        """Calls the sub function in an expression, to use the value it returns
+
+        Args:
+            *args (AnyValue): The value of each parameter
+
+        Returns:
+            SUB_EVAL: The call
+        """
+        return SUB_EVAL(self, *args)
+
+    def process(self, macro: Macro):
+        macro.process(*self.body)
+        super().process(macro)
+
+    def expand(self) -> List[STATEMENT]:
+        return [self.header, *self.body, self.footer]
+
+    def bodies(self) -> List[List[STATEMENT]]:
+        return [self.body]
+
+    def __deepcopy__(self, memo:Dict[int, Any]) -> SUB:
+        return self
+
+    def __hash__(self):
+        return super().__hash__()
+
+class SUB_CALL(CALL):
+    """A call to a `SUB`
+    """
+    def __init__(self, sub:SUB, *args:AnyValue):
+        """A call to a `SUB`
+
+        Args:
+            sub (SUB): The sub function
+            *args (AnyValue): The value of each parameter
+
+        Raises:
+            TypeError: If the number of values doesn't match the parameters
+        """
+        if len(args) != len(sub.params):
+            raise TypeError(f"{sub.name} takes {len(sub.params)} parameters, {len(args)} given")
+        super().__init__(sub.name, *args)
+        self.sub = sub
+
+    def __hash__(self):
+        return super().__hash__()
+
+class SUB_BLOCK(STATEMENT):
+    """Internal statement for the sub functions of a macro, and the global variables they use
+    """
+    def __init__(self):
+        super().__init__()
+        self.subs:List[SUB] = []
+        self.variable_block = VARIABLE_BLOCK()
+
+    def expand(self) -> List[STATEMENT]:
+        if not self.subs:
+            return []
+        content:List[STATEMENT] = [self.variable_block, EMPTY()]
+        for sub in self.subs:
+            content.extend((sub, EMPTY()))
+        return content
+
+    def __hash__(self):
+        return super().__hash__()
+
+def _sub_calls(statement:STATEMENT) -> Iterator[SUB]:
+    """The sub functions a statement written as-is calls, directly or in its expressions"""
+    if isinstance(statement, SUB_CALL):
+        yield statement.sub
+    values:List[Any] = []
+    statement.map_expressions(lambda v, _: values.append(v) or v)
+    while values:
+        v = values.pop()
+        if isinstance(v, SUB_EVAL):
+            yield v.sub
+        if isinstance(v, VariableItem):
+            values.append(v.index)
+        elif isinstance(v, LITERAL):
+            values.append(v.literal)
+        elif isinstance(v, EXPRESSION):
+            values.extend(v.parts() or [])
+
+def called_subs(*statements:STATEMENT) -> List[SUB]:
+    """Finds the sub functions called by statements, and the ones they call
+
+    Args:
+        *statements (STATEMENT): The statements
+
+    Returns:
+        List[SUB]: The sub functions, each one after the ones it calls
+    """
+    res:List[SUB] = []
+    seen:Set[int] = set()
+    # Depth first, a function is added once every function it calls was
+    stack:List[Tuple[SUB, bool]] = []
+    for s, content in walk(*statements):
+        if content is not None:
+            continue
+        for sub in _sub_calls(s):
+            if id(sub) not in seen:
+                seen.add(id(sub))
+                stack.append((sub, False))
+        while stack:
+            sub, expanded = stack.pop()
+            if expanded:
+                res.append(sub)
+                continue
+            stack.append((sub, True))
+            for c, content in walk(*sub.body):
+                for callee in ([] if content is not None else _sub_calls(c)):
+                    if id(callee) not in seen:
+                        seen.add(id(callee))
+                        stack.append((callee, False))
+    return res
+
+class CASE_CONTENT(STATEMENT):
+    def __init__(self, match:AnyValue, *body:STATEMENT):
+        super().__init__(match, *body)
+        self.match = deboolify(match)
+        self.body = list(body)
+        self._end = False
+        self._start = False
+        self.expression:Optional[AnyValue] = None
+
+    def process(self, macro:Macro):
+        macro.process(self.expression)
+        super().process(macro)
+
+    def expand(self) -> List[STATEMENT]:
+        if self._start:
+            content = [C_IF(self.expression == self.match), *self.body]
+        else:
+            content = [C_ELIF(self.expression == self.match), *self.body]
+        if self._end:
+            content.append(C_END_IF())
+        return content
+    
+    def bodies(self) -> List[List[STATEMENT]]:
+        return [self.body]
+            
+    def __hash__(self):
+        return super().__hash__()
+
+class CASE(Resource):
+    """A single case for a `SWITCH`
+    """
+    def __init__(self, match:AnyValue):
+        """A single case for a `SWITCH`
+        
+        Args:
+            match (AnyValue): the value to match
+        """
+        self.match = deboolify(match)
+        super().__init__()
+    
+    def __call__(self, *body:STATEMENT) -> CASE_CONTENT:
+        res = CASE_CONTENT(self.match, *body)
+        self.resources.add(res)
+        return res
+    
+    def __hash__(self):
+        return super().__hash__()
+    
+# Lowering of `SWITCH` when none is given
+SWITCH_BINARY_ABOVE = 8
+SWITCH_TABLE_FROM = 4
+SWITCH_TABLE_DENSITY = 0.5
+
+@dataclass
+class LoweringCost:
+    """The cost of a way to lower a `SWITCH`: the lines written, the comparisons to reach the slowest case,
+    the average comparisons to reach a case and the array elements declared
+    """
+    lines:int
+    worst:int
+    average:float
+    elements:int = 0
+
+def binary_dispatch(expression:AnyValue, cases:List[Tuple[int, List[STATEMENT]]], comparisons:Optional[Dict[int, int]] = None, 
+                    arms:Optional[Dict[int, CONDITION_ARM]] = None) -> STATEMENT:
+    """Selects the case matching an expression with a balanced tree of comparisons
+
+    Each range check halves the cases left, and the last one or two cases are checked for equality,
+    so any case costs at most ceil(log2(cases)) + 1 comparisons. Values matching no case execute nothing.
+
+    Args:
+        expression (AnyValue): The expression to match
+        cases (List[Tuple[int, List[STATEMENT]]]): The value and body of each case, sorted by value
+        comparisons (Optional[Dict[int, int]], optional): Filled with the number of comparisons to reach each case. Defaults to None.
+        arms (Optional[Dict[int, CONDITION_ARM]], optional): Filled with the arm executing each case. Defaults to None.
+
+    Returns:
+        STATEMENT: The comparison tree
+    """
+    if comparisons is None:
+        comparisons = {}
+    if arms is None:
+        arms = {}
+    
+    def chain(low:int, high:int, depth:int) -> STATEMENT:
+        statement = None
+        for i in range(low, high):
+            match, body = cases[i]
+            comparisons[match] = depth + i - low + 1
+            if statement is None:
+                statement = IF(expression == match)(*body)
+            else:
+                statement = statement.ELIF(expression == match)(*body)
+            arms[match] = statement.arms[-1]
+        return statement
+    
+    def split(low:int, high:int, depth:int) -> STATEMENT:
+        # A pair of equality checks costs no more than a range check followed by an equality check
+        if high - low <= 2:
+            return chain(low, high, depth)
+        middle = (low + high) // 2
+        return IF(expression < cases[middle][0])(
+            split(low, middle, depth + 1)
+        ).ELSE()(
+            split(middle, high, depth + 1)
+        )
+    return split(0, len(cases), 0)
+
+class DISPATCH(BLOCK):
+    """The lowered statements of a `SWITCH` or of the steps of a routine, executing one of several cases
+    """
+    def __init__(self, name:str, *statements:STATEMENT, cases:Optional[List[Tuple[Any, int, Any]]] = None, expression:Optional[AnyValue] = None,
+                 tables:Optional[List[VariableArray]] = None):
+        """The lowered statements of a `SWITCH` or of the steps of a routine, executing one of several cases
+
+        Args:
+            name (str): What selects the case, to tell the dispatches apart in the analysis
+            *statements (STATEMENT): The lowered statements
+            cases (Optional[List[Tuple[Any, int, Any]]], optional): The match of each case, the number of comparisons
+                to reach it and the `CONDITION_ARM` or `CASE_CONTENT` holding its body. Defaults to None.
+            expression (Optional[AnyValue], optional): The expression matched by the cases. Defaults to None.
+            tables (Optional[List[VariableArray]], optional): The arrays of a `SWITCH` lowered to a lookup table,
+                numbered by the macro writing them, see `Macro.end`. Defaults to None.
+        """
+        super().__init__(*statements)
+        self.name = name
+        self.cases:List[Tuple[Any, int, Any]] = [] if cases is None else cases
+        self.expression = expression
+        self.tables:List[VariableArray] = [] if tables is None else tables
+        self.numbered = False
+        
+    def __hash__(self):
+        return super().__hash__()
+
+def _size(statement:STATEMENT) -> int:
+    """The number of lines written for a statement"""
+    return sum(1 for _, content in walk(statement) if content is None)
+
+def _table_address(address:Any) -> Optional[Tuple[str, int]]:
+    """The register and offset of a numbered tag address, None for tag names"""
+    if not isinstance(address, str) or address.startswith('"'):
+        return None
+    parts = address.split(',')
+    if len(parts) != 2:
+        return None
+    try:
+        return parts[0].strip(), int(parts[1])
+    except ValueError:
+        return None
+
+class SWITCH(Resource):
+    """A series of `if/else if` that act similar to a switch case
+    """
+    def __init__(self, expression:AnyValue, lowering:Optional[str] = None):
+        """A series of `if/else if` that act similar to a switch case
+
+        The cases can be lowered to:
+        - `linear`: an `if/else if` chain, case N costs N + 1 comparisons.
+        - `binary`: a balanced tree of comparisons, see `binary_dispatch`. The cases must match distinct integers.
+        - `table`: an array indexed by the expression, looked up after a range check. The cases must match distinct
+        integers, and each body must be a single assignment of a number to the same variable, or a single
+        `GetData`/`SetData` of the same variable on numbered addresses of the same register.
+        
+        After the cases are given, `costs` holds the size and comparison counts of each possible lowering.
+
+        Args:
+            expression (AnyValue): The expression to match for the cases
+            lowering (Optional[str], optional): `linear`, `binary` or `table`. By default, `table` is used from
+                `SWITCH_TABLE_FROM` cases when at least `SWITCH_TABLE_DENSITY` of the range is matched, `binary`
+                above `SWITCH_BINARY_ABOVE` cases, and `linear` otherwise. Defaults to None.
+        """
+        super().__init__(expression)
+        self.expression = deboolify(expression)
+        if lowering not in (None, 'linear', 'binary', 'table'):
+            raise ValueError(f"Unknown lowering {lowering}, expected 'linear', 'binary' or 'table'")
+        self.lowering = lowering
+        self.costs:Dict[str, LoweringCost] = {}
+    
+    def __call__(self, *cases:CASE_CONTENT) -> DISPATCH:
+        """The content of the `SWITCH`
+        
+        Args:
+            *cases (CASE_CONTENT): A series of `CASE(match)(...)`
+        """
+        cases = list(cases)
+        cases[-1]._end = True
+        cases[0]._start = True
+        for c in cases:
+            c.expression = self.expression
+        n = len(cases)
+        lowered:Dict[str, List[STATEMENT]] = {'linear' : cases}
+        paths:Dict[str, List[Tuple[Any, int, Any]]] = {'linear' : [(c.match, i + 1, c) for i, c in enumerate(cases)]}
+        self.costs = {'linear' : LoweringCost(sum(_size(c) for c in cases), n, (n + 1) / 2)}
+        
+        matches = [c.match for c in cases]
+        if all(isinstance(m, int) for m in matches) and len(set(matches)) == n:
+            comparisons:Dict[int, int] = {}
+            arms:Dict[int, CONDITION_ARM] = {}
+            tree = binary_dispatch(self.expression, sorted([(c.match, c.body) for c in cases], key=lambda c: c[0]), comparisons, arms)
+            lowered['binary'] = [tree]
+            paths['binary'] = [(c.match, comparisons[c.match], arms[c.match]) for c in cases]
+            self.costs['binary'] = LoweringCost(_size(tree), max(comparisons.values()), sum(comparisons.values()) / n)
+            table = self._table(cases)
+            if table is not None:
+                statement, arrays, worst = table
+                lowered['table'] = [statement]
+                # The lookup costs what the body of the case costs
+                paths['table'] = [(c.match, worst, c) for c in cases]
+                elements = len(arrays) * (max(matches) - min(matches) + 1)
+                self.costs['table'] = LoweringCost(_size(statement) + len(arrays), worst, worst, elements)
+        
+        lowering = self.lowering
+        if lowering is None:
+            density = n / (max(matches) - min(matches) + 1) if 'binary' in lowered else 0
+            if 'table' in lowered and n >= SWITCH_TABLE_FROM and density >= SWITCH_TABLE_DENSITY:
+                lowering = 'table'
+            elif 'binary' in lowered and n > SWITCH_BINARY_ABOVE:
+                lowering = 'binary'
+            else:
+                lowering = 'linear'
+        if lowering not in lowered:
+            raise ValueError(f"The cases of this SWITCH can't be lowered to {lowering}")
+        tables = table[1] if lowering == 'table' else None
+        return DISPATCH(str(self.expression), *lowered[lowering], cases=paths[lowering], expression=self.expression, tables=tables)
+    
+    def _table(self, cases:List[CASE_CONTENT]) -> Optional[Tuple[STATEMENT, List[VariableArray], int]]:
+        """Lowers the cases to a lookup table
+        
+        The arrays are named after the `SWITCH` until the macro writing the table numbers them, see `Macro.end`.
+
+        Returns:
+            Optional[Tuple[STATEMENT, List[VariableArray], int]]: The statement, its arrays and its number of comparisons, None if the cases can't be lowered to a table
+        """
+        if not isinstance(self.expression, (Operand, EXPRESSION)):
+            return None
+        bodies = []
+        for c in cases:
+            body = [s for s in c.body if not isinstance(s, (COMMENT, EMPTY))]
+            if len(body) != 1:
+                return None
+            bodies.append(body[0])
+        first = bodies[0]
+        if all(isinstance(b, ASSIGNMENT) and str(b.var) == str(first.var) for b in bodies):
+            if not all(isinstance(b.value, (int, float)) for b in bodies):
+                return None
+            values = [b.value for b in bodies]
+            dtype = first.var.dtype if isinstance(first.var, Variable) else first.var.array.dtype
+            lookup = lambda item: ASSIGNMENT(first.var, item)
+        elif all(isinstance(b, CALL) and b.funcName == first.funcName and len(b.params) == 4 and b.params[3] == 1 for b in bodies):
+            if first.funcName not in ('GetData', 'SetData'):
+                return None
+            addresses = [_table_address(b.params[2]) for b in bodies]
+            if any(a is None or a[0] != addresses[0][0] for a in addresses):
+                return None
+            if any(str(b.params[0]) != str(first.params[0]) or b.params[1] != first.params[1] for b in bodies):
+                return None
+            values = [a[1] for a in addresses]
+            dtype = 'int'
+            register = LITERAL(addresses[0][0])
+            lookup = lambda item: CALL(first.funcName, first.params[0], first.params[1], register, item, 1)
+        else:
+            return None
+        
+        low = min(c.match for c in cases)
+        size = max(c.match for c in cases) - low + 1
+        table = VariableArray(f"p_switch_table_{self._id}", dtype, size, [0] * size)
+        for c, v in zip(cases, values):
+            table.default[c.match - low] = v
+        index = self.expression - low if low != 0 else self.expression
+        statement = lookup(table[index])
+        arrays, worst = [table], 2
+        if size != len(cases):
+            present = VariableArray(f"p_switch_cases_{self._id}", 'bool', size, [0] * size)
+            for c in cases:
+                present.default[c.match - low] = 1
+            statement = IF(present[index])(statement)
+            arrays, worst = [table, present], 3
+        return IF(self.expression >= low)(
+            IF(self.expression <= low + size - 1)(
+                statement,
+            ),
+        ), arrays, worst
+    
+    def __hash__(self):
+        return super().__hash__()
+        
+    
+class Operand:
+    """Operators shared by expressions, variables and variable items
+
+    Every operator returns an expression node. Nothing is rendered to text until the macro is built.
+    """
+    def __eq__(self, o:AnyValue) -> BINARY:
+        return BINARY('==', self, o)
+    
+    def __ne__(self, o:AnyValue) -> BINARY:
+        return BINARY('<>', self, o)
+    
+    def __lt__(self, o:AnyValue) -> BINARY:
+        return BINARY('<', self, o)
+    
+    def __le__(self, o:AnyValue) -> BINARY:
+        return BINARY('<=', self, o)
+    
+    def __gt__(self, o:AnyValue) -> BINARY:
+        return BINARY('>', self, o)
+    
+    def __ge__(self, o:AnyValue) -> BINARY:
+        return BINARY('>=', self, o)
+    
+    def __and__(self, o:AnyBool) -> AND:
+        return AND(self, o)
+
+    def __rand__(self, o:AnyBool) -> AND:
+        return AND(o, self)
+    
+    def __or__(self, o:AnyBool) -> OR:
+        return OR(self, o)
+
+    def __ror__(self, o:AnyBool) -> OR:
+        return OR(o, self)
+    
+    def __invert__(self) -> NOT:
+        return NOT(self)
+    
+    def __sub__(self, o:AnyValue) -> BINARY:
+        return BINARY('-', self, o)
+
+    def __rsub__(self, o:AnyValue) -> BINARY:
+        return BINARY('-', o, self)
+    
+    def __add__(self, o:AnyValue) -> BINARY:
+        return BINARY('+', self, o)
+
+    def __radd__(self, o:AnyValue) -> BINARY:
+        return BINARY('+', o, self)
+    
+    def __mul__(self, o:AnyValue) -> BINARY:
+        return BINARY('*', self, o)
+
+    def __rmul__(self, o:AnyValue) -> BINARY:
+        return BINARY('*', o, self)
+    
+    def __truediv__(self, o:AnyValue) -> BINARY:
+        return BINARY('/', self, o)
+
+    def __rtruediv__(self, o:AnyValue) -> BINARY:
+        return BINARY('/', o, self)
+    
+    def __mod__(self, o:AnyValue) -> BINARY:
+        return BINARY('%', self, o)
+
+    def __rmod__(self, o:AnyValue) -> BINARY:
+        return BINARY('%', o, self)
+    
+class EXPRESSION(Resource, Operand):
+    """Base class for expressions
+    """
+    GENERATION = 0
+    _rendered:Optional[Tuple[int, Optional[str]]] = None
+    def __init__(self, *exps:EXPRESSION):
+        """Base class for expressions
+        
+        Args:
+            *exps (EXPRESSION): Sub expressions
+        """
+        super().__init__(*exps)
+    
+    @staticmethod
+    def invalidate():
+        """Invalidates the rendered text cached by every expression
+        """
+        EXPRESSION.GENERATION += 1
+    
+    def parts(self) -> Optional[List[Any]]:
+        """Returns the pieces the expression is rendered from
+
+        Returns:
+            Optional[List[Any]]: Text and operands in output order, or None if the expression renders itself with `__str__`
+        """
+        return None
+    
+    def __str__(self) -> str:
+        return render(self)
+    
+    def __hash__(self):
+        return super().__hash__()
+    
+class EVAL(EXPRESSION, Generic[DT]):
+    """A function that evaluates to a value
+    """
+    def __init__(self, funcName: str, *params:Union[Variable, VariableItem, bool, int, float, str]):
+        """A function that evaluates to a value
+        Args:
+            funcName (str): The name of the function
+            *params (Union[Variable, VariableItem, bool, int, float, str]): The parameters for the function
+        """
+        super().__init__()
+        self.funcName = funcName
+        self.params:List[Union[Variable, VariableItem, bool, int, float, str]] = list([deboolify(p) for p in params])
+        for p in self.params:
+            if isinstance(p, Resource):
+                self.resources.add(p)
+    
+    def parts(self) -> List[Any]:
+        parts = [self.funcName, '(']
+        for p in self.params:
+            parts.extend((p, ', '))
+        if self.params:
+            parts.pop()
+        parts.append(')')
+        return parts
+    
+    def process(self, macro: Macro):
+        macro.process(*self.params)
+        super().process(macro)
+        
+    def __hash__(self):
+        return super().__hash__()
+    
+class SUB_EVAL(EVAL):
+    """A call to a `SUB` in an expression, evaluating to the value it returns
+    """
+    def __init__(self, sub:SUB, *args:AnyValue):
+        """A call to a `SUB` in an expression, evaluating to the value it returns
+
+        Args:
+            sub (SUB): The sub function
+            *args (AnyValue): The value of each parameter
+
+        Raises:
+            TypeError: If the number of values doesn't match the parameters
+        """
+        if len(args) != len(sub.params):
+            raise TypeError(f"{sub.name} takes {len(sub.params)} parameters, {len(args)} given")
+        super().__init__(sub.name, *args)
+        self.sub = sub
+
+    def __hash__(self):
+        return super().__hash__()
+    
+class LITERAL(EXPRESSION):
+    """A literal value
+    """
+    def __init__(self, literal:Union[str, Resource]):
+        """A literal value
+
+        Args:
+            literal (Union[str, Resource]): The literal value. This value will be pasted as-is into the generated macro. 
+                A resource (a variable for example) is rendered when the macro is built
+        """
+        super().__init__(literal)
+        self.literal = literal
+        
+    def __str__(self) -> str:
+        return str(self.literal)
+    
     def __repr__(self):
         return f"[{self.literal}]"
     
     def __hash__(self):
         return super().__hash__()
     
-class NOT(EXPRESSION):
+class BINARY(EXPRESSION):
+    """A binary operation, rendered as `left operator right`
+    """
+    def __init__(self, operator:str, left:AnyValue, right:AnyValue):
+        """A binary operation, rendered as `left operator right`
+
+        Args:
+            operator (str): The macro operator (`+`, `==`, `<>`...)
+            left (AnyValue): The left operand
+            right (AnyValue): The right operand
+        """
+        left = deboolify(left)
+        right = deboolify(right)
+        if isinstance(left, (Variable, VariableItem)) and isinstance(right, (Variable, VariableItem)) and left is not right:
+            # Two variables with the same name would be compared with `==` when added to the resources set
+            super().__init__(left, right.as_literal())
+        else:
+            super().__init__(left, right)
+        self.operator = operator
+        self.left = left
+        self.right = right
+    
+    def parts(self) -> List[Any]:
+        return [self.left, f' {self.operator} ', self.right]
+    
+    def __repr__(self):
+        return f'[{repr(self.left)} {self.operator} {repr(self.right)}]'
+    
+    def __hash__(self):
+        return super().__hash__()
+    
+class UNARY(EXPRESSION):
+    """A unary operation, rendered as `(operator operand)`
+    """
+    def __init__(self, operator:str, expression:AnyValue):
+        """A unary operation, rendered as `(operator operand)`
+
+        Args:
+            operator (str): The macro operator
+            expression (AnyValue): The operand
+        """
+        expression = deboolify(expression)
+        super().__init__(expression)
+        self.operator = operator
+        self.expression = expression.as_literal() if isinstance(expression, (Variable, VariableItem)) else expression
+    
+    def parts(self) -> List[Any]:
+        return [f'({self.operator} ', self.expression, ')']
+    
+    def __hash__(self):
+        return super().__hash__()
+    
+class NOT(UNARY):
     def __init__(self, expression:EXPRESSION):
-        super().__init__(expression)
-        self.expression = expression.as_literal() if isinstance(expression, (Variable, VariableItem)) else expression
+        super().__init__('not', expression)
         
     def __invert__(self) -> EXPRESSION:
         return self.expression
-        
-    def __str__(self) -> str:
-        return f'(not {self.expression})'
     
     def __repr__(self):
         return f'NOT [{repr(self.expression)}]'
@@ -872,23 +1536,27 @@ class NOT(EXPRESSION):
     
 class OR(EXPRESSION):
     def __init__(self, *expressions:EXPRESSION):
+        expressions = [deboolify(e) for e in expressions]
         super().__init__(*expressions)
-        self._expressions:List[EXPRESSION] = [*[(e.as_literal() if isinstance(e, (Variable, VariableItem)) else e) for e in expressions]]
+        self._expressions:List[AnyValue] = expressions
     
     def __or__(self, other:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> OR:
         other = deboolify(other)
-        if isinstance(other, (Variable, VariableItem)):
-            other = other.as_literal()
         if isinstance(other, OR):
             return OR(*self._expressions, *other._expressions)
-        return super().__or__(self, other)
+        return OR(self, other)
     
     def append(self, *expressions:EXPRESSION):
         self._expressions.extend(expressions)
         self.resources.update(expressions)
+        EXPRESSION.invalidate()
         
-    def __str__(self):
-        return f'({" or ".join([str(e) for e in self._expressions])})'
+    def parts(self) -> List[Any]:
+        parts = ['(']
+        for e in self._expressions:
+            parts.extend((e, ' or '))
+        parts[-1] = ')'
+        return parts
         
     def __repr__(self):
         return f'[{" OR ".join([repr(e) for e in self._expressions])}]'
@@ -898,23 +1566,27 @@ class OR(EXPRESSION):
         
 class AND(EXPRESSION):
     def __init__(self, *expressions:Union[EXPRESSION, Variable[bool], VariableItem[bool]]):
+        expressions = [deboolify(e) for e in expressions]
         super().__init__(*expressions)
-        self._expressions:List[EXPRESSION] = [*[(e.as_literal() if isinstance(e, (Variable, VariableItem)) else e) for e in expressions]]
+        self._expressions:List[AnyValue] = expressions
         
     def __and__(self, other:EXPRESSION) -> AND:
         other = deboolify(other)
-        if isinstance(other, (Variable, VariableItem)):
-            other = other.as_literal()
         if isinstance(other, AND):
             return AND(*self._expressions, *other._expressions)
-        return super().__and__(other)
+        return AND(self, other)
         
     def append(self, *expressions:EXPRESSION):
         self._expressions.extend(expressions)
         self.resources.update(expressions)
+        EXPRESSION.invalidate()
         
-    def __str__(self):
-        return f'({" and ".join([str(e) for e in self._expressions])})'
+    def parts(self) -> List[Any]:
+        parts = ['(']
+        for e in self._expressions:
+            parts.extend((e, ' and '))
+        parts[-1] = ')'
+        return parts
         
     def __repr__(self):
         return f'[{" AND ".join([repr(e) for e in self._expressions])}]'
@@ -922,7 +1594,65 @@ class AND(EXPRESSION):
     def __hash__(self):
         return super().__hash__()
 
-class Variable(Resource, Generic[DT]):
+def render(expression:EXPRESSION) -> str:
+    """Renders an expression to macro code
+
+    The expression tree is walked with an explicit stack, so long operation chains don't hit the recursion limit.
+    An expression met a second time during the same generation (see `EXPRESSION.invalidate`) keeps its text,
+    so shared sub expressions are only rendered once.
+
+    Args:
+        expression (EXPRESSION): The expression to render
+
+    Returns:
+        str: The macro code of the expression
+    """
+    if expression.parts() is None:
+        raise NotImplementedError(f"{type(expression).__name__} must define either parts() or __str__()")
+    macro = _building.get()
+    # Each build renders with its own names, see `Macro._start_build`
+    generation = EXPRESSION.GENERATION if macro is None else macro._generation
+    out:List[str] = []
+    stack = []
+    caching = None
+    e = expression
+    while True:
+        if e is not None:
+            rendered = e._rendered
+            if rendered is not None and rendered[0] == generation and rendered[1] is not None:
+                out.append(rendered[1])
+            else:
+                parts = e.parts()
+                if parts is None:
+                    out.append(str(e))
+                else:
+                    if caching is None and rendered is not None and rendered[0] == generation:
+                        # Seen before: keep the text of the outermost shared expression
+                        caching = e
+                    e._rendered = (generation, None)
+                    stack.append((e, iter(parts), len(out)))
+        if not stack:
+            break
+        e = None
+        node, parts, start = stack[-1]
+        for p in parts:
+            if isinstance(p, EXPRESSION):
+                e = p
+                break
+            out.append(str(p))
+        else:
+            stack.pop()
+            if node is caching:
+                text = ''.join(out[start:])
+                out[start:] = [text]
+                node._rendered = (generation, text)
+                caching = None
+    return ''.join(out)
+
+# The macro whose statements are being processed or baked, which decides the names they are written with
+_building:ContextVar[Optional[Macro]] = ContextVar("_building", default=None)
+
+class Variable(Resource, Operand, Generic[DT]):
     """Defines a variable
     """
     def __init__(self, name:str, dtype:dt, default:DT=None):
@@ -943,195 +1673,69 @@ class Variable(Resource, Generic[DT]):
         macro.add_variable(self)
         
     def as_literal(self) -> LITERAL:
-        res = LITERAL(str(self))
-        res.resources.add(self)
-        return res
+        return LITERAL(self)
         
-    def declare(self) -> str:
+    def declarator(self) -> str:
+        """The declaration of the variable without its type, to declare it with other variables of the same type"""
         if self.default is None:
-            return f'{self.dtype} {self.name}'
-        return f'{self.dtype} {self.name} = {self.default}'
-    
-    @overload
-    def __eq__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.name} == {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __eq__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.name} == {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __ne__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.name} <> {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __ne__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.name} <> {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __lt__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.name} < {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __lt__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.name} < {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    @overload
-    def __le__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.name} <= {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __le__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.name} <= {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __gt__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.name} > {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __gt__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.name} > {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __ge__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.name} >= {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __ge__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.name} >= {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __and__(self, o:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> AND:
-        return AND(self, o)
-    
-    def __or__(self, o:Union[EXPRESSION, Variable[bool], VariableItem[bool]]) -> OR:
-        return OR(self, o)
-    
-    def __invert__(self) -> NOT:
-        return NOT(self)
-    
-    def __sub__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} - {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+            return str(self)
+        return f'{self} = {self.default}'
 
-    def __rsub__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} - {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def declare(self) -> str:
+        return f'{self.dtype} {self.declarator()}'
     
-    def __add__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} + {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def set(self, o:Union[Variable, VariableItem, EXPRESSION, bool, int, float, str]) -> ASSIGNMENT:
+        return ASSIGNMENT(self, deboolify(o))
 
-    def __radd__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} + {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __mul__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} * {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def __deepcopy__(self, memo:Dict[int, Any]) -> Variable[DT]:
+        return self
 
-    def __rmul__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} * {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def __hash__(self) -> int:
+        return self.name.__hash__()
     
-    def __truediv__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} / {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    def __rtruediv__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} / {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+    def __str__(self) -> str:
+        macro = _building.get()
+        return self.name if macro is None else macro._aliases.get(self.name, self.name)
     
-    def __mod__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} % {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
 
-    def __rmod__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} % {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
+class Temporary(Variable[DT]):
+    """A scratch variable, only holding a value from its assignment to its last use
 
-    def set(self, o:Union[Variable, VariableItem, EXPRESSION, bool, int, float, str]) -> ASSIGNMENT:
-        return ASSIGNMENT(self, deboolify(o))
+    Helpers keep their intermediate values in temporaries. `eb_macro_gen.passes.allocate_temporaries` gives
+    temporaries of the same type whose lifetimes don't overlap a shared variable, their slot. The slot is looked up
+    in the macro being built, so a temporary shared by several macros gets the slot of each of them.
+    """
+    def __init__(self, name:str, dtype:dt, default:DT=None):
+        """A scratch variable, only holding a value from its assignment to its last use
 
-    def __hash__(self) -> int:
-        return self.name.__hash__()
+        Args:
+            name (str): The name of the variable, when it has no slot
+            dtype (dt): The data type
+            default (DT, optional): The default value, when it has no slot. Defaults to None.
+        """
+        super().__init__(name, dtype, default)
+        
+    def process(self, macro:Macro) -> None:
+        slot = macro._slots.get(self.name)
+        if slot is None:
+            super().process(macro)
+            return
+        Resource.process(self, macro)
+        macro.process(slot)
     
     def __str__(self) -> str:
-        return self.name
+        macro = _building.get()
+        slot = None if macro is None else macro._slots.get(self.name)
+        return super().__str__() if slot is None else str(slot)
     
 
-class VariableItem(Resource, Generic[DT]):
+class Parameter(Variable[DT]):
+    """A parameter of a `SUB`, declared by the sub function instead of the macro
+    """
+    def process(self, macro:Macro) -> None:
+        Resource.process(self, macro)
+
+class VariableItem(Resource, Operand, Generic[DT]):
     def __init__(self, array:VariableArray[DT], index:Union[EXPRESSION, Variable[int], VariableItem[int], int]):
         Resource.__init__(self, array)
         self.array = array
@@ -1144,184 +1748,13 @@ class VariableItem(Resource, Generic[DT]):
         macro.add_variable(self.array)
         
     def as_literal(self) -> LITERAL:
-        res = LITERAL(str(self))
-        res.resources.add(self)
-        return res
+        return LITERAL(self)
         
-    @overload
-    def __eq__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} == {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __eq__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} == {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __ne__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} <> {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __ne__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} <> {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __lt__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} < {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __lt__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} < {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    @overload
-    def __le__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} <= {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __le__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} <= {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __gt__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} > {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __gt__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} > {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    @overload
-    def __ge__(self, o:Union[int, float, bool, str]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} >= {deboolify(o)}')
-        res.resources.add(self)
-        return res
-    
-    def __ge__(self, o:Union[Variable, VariableItem, EXPRESSION]) -> LITERAL:
-        res = LITERAL(f'{self.array.name} >= {str(o)}')
-        res.resources.add(self.as_literal())
-        if isinstance(o, (Variable, VariableItem)):
-            res.resources.add(o.as_literal())
-        elif isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __and__(self, o:Union[EXPRESSION, VariableItem[bool], Variable[bool]]) -> AND:
-        return AND(self, o)
-    
-    def __or__(self, o:Union[EXPRESSION, VariableItem[bool], Variable[bool]]) -> OR:
-        return OR(self, o)
-    
-    def __invert__(self) -> NOT:
-        return NOT(self)
-    
-    def __sub__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} - {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    def __rsub__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} - {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __add__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} + {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    def __radd__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} + {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __mul__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} * {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    def __rmul__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} * {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __truediv__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} / {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    def __rtruediv__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} / {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-    
-    def __mod__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(self)} % {str(deboolify(o))}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
-    def __rmod__(self, o) -> LITERAL:
-        res = LITERAL(f'{str(deboolify(o))} % {str(self)}')
-        res.resources.add(self)
-        if isinstance(o, Resource):
-            res.resources.add(o)
-        return res
-
     def set(self, o:AnyValue) -> ASSIGNMENT:
         return ASSIGNMENT(self, deboolify(o))
 
     def __str__(self) -> str:
-        return f"{self.array.name}[{str(self.index)}]"
+        return f"{self.array}[{str(self.index)}]"
     
     def __hash__(self):
         return hash(str(self))
@@ -1343,14 +1776,19 @@ class VariableArray(Resource, Generic[DT]):
         macro.add_variable(self)
         
     def as_literal(self) -> LITERAL:
-        res = LITERAL(str(self))
-        res.resources.add(self)
-        return res
+        return LITERAL(self)
         
-    def declare(self) -> str:
+    def declarator(self) -> str:
+        """The declaration of the array without its type, to declare it with other variables of the same type"""
         if self.default is None:
-            return f'{self.dtype} {self.name}[{self.size}]'
-        return f'{self.dtype} {self.name}[{self.size}] = ' + '{ ' + ", ".join([str(e) for e in self.default]) + ' }'
+            return f'{self}[{self.size}]'
+        return f'{self}[{self.size}] = ' + '{ ' + ", ".join([str(e) for e in self.default]) + ' }'
+
+    def declare(self) -> str:
+        return f'{self.dtype} {self.declarator()}'
+
+    def __deepcopy__(self, memo:Dict[int, Any]) -> VariableArray[DT]:
+        return self
 
     def __getitem__(self, index:Union[Variable[int], VariableItem[int], EXPRESSION, int]) -> VariableItem[DT]:
         if isinstance(index, int) and index > self.size:
@@ -1366,7 +1804,23 @@ class VariableArray(Resource, Generic[DT]):
         return self.name.__hash__()
     
     def __str__(self) -> str:
-        return self.name
+        macro = _building.get()
+        return self.name if macro is None else macro._aliases.get(self.name, self.name)
+
+
+def short_names() -> Iterator[str]:
+    """Generates the short names of the variables of release builds, `a` to `z`, then `aa`, `ab`... skipping `RESERVED_NAMES`
+
+    Yields:
+        str: Each name, shortest first
+    """
+    length = 1
+    while True:
+        for letters in product(string.ascii_lowercase, repeat=length):
+            name = ''.join(letters)
+            if name not in RESERVED_NAMES:
+                yield name
+        length += 1
 
 
 def vuchar(name:str, default:int = None) -> Variable[int]: return Variable(name, 'unsigned char', default)
@@ -1393,21 +1847,106 @@ def vbool_arr(name:str, size:int, default:Optional[List[bool]] = None) -> Variab
 def vfloat_arr(name:str, size:int, default:Optional[List[float]] = None) -> VariableArray[float]: return VariableArray(name, 'float', size, default)
 def vdouble_arr(name:str, size:int, default:Optional[List[float]] = None) -> VariableArray[float]: return VariableArray(name, 'double', size, default)
 
+def walk(*statements:STATEMENT) -> Iterator[Tuple[STATEMENT, Optional[List[STATEMENT]]]]:
+    """Iterates over statements and all of their sub statements in output order
+
+    The traversal uses an explicit stack, so deeply nested statements don't hit the recursion limit.
+
+    Args:
+        *statements (STATEMENT): The statements to walk
+
+    Yields:
+        Tuple[STATEMENT, Optional[List[STATEMENT]]]: Each statement with its expanded content, None if it is written as-is
+    """
+    stack = [iter(statements)]
+    while stack:
+        for s in stack[-1]:
+            content = s.expand()
+            yield s, content
+            if content is not None:
+                stack.append(iter(content))
+                break
+        else:
+            stack.pop()
+
+def iter_bodies(statements:List[STATEMENT]) -> Iterator[List[STATEMENT]]:
+    """Iterates over a list of statements and every nested list of statements
+
+    Each list is yielded before its sub statements are looked at, so it can be edited in place while iterating.
+
+    Args:
+        statements (List[STATEMENT]): The outermost statements, `Macro.statements` for example
+
+    Yields:
+        List[STATEMENT]: Each list of statements, once
+    """
+    # Keeps the lists alive so their ids can't be reused
+    seen:Dict[int, List[STATEMENT]] = {}
+    stack = [statements]
+    while stack:
+        body = stack.pop()
+        if id(body) in seen:
+            continue
+        seen[id(body)] = body
+        yield body
+        for s in reversed(body):
+            stack.extend(reversed(s.bodies()))
+
+def repeated_bodies(statements:List[STATEMENT]) -> Set[int]:
+    """Finds the lists of statements nested in a loop, which may run more than once per execution
+
+    Args:
+        statements (List[STATEMENT]): The outermost statements, `Macro.statements` for example
+
+    Returns:
+        Set[int]: The ids of the lists of statements, as given by `iter_bodies`
+    """
+    repeated:Set[int] = set()
+    for body in iter_bodies(statements):
+        looping = id(body) in repeated
+        for s in body:
+            if looping or isinstance(s, LOOP):
+                repeated.update(id(b) for b in s.bodies())
+    return repeated
+
 class BlockType(Enum):
     IF_BLOCK = 0
     WHILE_BLOCK = 1
     FOR_BLOCK = 2
     MACRO_BLOCK = 3
+    SUB_BLOCK = 4
+
+# Nested `Macro.process` calls made recursively, deeper resources are queued
+PROCESS_DEPTH = 100
 
 class Macro:
-    def __init__(self, name:str, description:Optional[str]=None):
+    def __init__(self, name:str, description:Optional[str]=None, scan_image:bool=False, max_lines:Optional[int]=None,
+                 release:bool=False):
         """A macro definition
 
         Args:
             name (str): The name of the macro
             description (str, optional): The description of the macro. Defaults to None.
+            scan_image (bool, optional): Whether the tags are read once when the macro starts and written once when it ends,
+                see `eb_macro_gen.passes.ScanImage`. Defaults to False.
+            max_lines (Optional[int], optional): The size budget of the macro, `split` splits it in parts 
+                when it is exceeded. Defaults to None.
+            release (bool, optional): Whether the macro is built for release: the variables get short names, see
+                `symbol_map`, and the comments, empty lines and indentation are left out. Defaults to False.
         """
         self.name = name
+        self.scan_image = scan_image
+        self.max_lines = max_lines
+        self.release = release
+        self.scan_report = None
+        # The slot of each temporary, see `eb_macro_gen.passes.allocate_temporaries`
+        self.temporaries:List[Tuple[Temporary, Variable]] = []
+        # The slot of each temporary by name during the current build
+        self._slots:Dict[str, Variable] = {}
+        # The short name of each variable by original name during the current release build, see `release`
+        self._aliases:Dict[str, str] = {}
+        # The generation the expressions of the current build are rendered with, see `render`
+        self._generation = 0
         self.description = description
         if self.description is None:
             self.description = ""
@@ -1415,9 +1954,24 @@ class Macro:
         self._maxlen = 200
         self.statements:List[STATEMENT] = []
         self.result:List[str] = ['']
+        # The variables declared by the current or last build, collected again by each build
         self.variables:Set[Variable, VariableArray] = set()
+        # The position of the statement first using each variable in the current build, see `_declared`
+        self._uses:Dict[str, int] = {}
+        self._use_time = 0
         self._nest:deque[BlockType] = deque()
         self._variable_block = VARIABLE_BLOCK()
+        self._sub_block = SUB_BLOCK()
+        self._sink:Optional[Callable[[str], None]] = None
+        self._indents:List[str] = ['']
+        self._processed:Set[int] = set()
+        # The resources deeper than `PROCESS_DEPTH`, see `process`
+        self._pending:List[Resource] = []
+        # The first pass which turned tag accesses into plain calls, see `optimize`
+        self._tags_hidden_by:Optional[str] = None
+        # The lookup tables numbered, see `_number_tables`
+        self._tables = 0
+        self._depth = 0
     
     def __enter__(self) -> Macro:
         self.begin()
@@ -1429,18 +1983,95 @@ class Macro:
     @overload
     def add_variable(self, var:Variable[DT]) -> Variable[DT]:
         self.variables.add(var)
+        self._uses.setdefault(var.name, self._use_time)
         return var
         
     def add_variable(self, var:VariableArray[DT]) -> VariableArray[DT]:
         self.variables.add(var)
+        self._uses.setdefault(var.name, self._use_time)
         return var
+
+    def _declared(self) -> List[Union[Variable, VariableArray]]:
+        """The variables to declare, in the order of the statements first using them, then in the order of their names
+
+        The variables used by the same statement are ordered by name, the order the resources of a statement are
+        processed in depends on their hashes.
+        """
+        return sorted(self.variables, key=lambda v: (v.name not in self._uses, self._uses.get(v.name, 0), v.name))
+    
+    @property
+    def subs(self) -> List[SUB]:
+        """The sub functions defined by the macro"""
+        return self._sub_block.subs
+
+    def define(self, *subs:SUB):
+        """Defines sub functions in the macro, before `macro_command main()`
+
+        The sub functions called by the statements of the macro are defined when it ends, this is only needed
+        for the functions called once the macro is written, by an optimization pass for example.
+
+        Args:
+            *subs (SUB): The sub functions, each one after the ones it calls
+        """
+        for sub in subs:
+            if all(sub is not s for s in self.subs):
+                self.subs.append(sub)
+
+    @property
+    def _declarations(self) -> VARIABLE_BLOCK:
+        """The block declaring the variables, global when sub functions need to see them"""
+        return self._sub_block.variable_block if self.subs else self._variable_block
+
+    def _indent_prefix(self) -> str:
+        """Returns the cached indentation prefix for the current nesting level
+        """
+        if self.release:
+            return ''
+        while len(self._indents) <= self.indentation:
+            self._indents.append(self._indents[-1] + '    ')
+        return self._indents[self.indentation]
+    
+    def process(self, *resources:Resource):
+        """Processes resources, visiting each of them at most once per build
+
+        Resources are processed recursively up to `PROCESS_DEPTH` nested calls. Deeper resources are queued and
+        processed once the outermost call is done, so deep expression trees don't hit the recursion limit.
+
+        Args:
+            *resources (Resource): Resources to process. Values that are not resources are ignored.
+        """
+        if self._depth >= PROCESS_DEPTH:
+            self._pending.extend(resources)
+            return
+        processed = self._processed
+        self._depth += 1
+        try:
+            for r in resources:
+                if isinstance(r, Resource) and r.__class__ is not Resource and r._id not in processed:
+                    processed.add(r._id)
+                    r.process(self)
+        finally:
+            self._depth -= 1
+        if self._depth == 0:
+            pending = self._pending
+            while pending:
+                self.process(pending.pop())
     
     def write_raw(self, *values:str):
         """Internal method to write text
+        
+        When the macro is being streamed (see `iter_lines`), each indented line is forwarded 
+        to the active sink instead of being accumulated in `result`.
         """
-        v = ''.join([str(vv) for vv in values])
+        v = str(values[0]) if len(values) == 1 else ''.join([str(vv) for vv in values])
+        prefix = self._indent_prefix()
+        if self._sink is not None:
+            sink = self._sink
+            for l in v.splitlines():
+                sink(prefix + l + '\n')
+            return
         for l in v.splitlines():
-            l = ''.join(repeat('    ', self.indentation)) + l + '\n'
+            l = prefix + l + '\n'
             if (len(l) + len(self.result[-1])) > self._maxlen:
                 self.result.append(l)
             else:
@@ -1507,12 +2138,28 @@ class Macro:
             raise SyntaxError(f'{self._nest[-1].name} not closed.')
         self._nest.pop()
         self.indentation -= 1
-        
+
+    def _open_sub(self):
+        self._nest.append(BlockType.SUB_BLOCK)
+        self.indentation += 1
+
+    def _close_sub(self):
+        if len(self._nest) == 0:
+            raise SyntaxError('Unable to close sub, no sub opened.')
+        if self._nest[-1] != BlockType.SUB_BLOCK:
+            raise SyntaxError(f'{self._nest[-1].name} not closed.')
+        self._nest.pop()
+        self.indentation -= 1
+
+    def _in_loop(self) -> bool:
+        return BlockType.WHILE_BLOCK in self._nest or BlockType.FOR_BLOCK in self._nest
+
     def begin(self):
         self.write(
             COMMENT(HEADER),
             EMPTY(),
             EMPTY(),
+            self._sub_block,
             COMMENT(self.description),
             BEGIN_MACRO(),
             self._variable_block,
@@ -1520,35 +2167,259 @@ class Macro:
         )
         
     def end(self):
+        if self.scan_image:
+            # The passes depend on the tag objects, which depend on this module
+            from eb_macro_gen.passes.scan_image import scan_image
+            self.scan_report = scan_image(self)
         self.write(END_MACRO())
+        self.define(*called_subs(*self.statements))
+        self._number_tables()
+
+    def _number_tables(self):
+        """Numbers the lookup tables of the `SWITCH`es of the macro, in output order
+
+        The tables already numbered by another macro keep their number, the parts of a split macro for example.
+        """
+        for s, _ in walk(*self.statements):
+            if isinstance(s, DISPATCH) and s.tables and not s.numbered:
+                self._tables += 1
+                for table in s.tables:
+                    # Named after the `SWITCH` until then, `p_switch_table_<id>`
+                    table.name = f"{table.name.rsplit('_', 1)[0]}{self._tables}"
+                s.numbered = True
+    
+    def optimize(self, *passes:Callable[[Macro], Any]) -> List[Any]:
+        """Runs optimization passes over the statements of the macro
+
+        Passes edit the statements in place. They are opt-in and run in the given order,
+        once the macro is written and before it is built.
+
+        The passes looking at the tags (`reads_tags`) must run before the passes turning tag accesses
+        into plain calls (`hides_tags`, `roll_loops` and `outline_blocks`), in this call or an earlier one.
+
+        Args:
+            *passes (Callable[[Macro], Any]): The passes, see `eb_macro_gen.passes`
+
+        Raises:
+            ValueError: If a pass looking at the tags comes after a pass hiding them
+
+        Returns:
+            List[Any]: The report of each pass
+        """
+        hidden = self._tags_hidden_by
+        for p in passes:
+            if getattr(p, 'hides_tags', False):
+                hidden = hidden or getattr(p, '__name__', type(p).__name__)
+            elif getattr(p, 'reads_tags', False) and hidden is not None:
+                name = getattr(p, '__name__', type(p).__name__)
+                raise ValueError(f"{name} looks at the tags, it must run before {hidden}")
+        reports = []
+        for p in passes:
+            reports.append(p(self))
+            if getattr(p, 'hides_tags', False) and self._tags_hidden_by is None:
+                self._tags_hidden_by = getattr(p, '__name__', type(p).__name__)
+        return reports
+    
+    def cost_report(self) -> CostReport:
+        """Statically analyses what the macro costs at runtime, see `eb_macro_gen.analysis.cost_report`
+
+        Returns:
+            CostReport: The device calls, statements, branches, memory and output size of the macro
+        """
+        # The analysis depends on the instructions, which depend on this module
+        from eb_macro_gen.analysis import cost_report
+        return cost_report(self)
+    
+    def split(self, max_lines:Optional[int] = None, state_address:Optional[int] = None) -> List[Macro]:
+        """Splits the macro into parts triggering each other when it exceeds its size budget, see `eb_macro_gen.splitting.MacroSplitter`
+
+        Args:
+            max_lines (Optional[int], optional): The maximum number of lines of each part. Defaults to `max_lines`.
+            state_address (Optional[int], optional): The first LW register used to pass variables between parts.
+                Defaults to None, the first register after the ones of the macros already split, from
+                `eb_macro_gen.splitting.SPLIT_STATE_ADDRESS`.
+
+        Returns:
+            List[Macro]: The macros to export, only this macro when it fits or when it has no budget
+
+        Raises:
+            ValueError: When the registers passing the state overlap the ones of another split macro
+        """
+        # The splitter depends on the tag objects, which depend on this module
+        from eb_macro_gen.splitting import split_macro
+        if max_lines is None:
+            max_lines = self.max_lines
+        if max_lines is None:
+            return [self]
+        return split_macro(self, max_lines, state_address)
+    
+    def symbol_map(self) -> Dict[str, str]:
+        """The short name each variable gets in a release build, see `release`
+
+        The variables declared by the macro and the parameters of its sub functions get the names of
+        `short_names` in the order of their names, so the same variables always get the same short names.
+        Names written as text, in a `LITERAL` string for example, aren't renamed.
+
+        Returns:
+            Dict[str, str]: The original name of each short name
+        """
+        processed, self._processed = self._processed, set()
+        uses, self._uses = self._uses, {}
+        variables, self.variables = self.variables, set()
+        # The variables the build declares, the slots instead of their temporaries
+        self._slots = {temporary.name: slot for temporary, slot in self.temporaries}
+        try:
+            self.process(*self.statements, *self.subs)
+        finally:
+            found, self.variables = self.variables, variables
+            self._processed = processed
+            self._uses = uses
+        names = {v.name for v in found} | {p.name for sub in self.subs for p in sub.params}
+        taken = {sub.name for sub in self.subs}
+        aliases = (alias for alias in short_names() if alias not in taken)
+        return {next(aliases): name for name in sorted(names)}
+
+    def write_symbols(self, path:Union[str, Path]):
+        """Writes the symbol map of the release build to a JSON file, to translate the short names back
+
+        Args:
+            path (Union[str, Path]): The file, created or overwritten
+        """
+        with Path(path).open("w") as fh:
+            json.dump(self.symbol_map(), fh, indent=4)
+    
+    def _start_build(self):
+        """Resets what a build collects, so each build only depends on the statements of the macro"""
+        self.variables = set()
+        self._uses = {}
+        self._processed.clear()
+        self._pending.clear()
+        self._depth = 0
+        self._slots = {temporary.name: slot for temporary, slot in self.temporaries}
+        self._aliases = {}
+        # A generation of its own, so the text rendered by other builds or outside of any build isn't reused
+        EXPRESSION.invalidate()
+        self._generation = EXPRESSION.GENERATION
+        EXPRESSION.invalidate()
+        self.indentation = 0
+        self._nest.clear()
+
+    def _prepare(self) -> List[STATEMENT]:
+        """Starts a build and processes every statement, before any of them is baked
+
+        This way the variables are all known when the variable block is written. The statements
+        must be processed and baked while `_building` is the macro, and `_finish` must be called
+        once they are baked.
+
+        Returns:
+            List[STATEMENT]: The statements written as-is, in output order. They are baked from
+            this list, without walking the containers a second time.
+        """
+        leaves:List[STATEMENT] = []
+        self._start_build()
+        if self.release:
+            self._aliases = {name: alias for alias, name in self.symbol_map().items()}
+        processed = self._processed
+        for self._use_time, (s, content) in enumerate(walk(*self.statements)):
+            if content is None:
+                leaves.append(s)
+                if s._id not in processed:
+                    processed.add(s._id)
+                    s.process(self)
+            elif s.resources:
+                self.process(*[r for r in s.resources if not isinstance(r, STATEMENT)])
+        return leaves
+
+    def _finish(self):
+        """Ends a build started by `_prepare`"""
+        self._sink = None
+
+    def compile(self) -> List[str]:
+        """Builds the resulting macro as a list of lines
+
+        Returns:
+            List[str]: The lines of the macro, including their trailing newline
+        """
+        lines:List[str] = []
+        token = _building.set(self)
+        try:
+            leaves = self._prepare()
+            self._sink = lines.append
+            for s in leaves:
+                s.bake(self)
+        finally:
+            self._finish()
+            _building.reset(token)
+        return lines
+
+    def iter_lines(self) -> Iterator[str]:
+        """Generates the resulting macro one line at a time
+
+        Lines are yielded as soon as the statement producing them is baked, so the whole
+        macro text is never held in memory.
+
+        Yields:
+            str: Each indented line, including its trailing newline
+        """
+        pending:List[str] = []
+        try:
+            token = _building.set(self)
+            try:
+                leaves = self._prepare()
+            finally:
+                _building.reset(token)
+            self._sink = pending.append
+            for s in leaves:
+                # Only while the statement is baked, the generator may be interleaved with other builds
+                token = _building.set(self)
+                try:
+                    s.bake(self)
+                finally:
+                    _building.reset(token)
+                if pending:
+                    yield from pending
+                    pending.clear()
+        finally:
+            self._finish()
+    
+    def render_to(self, stream:TextIO, buffer_lines:int = 256):
+        """Streams the resulting macro to a text stream
+
+        Args:
+            stream (TextIO): Stream to write the macro to
+            buffer_lines (int, optional): Number of lines to buffer between writes. Defaults to 256.
+        """
+        buffer:List[str] = []
+        token = _building.set(self)
+        try:
+            leaves = self._prepare()
+            self._sink = buffer.append
+            for s in leaves:
+                s.bake(self)
+                if len(buffer) >= buffer_lines:
+                    stream.write(''.join(buffer))
+                    buffer.clear()
+        finally:
+            self._finish()
+            _building.reset(token)
+        if buffer:
+            stream.write(''.join(buffer))
     
     def display(self, io:TextIO=None):
-        """Displays the resulting macro
+        """Displays the resulting macro, streamed through `render_to`
 
         Args:
             io (TextIO, optional): Stream to print the macro to. Defaults to stdout.
         """
-        self.result = ['']
-        for s in self.statements:
-            s.process(self)
-        
-        for s in self.statements:
-            s.bake(self)
-        
-        for l in self.result:
-            print(l, end='', file=io)
-            
+        if io is None:
+            io = sys.stdout
+        self.render_to(io)
+
     def clipboard(self):
         """Copies the resulting macro to clipboard
         """
         import pyperclip
-        self.result = ['']
-        for s in self.statements:
-            s.process(self)
-        
-        for s in self.statements:
-            s.bake(self)
-        pyperclip.copy(''.join(self.result))
+        pyperclip.copy(''.join(self.iter_lines()))
         
 
 class CONDITIONAL(STATEMENT):
@@ -1566,25 +2437,16 @@ class CONDITIONAL(STATEMENT):
         return self.condition
         
     def process(self, macro:Macro):
-        if self.result:
-            if self.onTrue is not None:
-                for s in self.onTrue:
-                    s.process(macro)
-        else:
-            if self.onFalse is not None:
-                for s in self.onFalse:
-                    s.process(macro)
+        macro.process(*self.expand())
         super().process(macro)
     
-    def bake(self, macro:Macro):
-        if self.result:
-            if self.onTrue is not None:
-                for s in self.onTrue:
-                    s.bake(macro)
-        else:
-            if self.onFalse is not None:
-                for s in self.onFalse:
-                    s.bake(macro)
+    def expand(self) -> List[STATEMENT]:
+        body = self.onTrue if self.result else self.onFalse
+        return [] if body is None else list(body)
+    
+    def bodies(self) -> List[List[STATEMENT]]:
+        body = self.onTrue if self.result else self.onFalse
+        return [] if body is None else [body]
 
 
 def C_MIN(a:Union[DT, Variable[DT]], b:Union[DT, Variable[DT]], r:Variable[DT]) -> STATEMENT:
@@ -0,0 +1,90 @@
+import json
+
+from eb_macro_gen.analysis import LOOP_ITERATIONS, CostReport, DeviceCost, PathCost, estimate_cost, path_costs
+from eb_macro_gen.objects import ROUTINE, DataType, Tag
+from eb_macro_gen.syntax import BLOCK, CASE, FOR, IF, SWITCH, WHILE, Macro, vbool, vchar, vint, vint_arr, vshort
+
+
+def test_cost_report_counts_device_calls_registers_and_memory():
+    plc = Tag("values", "PLC", "D, 5", DataType.S32)
+    hmi = Tag("mode", "Local HMI", "LW, 1", DataType.S16)
+    macro = Macro("costs")
+
+    with macro:
+        values = vint_arr("values", 10)
+        flag = vchar("flag")
+        mode = vshort("mode")
+        macro.write(
+            plc.read(values[0], 10),
+            IF(mode == 1)(plc.write(flag)).ELIF(mode == 2)(IF(flag)(mode.set(3))).ELSE()(mode.set(1)),
+            hmi.read(mode),
+        )
+
+    report = macro.cost_report()
+
+    assert report.devices == {
+        "PLC": DeviceCost(reads=1, writes=1, registers=21),
+        "Local HMI": DeviceCost(reads=1, writes=0, registers=1),
+    }
+    assert (report.calls, report.registers) == (3, 22)
+    assert report.statements == 8
+    assert report.branches == 3
+    assert report.memory == 10 * 4 + 1 + 2
+    assert report.lines == len(macro.compile())
+    assert json.loads(report.to_json())["registers"] == 22
+    assert "    PLC             1       1         21\n" in str(report)
+
+
+def test_estimate_cost_takes_the_most_expensive_arm():
+    mode = vshort("mode")
+    tag = Tag("mode", "Local HMI", "LW, 1", DataType.S16)
+
+    cheap_first = IF(mode == 1)(mode.set(2)).ELIF(mode == 2)(tag.read(mode)).ELSE()(mode.set(0))
+
+    # Two conditions tested, then the read
+    assert estimate_cost(cheap_first) == 12
+    assert estimate_cost(cheap_first, mode.set(1)) == 13
+    assert isinstance(Macro("empty").cost_report(), CostReport)
+
+
+def test_path_costs_weight_cases_uniformly_and_find_the_outlier():
+    value = vshort("value")
+    plc = Tag("value", "PLC", "D, 5", DataType.S16)
+    steps = [value.set(i) for i in range(10)]
+    steps[7] = BLOCK(plc.read(value), plc.write(value))
+    routine = ROUTINE("routine", Tag("step", "Local HMI", "LW, 0", DataType.S16), steps)
+    switch = SWITCH(value, lowering="linear")(
+        CASE(1)(value.set(2)),
+        CASE(2)(plc.read(value)),
+        CASE(3)(IF(value)(value.set(1))),
+    )
+
+    report = path_costs(routine, switch)
+    steps_report, cases_report = report.dispatches
+
+    assert steps_report.name == "routine_step"
+    assert steps_report.outlier == 7
+    # Reached after 3 comparisons of the binary dispatch
+    assert steps_report.cases[7].instructions == PathCost(6, 6, 6)
+    assert cases_report.outlier == 2
+    assert cases_report.cases[3].instructions == PathCost(4, 5, 4.5)
+    # Reading and writing the step, plus one case of each dispatch
+    assert report.calls.best == 2
+    assert report.calls.worst == 2 + 2 + 1
+    assert report.calls.average == 2 + 2 / 10 + 1 / 3
+
+
+def test_loops_repeat_the_cost_of_their_body():
+    index = vint("index")
+    busy = vbool("busy")
+    tag = Tag("input", "Local HMI", "LW, 1", DataType.S16)
+
+    counted = FOR(index, 0, 4)(tag.read(index))
+    polling = WHILE(busy)(tag.read(busy))
+
+    # 5 reads and 6 checks of the counter
+    assert estimate_cost(counted) == 5 * 10 + 6
+    assert estimate_cost(polling) == LOOP_ITERATIONS * 10 + LOOP_ITERATIONS + 1
+    report = path_costs(counted, polling)
+    assert report.calls == PathCost(5, 5 + LOOP_ITERATIONS, 5 + LOOP_ITERATIONS)
+    assert report.instructions == PathCost(5 + 6 + 1, 11 + 2 * LOOP_ITERATIONS + 1, 11 + 2 * LOOP_ITERATIONS + 1)
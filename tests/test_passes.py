@@ -0,0 +1,680 @@
+import io
+
+import pytest
+
+from eb_macro_gen.instructions import DELAY, SYNC_TRIG_MACRO, GetData, SetData
+from eb_macro_gen.objects import ROUTINE, DataType, Tag
+from eb_macro_gen.passes import (
+    AllocationReport, CoalescingReport, FoldingReport, Outliner, OutliningReport, ReadPlanner, RedundantReadReport,
+    RollingReport, ScanImageReport, allocate_temporaries, coalesce_reads, coalesce_writes, eliminate_redundant_reads,
+    fold_constants, outline_blocks, plan_reads, roll_loops,
+)
+from eb_macro_gen.syntax import (
+    BINARY, BLOCK, COMMENT, EMPTY, END_MACRO, IF, NOT, RETURN, WHILE, Macro, Temporary, vbool, vfloat, vint, vint_arr, vshort, vushort,
+)
+
+
+def render_macro(macro: Macro) -> str:
+    stream = io.StringIO()
+    macro.display(io=stream)
+    return stream.getvalue()
+
+
+def test_fold_constants_folds_arithmetic_and_boolean_identities():
+    macro = Macro("folding")
+
+    with macro:
+        a = vint("a")
+        flag = vbool("flag")
+        macro.write(
+            a.set(BINARY("*", 4, 3) + a),
+            a.set(BINARY("+", 1, 2) * a),
+            a.set(BINARY("/", 7, 2)),
+            IF(True & flag)(a.set(1)),
+            IF(False | (a > 3))(a.set(2)),
+            IF(NOT(NOT(flag)))(a.set(3)),
+            a.set(1 & flag),
+        )
+
+    report, = macro.optimize(fold_constants)
+    output = render_macro(macro)
+
+    assert report == FoldingReport(expressions=4, arms=0)
+    assert "    a = 12 + a\n" in output
+    # Rendered without parentheses, `(1 + 2) * a` reads `1 + 2 * a` and is left as is
+    assert "    a = 1 + 2 * a\n" in output
+    assert "    a = 7 / 2\n" in output
+    assert "    if flag then\n" in output
+    assert "    if a > 3 then\n" in output
+    assert "    if flag then\n        a = 3\n" in output
+    # Only the truth of a condition can drop the `and`
+    assert "    a = (1 and flag)\n" in output
+
+
+def test_fold_constants_removes_unreachable_arms():
+    macro = Macro("pruning")
+
+    with macro:
+        a = vint("a")
+        unused = vint("unused")
+        macro.write(
+            IF(BINARY(">", 3, 2))(COMMENT("always")).ELSE()(unused.set(1)),
+            IF(a & 0)(unused.set(2)).ELIF(a)(COMMENT("first")),
+            IF(a)(COMMENT("a")).ELIF(1)(COMMENT("otherwise")).ELIF(a > 1)(unused.set(3)),
+        )
+
+    report, = macro.optimize(fold_constants)
+    output = render_macro(macro)
+
+    assert report.arms == 3
+    assert "    // always\n" in output
+    assert "    if a then\n        // first\n    end if\n" in output
+    assert "    if a then\n        // a\n    else\n        // otherwise\n    end if\n" in output
+    assert "unused" not in output
+
+
+def test_coalesce_reads_merges_contiguous_addresses():
+    macro = Macro("read_coalescing")
+    words = [Tag(f"word{i}", "PLC", f"LW, {100 + i}", DataType.S16) for i in range(4)]
+    floats = [Tag(f"float{i}", "PLC", f"LW, {200 + 2 * i}", DataType.F32) for i in range(2)]
+    bits = [Tag(f"bit{i}", "Local HMI", f"LB, {i}", DataType.Bit) for i in range(2)]
+
+    with macro:
+        shorts = [vshort(f"short{i}") for i in range(4)]
+        reals = [vfloat(f"real{i}") for i in range(2)]
+        flags = [vbool(f"flag{i}") for i in range(2)]
+        macro.write(
+            words[1].read(shorts[1]),
+            COMMENT("Comments don't split reads"),
+            BLOCK(words[0].read(shorts[0]), words[2].read(shorts[2])),
+            floats[0].read(reals[0]),
+            floats[1].read(reals[1]),
+            bits[0].read(flags[0]),
+            bits[1].read(flags[1]),
+            DELAY(10),
+            words[3].read(shorts[3]),
+        )
+
+    report, = macro.optimize(coalesce_reads)
+    output = render_macro(macro)
+
+    assert report == CoalescingReport(calls=7, blocks=3)
+    assert report.saved == 4
+    assert "    short p_read_short[3], short1, short0, short2, short3\n" in output
+    assert (
+        '    GetData(p_read_short[0], "PLC", LW, 100, 3)\n'
+        "    short1 = p_read_short[1]\n"
+        "    // Comments don't split reads\n"
+        "    short0 = p_read_short[0]\n"
+        "    short2 = p_read_short[2]\n"
+    ) in output
+    assert '    GetData(p_read_float[0], "PLC", LW, 200, 2)\n' in output
+    assert '    GetData(p_read_bool[0], "Local HMI", LB, 0, 2)\n' in output
+    assert '    GetData(short3, "PLC", LW, 103, 1)\n' in output
+
+
+def test_coalesce_reads_gives_interleaved_runs_their_own_elements():
+    macro = Macro("interleaved_reads")
+    words = [Tag(f"word{i}", "PLC", f"LW, {100 + i}", DataType.S16) for i in range(2)]
+    registers = [Tag(f"register{i}", "PLC", f"RW, {i}", DataType.S16) for i in range(2)]
+
+    with macro:
+        values = [vshort(f"value{i}") for i in range(4)]
+        macro.write(
+            words[0].read(values[0]),
+            registers[0].read(values[1]),
+            words[1].read(values[2]),
+            registers[1].read(values[3]),
+        )
+
+    report, = macro.optimize(coalesce_reads)
+    output = render_macro(macro)
+
+    assert report == CoalescingReport(calls=4, blocks=2)
+    # The read of RW 0 must not overwrite LW 101 before it is assigned
+    assert (
+        '    GetData(p_read_short[0], "PLC", LW, 100, 2)\n'
+        "    value0 = p_read_short[0]\n"
+        '    GetData(p_read_short[2], "PLC", RW, 0, 2)\n'
+        "    value1 = p_read_short[2]\n"
+        "    value2 = p_read_short[1]\n"
+        "    value3 = p_read_short[3]\n"
+    ) in output
+    assert "    short p_read_short[4], " in output
+
+
+def test_coalesce_writes_sends_values_after_the_last_write():
+    macro = Macro("write_coalescing")
+    words = [Tag(f"word{i}", "PLC", f"LW, {10 + i}", DataType.U16) for i in range(3)]
+    floats = [Tag(f"float{i}", "PLC", f"LW, {20 + 2 * i}", DataType.F32) for i in range(2)]
+
+    with macro:
+        temp = vushort("temp")
+        real = vfloat("real")
+        macro.write(
+            temp.set(1),
+            words[0].write(temp),
+            temp.set(2),
+            words[1].write(temp),
+            temp.set(3),
+            words[2].write(temp),
+            floats[1].write(real),
+            floats[0].write(real),
+            words[0].read(temp),
+            floats[0].write(real),
+        )
+
+    report, = macro.optimize(coalesce_writes)
+    output = render_macro(macro)
+
+    assert report == CoalescingReport(calls=5, blocks=2)
+    assert (
+        "    temp = 1\n"
+        "    p_write_unsigned_short[0] = temp\n"
+        "    temp = 2\n"
+        "    p_write_unsigned_short[1] = temp\n"
+        "    temp = 3\n"
+        "    p_write_unsigned_short[2] = temp\n"
+        '    SetData(p_write_unsigned_short[0], "PLC", LW, 10, 3)\n'
+        "    p_write_float[1] = real\n"
+        "    p_write_float[0] = real\n"
+        '    SetData(p_write_float[0], "PLC", LW, 20, 2)\n'
+    ) in output
+    # A read of the device ends the window
+    assert '    SetData(real, "PLC", LW, 20, 1)\n' in output
+
+
+def test_coalesce_writes_gives_interleaved_runs_their_own_elements():
+    macro = Macro("interleaved_writes")
+    words = [Tag(f"word{i}", "PLC", f"LW, {100 + i}", DataType.S16) for i in range(2)]
+    registers = [Tag(f"register{i}", "PLC", f"RW, {i}", DataType.S16) for i in range(2)]
+
+    with macro:
+        values = [vshort(f"value{i}") for i in range(4)]
+        macro.write(
+            words[0].write(values[0]),
+            registers[0].write(values[1]),
+            words[1].write(values[2]),
+            registers[1].write(values[3]),
+        )
+
+    report, = macro.optimize(coalesce_writes)
+    output = render_macro(macro)
+
+    assert report == CoalescingReport(calls=4, blocks=2)
+    # The value for RW 0 must not overwrite the one for LW 100 before it is sent
+    assert (
+        "    p_write_short[0] = value0\n"
+        "    p_write_short[2] = value1\n"
+        "    p_write_short[1] = value2\n"
+        '    SetData(p_write_short[0], "PLC", LW, 100, 2)\n'
+        "    p_write_short[3] = value3\n"
+        '    SetData(p_write_short[2], "PLC", RW, 0, 2)\n'
+    ) in output
+
+
+
+def test_coalescing_again_declares_new_scratch_arrays():
+    macro = Macro("coalesced_twice")
+    words = [Tag(f"word{i}", "PLC", f"LW, {i}", DataType.S16) for i in range(6)]
+
+    with macro:
+        values = [vshort(f"value{i}") for i in range(6)]
+        macro.write(words[0].read(values[0]), words[1].read(values[1]))
+    macro.optimize(coalesce_reads)
+    end = next(i for i, s in enumerate(macro.statements) if isinstance(s, END_MACRO))
+    macro.statements.insert(end, BLOCK(*[words[i].read(values[i]) for i in range(2, 6)]))
+    report, = macro.optimize(coalesce_reads)
+    output = render_macro(macro)
+
+    assert report == CoalescingReport(calls=4, blocks=1)
+    # Declared with its own size, not merged with the array of the first run
+    assert "    short p_read_short[2], value0, value1, p_read_short_2[4], " in output
+    assert '    GetData(p_read_short_2[0], "PLC", LW, 2, 4)\n' in output
+
+
+def test_coalesce_writes_keeps_arrays_of_the_same_name_apart():
+    macro = Macro("written_arrays")
+    words = [Tag(f"word{i}", "PLC", f"LW, {i}", DataType.S16) for i in range(3)]
+
+    with macro:
+        history = vint_arr("p_write_short", 5)
+        values = [vshort(f"value{i}") for i in range(3)]
+        macro.write(history[4].set(1), *[words[i].write(values[i]) for i in range(3)])
+    report, = macro.optimize(coalesce_writes)
+    output = render_macro(macro)
+
+    assert report == CoalescingReport(calls=3, blocks=1)
+    assert "    int p_write_short[5]\n" in output
+    assert "    short p_write_short_2[3], " in output
+    assert '    SetData(p_write_short_2[0], "PLC", LW, 0, 3)\n' in output
+
+def test_plan_reads_covers_small_gaps_with_one_request():
+    macro = Macro("read_planning")
+    words = {a: Tag(f"word{a}", "PLC", f"LW, {a}", DataType.S16) for a in (0, 1, 4, 10, 12)}
+    output_tag = Tag("output", "PLC", "LW, 12", DataType.S16)
+
+    with macro:
+        values = {a: vshort(f"value{a}") for a in words}
+        macro.write(
+            words[4].read(values[4]),
+            IF(values[4] > 0)(
+                words[0].read(values[0]),
+                words[1].read(values[1]),
+            ),
+            words[4].read(values[4]),
+            words[10].read(values[10]),
+            # Written by the macro, the read stays where it is
+            words[12].read(values[12]),
+            output_tag.write(values[0]),
+        )
+
+    report, = macro.optimize(plan_reads)
+    output = render_macro(macro)
+
+    assert report.reads == 5
+    assert report.requests == 2
+    assert report.saved == 3
+    assert report.unused == 2
+    assert "    short p_plan_short[6], value4, value0, value1, value10, value12\n" in output
+    assert (
+        "    // Read plan\n"
+        '    GetData(p_plan_short[0], "PLC", LW, 0, 5)\n'
+        '    GetData(p_plan_short[5], "PLC", LW, 10, 1)\n'
+    ) in output
+    assert "    value4 = p_plan_short[4]\n    if value4 > 0 then\n" in output
+    assert "        value0 = p_plan_short[0]\n        value1 = p_plan_short[1]\n" in output
+    assert '    GetData(value12, "PLC", LW, 12, 1)\n' in output
+
+    narrow = Macro("narrow")
+    with narrow:
+        narrow.write(*[words[a].read(vshort(f"value{a}")) for a in (0, 1, 4)])
+    report, = narrow.optimize(ReadPlanner(max_gap=1))
+    assert [(b.address, b.count) for b in report.blocks] == [(0, 2), (4, 1)]
+
+
+
+def test_plan_reads_stops_at_delays_and_keeps_volatile_tags():
+    words = {a: Tag(f"word{a}", "PLC", f"LW, {a}", DataType.S16) for a in range(5)}
+    ack = Tag("ack", "PLC", "LW, 5", DataType.S16, volatile=True)
+    macro = Macro("read_barriers")
+
+    with macro:
+        values = {a: vshort(f"value{a}") for a in range(6)}
+        macro.write(
+            words[0].read(values[0]),
+            words[1].read(values[1]),
+            ack.read(values[5]),
+            DELAY(100),
+            # Must see the value after the delay
+            words[2].read(values[2]),
+            SYNC_TRIG_MACRO("other"),
+            words[3].read(values[3]),
+            words[4].read(values[4]),
+        )
+
+    report, = macro.optimize(ReadPlanner(volatile=[words[1]]))
+    output = render_macro(macro)
+
+    assert report.reads == 1
+    assert "    value0 = p_plan_short[0]\n" in output
+    assert '    GetData(value1, "PLC", LW, 1, 1)\n' in output
+    assert '    GetData(value5, "PLC", LW, 5, 1)\n' in output
+    assert '    DELAY(100)\n    GetData(value2, "PLC", LW, 2, 1)\n' in output
+    assert '    GetData(value4, "PLC", LW, 4, 1)\n' in output
+
+def test_scan_image_reads_once_and_flushes_dirty_tags():
+    command = Tag("command", "PLC", "LB, 0", DataType.Bit)
+    step = Tag("step", "PLC", "LW, 10", DataType.S16)
+    alarm = Tag("alarm", "PLC", "LW, 11", DataType.S16, volatile=True)
+    macro = Macro("scan", scan_image=True)
+
+    with macro:
+        enabled = vbool("enabled")
+        value = vshort("value")
+        macro.write(
+            command.read(enabled),
+            IF(enabled)(
+                step.read(value),
+                value.set(value + 1),
+                step.write(value),
+            ),
+            alarm.read(value),
+            step.read(value),
+            command.read(enabled),
+        )
+
+    output = render_macro(macro)
+
+    assert macro.scan_report == ScanImageReport(inputs=2, outputs=1, reads=4, writes=1)
+    assert (
+        "    // Input image\n"
+        '    GetData(p_image_command, "PLC", LB, 0, 1)\n'
+        '    GetData(p_image_step, "PLC", LW, 10, 1)\n'
+        "    \n"
+        "    enabled = p_image_command\n"
+        "    if enabled then\n"
+        "        value = p_image_step\n"
+        "        value = value + 1\n"
+        "        p_image_step = value\n"
+        "        p_image_step_dirty = 1\n"
+        "    end if\n"
+        '    GetData(value, "PLC", LW, 11, 1)\n'
+        "    value = p_image_step\n"
+        "    enabled = p_image_command\n"
+        "    // Output image\n"
+        "    if p_image_step_dirty then\n"
+        '        SetData(p_image_step, "PLC", LW, 10, 1)\n'
+        "    end if\n"
+        "end macro_command\n"
+    ) in output
+    assert "    bool p_image_command, enabled, p_image_step_dirty = 0\n" in output
+
+
+def test_eliminate_redundant_reads_reuses_earlier_values():
+    level = Tag("level", "PLC", "LW, 0", DataType.F32)
+    named = Tag("named", "Local HMI", '"named"', DataType.F32)
+    macro = Macro("redundant")
+
+    with macro:
+        a = vfloat("a")
+        b = vfloat("b")
+        c = vfloat("c")
+        macro.write(
+            GetData(c, "Local HMI", "named"),
+            named.read(c),
+            level.read(a),
+            COMMENT("Same address, other variable"),
+            BLOCK(level.read(b)),
+            level.read(a),
+            a.set(a + 1),
+            level.read(a),
+            SetData(c, "PLC", "LW, 10"),
+            level.read(b),
+            DELAY(10),
+            named.read(c),
+            IF(a > 1)(named.read(c)),
+        )
+
+    report, = macro.optimize(eliminate_redundant_reads)
+    output = render_macro(macro)
+
+    assert report == RedundantReadReport(removed=2, reused=1)
+    assert (
+        '    GetData(c, "Local HMI", "named", 1)\n'
+        '    GetData(a, "PLC", LW, 0, 1)\n'
+        "    // Same address, other variable\n"
+        "    b = a\n"
+        "    a = a + 1\n"
+        '    GetData(a, "PLC", LW, 0, 1)\n'
+        '    SetData(c, "PLC", "LW, 10", 1)\n'
+        '    GetData(b, "PLC", LW, 0, 1)\n'
+        "    DELAY(10)\n"
+        '    GetData(c, "Local HMI", "named", 1)\n'
+        "    if a > 1 then\n"
+        '        GetData(c, "Local HMI", "named", 1)\n'
+    ) in output
+
+
+def test_allocate_temporaries_shares_slots_between_disjoint_lifetimes():
+    value = vshort("value")
+    early = Temporary("early", "short", 0)
+    macro = Macro("temporaries")
+
+    with macro:
+        first = ROUTINE("first", Tag("first_step", "Local HMI", "LW, 0", DataType.S16), [value.set(1), value.set(2)])
+        second = ROUTINE("second", Tag("second_step", "Local HMI", "LW, 1", DataType.S16), [value.set(3), value.set(4)])
+        macro.write(
+            first,
+            second,
+            COMMENT("Used before being assigned"),
+            value.set(early),
+        )
+
+    report, = macro.optimize(allocate_temporaries)
+    output = render_macro(macro)
+
+    assert report == AllocationReport(temporaries=2, slots=1)
+    assert "    short p_temp_short0, value, early = 0\n" in output
+    assert "first_step" not in output and "second_step" not in output
+    assert '    GetData(p_temp_short0, "Local HMI", LW, 0, 1)\n' in output
+    assert '    GetData(p_temp_short0, "Local HMI", LW, 1, 1)\n' in output
+    assert "    value = early\n" in output
+    # The slots are only given while the macro is built
+    assert str(first.step_var) == "first_step"
+
+
+def test_each_build_declares_the_variables_again():
+    value = vshort("value")
+    macro = Macro("rebuilt")
+
+    with macro:
+        first = ROUTINE("first", Tag("first_step", "Local HMI", "LW, 0", DataType.S16), [value.set(1)])
+        second = ROUTINE("second", Tag("second_step", "Local HMI", "LW, 1", DataType.S16), [value.set(2)])
+        macro.write(first, second)
+
+    before = macro.cost_report()
+    report, = macro.optimize(allocate_temporaries)
+    output = ''.join(macro.compile())
+
+    assert report == AllocationReport(temporaries=2, slots=1)
+    # The temporaries declared by the first build are gone once they share a slot
+    assert "    short p_temp_short0, value\n" in output
+    assert "first_step" not in output and "second_step" not in output
+    assert macro.cost_report().memory == before.memory - 2
+    assert ''.join(macro.compile()) == output == ''.join(macro.iter_lines())
+
+
+
+def test_temporaries_get_the_slot_of_the_macro_being_built():
+    value = vshort("value")
+    macro = Macro("shared_slot")
+
+    with macro:
+        first = ROUTINE("first", Tag("first_step", "Local HMI", "LW, 0", DataType.S16), [value.set(1)])
+        second = ROUTINE("second", Tag("second_step", "Local HMI", "LW, 1", DataType.S16), [value.set(2)])
+        macro.write(first, second)
+    macro.optimize(allocate_temporaries)
+    other = Macro("other")
+    with other:
+        other.write(value.set(first.step_var))
+
+    lines = macro.iter_lines()
+    started = [next(lines) for _ in range(3)]
+    # Built while the first build is suspended, without the slots of the first macro
+    other_output = ''.join(other.iter_lines())
+    output = ''.join(started) + ''.join(lines)
+
+    assert "    value = first_step\n" in other_output
+    assert "p_temp_short0" not in other_output
+    assert output == ''.join(macro.compile())
+    assert '    GetData(p_temp_short0, "Local HMI", LW, 0, 1)\n' in output
+
+def test_roll_loops_rewrites_repeated_statements_as_for_loops():
+    values = vint_arr("values", 8)
+    value = vshort("value")
+    color = vint("color")
+    tags = [Tag(f"input{i}", "PLC", f"LW, {100 + 2 * i}", DataType.S16) for i in range(6)]
+    macro = Macro("rolling")
+
+    with macro:
+        macro.write(
+            *[values[i].set(0) for i in range(8)],
+            *[BLOCK(COMMENT(f"Input {i}"), tags[i].read(value), values[i].set(value * 2 + i)) for i in range(6)],
+            *[color.set(c) for c in (3, 1, 4, 1, 5)],
+            COMMENT("Too short to be worth a loop"),
+            value.set(1),
+            value.set(2),
+        )
+
+    report, = macro.optimize(roll_loops)
+    output = render_macro(macro)
+
+    assert report == RollingReport(loops=3, statements=25, arrays=1, lines=18)
+    assert (
+        "    for p_loop_index = 0 to 7\n"
+        "        values[p_loop_index] = 0\n"
+        "    next p_loop_index\n"
+    ) in output
+    assert (
+        "    for p_loop_index = 0 to 5\n"
+        '        GetData(value, "PLC", LW, p_loop_index * 2 + 100, 1)\n'
+        "        values[p_loop_index] = value * 2 + p_loop_index\n"
+        "    next p_loop_index\n"
+    ) in output
+    assert "    short value, p_rolled0[5] = { 3, 1, 4, 1, 5 }\n" in output
+    assert "        color = p_rolled0[p_loop_index]\n" in output
+    assert "    value = 1\n    value = 2\n" in output
+    assert "Input 1" not in output
+
+
+def test_optimize_refuses_tag_passes_after_roll_loops():
+    values = vint_arr("values", 4)
+    value = vshort("value")
+    tags = [Tag(f"input{i}", "PLC", f"LW, {100 + 2 * i}", DataType.S16) for i in range(4)]
+    macro = Macro("rolling_order")
+
+    with macro:
+        macro.write(*[BLOCK(tags[i].read(value), values[i].set(value)) for i in range(4)])
+
+    coalescing, rolling = macro.optimize(coalesce_reads, roll_loops)
+
+    assert isinstance(coalescing, CoalescingReport)
+    assert isinstance(rolling, RollingReport)
+    with pytest.raises(ValueError, match="plan_reads looks at the tags, it must run before roll_loops"):
+        macro.optimize(plan_reads)
+    with pytest.raises(ValueError, match="coalesce_writes looks at the tags, it must run before outline_blocks"):
+        Macro("outlining_order").optimize(outline_blocks, coalesce_writes)
+
+
+def test_allocate_temporaries_keeps_values_used_by_later_iterations():
+    busy = vbool("busy")
+    limit = Temporary("limit", "short", 0)
+    scratch = Temporary("scratch", "short", 0)
+    value = vshort("value")
+    macro = Macro("loop_temporaries")
+
+    with macro:
+        macro.write(
+            limit.set(10),
+            WHILE(busy)(
+                value.set(limit),
+                # Would overwrite the limit read by the next iteration
+                scratch.set(value * 2),
+                value.set(scratch),
+            ),
+        )
+
+    report, = macro.optimize(allocate_temporaries)
+
+    assert report == AllocationReport(temporaries=2, slots=2)
+    assert "limit = 10" in render_macro(macro)
+
+
+def test_outline_blocks_moves_repeated_blocks_into_sub_functions():
+    level = vshort("level")
+    limit = vshort("limit")
+    alarm = vbool("alarm")
+
+    def tank(k: int, threshold) -> IF:
+        return IF(alarm)(
+            COMMENT(f"Tank {k}"),
+            Tag(f"level{k}", "PLC", f"LW, {100 + k}", DataType.S16).read(level),
+            IF(level > threshold)(
+                Tag(f"alarm{k}", "PLC", f"LW, {200 + k}", DataType.S16).write(level),
+                level.set(10 * k),
+            ),
+        )
+
+    def build() -> Macro:
+        macro = Macro("outlining")
+        with macro:
+            macro.write(*[tank(k, limit) for k in range(4)], IF(alarm)(RETURN()), IF(alarm)(RETURN()))
+        return macro
+
+    macro = build()
+    before = len(macro.compile())
+    report, = macro.optimize(outline_blocks)
+    output = render_macro(macro)
+
+    assert report == OutliningReport(subs=1, calls=4, lines=17)
+    assert len(macro.compile()) == before - 17
+    assert (
+        "sub p_sub0(short p_arg0, short p_arg1, short p_arg2)\n"
+        "    if alarm then\n"
+        '        GetData(level, "PLC", LW, p_arg0, 1)\n'
+        "        if level > limit then\n"
+        '            SetData(level, "PLC", LW, p_arg1, 1)\n'
+        "            level = p_arg2\n"
+        "        end if\n"
+        "    end if\n"
+        "end sub\n"
+    ) in output
+    assert "    p_sub0(100, 200, 0)\n" in output
+    assert "    p_sub0(103, 203, 30)\n" in output
+    # Returning from a sub function doesn't end the macro
+    assert output.count("return") == 2
+    assert "Tank" not in output
+
+    # Each call must save 5 lines on top of its own
+    macro = build()
+    assert macro.optimize(Outliner(call_cost=5)) == [OutliningReport()]
+    assert "sub" not in render_macro(macro)
+
+
+def test_outline_blocks_counts_every_line_of_the_sub_function():
+    level = vshort("level")
+    alarm = vbool("alarm")
+    macro = Macro("outlining_lines")
+
+    with macro:
+        macro.write(*[
+            IF(alarm)(
+                Tag(f"level{k}", "PLC", f"LW, {100 + k}", DataType.S16).read(level),
+                EMPTY(),
+                level.set(level + k),
+                EMPTY(),
+            )
+            for k in range(3)
+        ])
+
+    before = len(macro.compile())
+    report, = macro.optimize(outline_blocks)
+
+    assert report == OutliningReport(subs=1, calls=3, lines=5)
+    assert len(macro.compile()) == before - 5
+
+
+def test_outline_blocks_leaves_the_outlined_statements_untouched():
+    level = vshort("level")
+    alarm = vbool("alarm")
+    tanks = [
+        IF(alarm)(
+            COMMENT(f"Tank {k}"),
+            Tag(f"level{k}", "PLC", f"LW, {100 + k}", DataType.S16).read(level),
+            level.set(level + 10 * k),
+            level.set(level * k),
+        )
+        for k in range(1, 4)
+    ]
+
+    def alone(statement) -> str:
+        source = Macro("source")
+        with source:
+            source.write(statement)
+        return render_macro(source)
+
+    texts = [alone(tank) for tank in tanks]
+    macro = Macro("outlined_sources")
+
+    with macro:
+        macro.write(*tanks)
+    report, = macro.optimize(outline_blocks)
+    output = render_macro(macro)
+
+    assert report.subs == 1
+    assert "        level = level + p_arg1\n" in output
+    # The statements replaced by the calls can still be written elsewhere as they were
+    assert [alone(tank) for tank in tanks] == texts
+    assert "    // Tank 1\n" in texts[0]
+    assert '    GetData(level, "PLC", LW, 101, 1)\n' in texts[0]
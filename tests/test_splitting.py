@@ -0,0 +1,86 @@
+import io
+import re
+
+import pytest
+
+from eb_macro_gen.objects import ROUTINE, DataType, Tag
+from eb_macro_gen.syntax import BLOCK, COMMENT, Macro, vint, vshort
+
+
+def render_macro(macro: Macro) -> str:
+    stream = io.StringIO()
+    macro.display(io=stream)
+    return stream.getvalue()
+
+
+def test_split_chains_parts_and_passes_state_through_registers():
+    plc = Tag("value", "PLC", "D, 5", DataType.S16)
+    value = vshort("value")
+    total = vint("total", 0)
+    steps = [BLOCK(*[total.set(total + i * j) for j in range(4)]) for i in range(12)]
+    macro = Macro("big", "Big macro", max_lines=45)
+
+    with macro:
+        macro.write(
+            plc.read(value),
+            total.set(value),
+            ROUTINE("routine", Tag("step", "Local HMI", "LW, 0", DataType.S16), steps),
+            BLOCK(plc.write(total), COMMENT("Done")),
+        )
+
+    parts = macro.split()
+    outputs = [render_macro(part) for part in parts]
+
+    assert len(parts) > 1
+    assert [part.name for part in parts] == ["big"] + [f"big_part{k}" for k in range(1, len(parts))]
+    assert all(len(part.compile()) <= 45 for part in parts)
+    for k, output in enumerate(outputs[:-1]):
+        assert output.endswith(f'    SYNC_TRIG_MACRO("big_part{k + 1}")\nend macro_command\n')
+    # The step is matched once, each part checks its own steps
+    assert "    p_split_case0 = routine_step\n" in outputs[0]
+    assert '    SetData(total, "Local HMI", LW, 9003, 1)\n' in outputs[0]
+    assert '    GetData(total, "Local HMI", LW, 9003, 1)\n' in outputs[-1]
+    assert '    SetData(total, "PLC", D, 5, 1)\n' in outputs[-1]
+    for i in range(12):
+        assert sum(f"    if p_split_case0 == {i} then\n" in output for output in outputs) == 1
+
+
+def test_split_keeps_macros_within_budget():
+    macro = Macro("small", max_lines=100)
+
+    with macro:
+        macro.write(COMMENT("Nothing to split"))
+
+    assert macro.split() == [macro]
+    assert Macro("unbounded").split()[0].name == "unbounded"
+
+
+def _stateful_macro(name:str) -> Macro:
+    total = vint("total", 0)
+    macro = Macro(name, max_lines=30)
+
+    with macro:
+        macro.write(
+            total.set(1),
+            BLOCK(*[COMMENT(f"Filler {i}") for i in range(40)]),
+            total.set(total + 1),
+        )
+    return macro
+
+
+def test_split_macros_get_their_own_state_registers():
+    outputs = [''.join(render_macro(part) for part in _stateful_macro(name).split()) for name in ("first", "second")]
+
+    addresses = [set(re.findall(r'SetData\(total, "Local HMI", LW, (\d+), 1\)', output)) for output in outputs]
+    assert all(len(a) == 1 for a in addresses)
+    assert addresses[0] != addresses[1]
+    # Splitting a macro again keeps its registers
+    assert set(re.findall(r'LW, (\d+)', ''.join(render_macro(part) for part in _stateful_macro("second").split()))) == addresses[1]
+
+
+def test_split_rejects_state_registers_of_another_macro():
+    _stateful_macro("owner").split(state_address=12000)
+
+    with pytest.raises(ValueError, match="overlaps the state of owner"):
+        _stateful_macro("intruder").split(state_address=12001)
+    assert len(_stateful_macro("neighbour").split(state_address=12002)) > 1
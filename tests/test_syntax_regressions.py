@@ -1,7 +1,17 @@
 import io
+import json
+import re
+import sys
+
+import pytest
 
 from eb_macro_gen.instructions import ACOS, ASYNC_TRIG_MACRO, BCD2BIN
-from eb_macro_gen.syntax import C_ELIF, C_END_IF, C_IF, C_ELSE, COMMENT, IF, Macro, vfloat, vint, vshort
+from eb_macro_gen.passes import allocate_temporaries
+from eb_macro_gen.objects import ASYNC_SCHEDULER, BUDGETED_SCHEDULER, INDIRECT_TAG, ROUTINE, SCHEDULER, TASK, DataType, Tag
+from eb_macro_gen.syntax import (
+    BINARY, BREAK, CASE, CONTINUE, C_ELIF, C_END_IF, C_IF, C_ELSE, COMMENT, EXPRESSION, FOR, IF, RETURN, SUB, SWITCH,
+    WHILE, Macro, Parameter, vbool, vfloat, vint, vint_arr, vshort,
+)
 
 
 def render_macro(macro: Macro) -> str:
@@ -74,3 +84,598 @@ def test_instruction_calls_render_and_track_variables():
     assert "BCD2BIN(packed, unpacked)" in output
     assert "float source = 0.5" in output
     assert "short packed = 4660" in output
+
+
+def test_streaming_emitter_matches_legacy_result():
+    macro = Macro("streaming")
+
+    with macro:
+        selector = vshort("selector")
+        macro.write(
+            COMMENT("multi\nline"),
+            IF(selector == 0)(
+                COMMENT("zero"),
+            ).ELSE()(
+                COMMENT("other"),
+            ),
+        )
+
+    streamed = render_macro(macro)
+
+    macro.result = ['']
+    for s in macro.statements:
+        s.process(macro)
+    for s in macro.statements:
+        s.bake(macro)
+
+    assert streamed == ''.join(macro.result)
+    assert ''.join(macro.iter_lines()) == streamed
+    assert all(line.endswith('\n') for line in macro.iter_lines())
+    assert "        // zero\n" in streamed
+
+
+def _split_declarations(lines):
+    start = lines.index("macro_command main()\n") + 1
+    end = lines.index("    \n", start)
+    return lines[:start] + lines[end:], sorted(lines[start:end])
+
+
+def test_compile_matches_iter_lines():
+    macro = Macro("equivalence")
+
+    with macro:
+        selector = vshort("selector")
+        case_value = vint("case_value")
+        step_tag = Tag("step", "Local HMI", "LW, 10", DataType.S16)
+        task_tag = Tag("task", "Local HMI", "LB, 10", DataType.Bit)
+        macro.write(
+            SWITCH(selector)(
+                CASE(0)(case_value.set(1)),
+                CASE(1)(case_value.set(2)),
+            ),
+            ROUTINE("routine", step_tag, [COMMENT("a"), case_value.set(3)]),
+            SCHEDULER(TASK("task", task_tag, case_value.set(4))),
+        )
+
+    compiled = macro.compile()
+    reference = list(macro.iter_lines())
+
+    assert _split_declarations(compiled) == _split_declarations(reference)
+    assert "    short selector, routine_step = 0\n" in compiled
+    assert "    int case_value\n" in compiled
+
+
+def test_process_visits_shared_resources_once():
+    macro = Macro("deep_chain")
+
+    with macro:
+        total = vshort("value0")
+        for i in range(1, 3000):
+            total = total + vshort(f"value{i}")
+        macro.write(IF(total > 0)(COMMENT("deep")), IF(total > 1)(COMMENT("shared")))
+
+    output = ''.join(macro.compile())
+
+    # Used by the same statement, the variables are declared in the order of their names
+    assert "    short value0, value1, value10, value100, value1000, value1001, " in output
+    assert ", value2999, value3, " in output
+    assert len(macro._processed) < 4 * 3000
+
+
+def test_process_visits_resources_shared_by_several_paths_once():
+    macro = Macro("doubling")
+    visits = []
+
+    class COUNTED(BINARY):
+        def process(self, macro):
+            visits.append(self)
+            super().process(macro)
+
+    with macro:
+        total = vshort("value")
+        for _ in range(12):
+            total = COUNTED('+', total, total)
+        macro.write(IF(total > 0)(COMMENT("doubled")), IF(total > 1)(COMMENT("again")))
+
+    lines = list(macro.iter_lines())
+
+    assert "    short value\n" in lines
+    # Once per build instead of once per path leading to them
+    assert len(visits) == 12
+
+
+def test_routine_with_many_steps_builds_without_deep_recursion():
+    step_tag = Tag("step", "Local HMI", "LW, 10", DataType.S16)
+    macro = Macro("long_routine")
+
+    with macro:
+        value = vshort("value")
+        macro.write(ROUTINE("routine", step_tag, [value.set(i) for i in range(50000)], dispatch="linear"))
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(300)
+    try:
+        output = macro.compile()
+    finally:
+        sys.setrecursionlimit(limit)
+
+    assert "    else if routine_step == 49999 then\n" in output
+    assert output.count("    end if\n") == 2
+
+
+def test_operators_build_expression_nodes_rendered_lazily():
+    a = vint("a")
+    b = vint("b")
+    flags = [vbool(f"flag{i}") for i in range(3)]
+
+    total = a + b * 2
+    assert isinstance(total, BINARY)
+    assert (total.left, total.operator) == (a, "+")
+    assert str(total > 10) == "a + b * 2 > 10"
+    assert str((flags[0] | flags[1]) | flags[2]) == "((flag0 or flag1) or flag2)"
+    assert str(~(flags[0] & flags[1])) == "(not (flag0 and flag1))"
+
+    b.name = "renamed"
+    EXPRESSION.invalidate()
+    assert str(total) == "a + renamed * 2"
+
+
+def test_variable_item_comparison_renders_index():
+    arr = vint_arr("arr", 3)
+
+    assert str(arr[1] == 2) == "arr[1] == 2"
+    assert str(arr[2] >= arr[0]) == "arr[2] >= arr[0]"
+
+
+def test_long_expression_chains_render_without_recursion():
+    values = [vshort(f"value{i}") for i in range(10000)]
+    total = values[0]
+    for v in values[1:]:
+        total = total + v
+
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(300)
+    try:
+        text = str(total)
+        assert str(total) == text
+    finally:
+        sys.setrecursionlimit(limit)
+
+    assert text == " + ".join(str(v) for v in values)
+
+
+def test_routine_dispatch_defaults_to_binary_above_threshold():
+    step_tag = Tag("step", "Local HMI", "LW, 10", DataType.S16)
+    macro = Macro("binary_routine")
+
+    with macro:
+        value = vshort("value")
+        macro.write(
+            ROUTINE("small", step_tag, [value.set(i) for i in range(3)]),
+            ROUTINE("large", step_tag, [value.set(i) for i in range(12)]),
+        )
+
+    output = render_macro(macro)
+
+    assert "    else if small_step == 2 then\n" in output
+    assert "    if large_step < 6 then\n" in output
+    assert "        if large_step < 3 then\n" in output
+    assert "        if large_step < 9 then\n" in output
+    # Three range checks at most on the way to the pair of equality checks of a step
+    assert "                else if large_step == 11 then\n" in output
+    assert output.count("if large_step == ") == 12
+    with pytest.raises(ValueError):
+        ROUTINE("bad", step_tag, [value.set(0)], dispatch="table")
+
+
+def test_switch_lowering_depends_on_case_density():
+    macro = Macro("switch_lowering")
+    tags = [Tag(f"tag{i}", "PLC", f"LW, {100 + 3 * i}", DataType.S16) for i in range(4)]
+
+    with macro:
+        selector = vshort("selector")
+        value = vint("value")
+        dense = SWITCH(selector)
+        sparse = SWITCH(selector)
+        reads = SWITCH(selector)
+        macro.write(
+            dense(*[CASE(i)(COMMENT(f"Case {i}"), value.set(10 * i)) for i in (1, 2, 3, 5)]),
+            sparse(*[CASE(100 * i)(value.set(i)) for i in range(10)]),
+            reads(*[CASE(i)(tag.read(value)) for i, tag in enumerate(tags)]),
+        )
+
+    output = render_macro(macro)
+
+    table = re.search(r"int (p_switch_table\d+)\[5\] = \{ 10, 20, 30, 0, 50 \}[,\n]", output).group(1)
+    cases = re.search(r"bool (p_switch_cases\d+)\[5\] = \{ 1, 1, 1, 0, 1 \}[,\n]", output).group(1)
+    assert (
+        "    if selector >= 1 then\n"
+        "        if selector <= 5 then\n"
+        f"            if {cases}[selector - 1] then\n"
+        f"                value = {table}[selector - 1]\n"
+    ) in output
+    assert dense.costs["table"].worst == 3
+    assert dense.costs["linear"].worst == 4
+
+    assert "    if selector < 500 then\n" in output
+    assert sparse.costs["binary"].worst == 5
+    assert sparse.costs["binary"].average < sparse.costs["linear"].average
+    # Too sparse for a table, which would need two arrays covering 0 to 900
+    assert sparse.costs["table"].elements == 2 * 901
+
+    addresses = re.search(r"[ ,](p_switch_table\d+)\[4\] = \{ 100, 103, 106, 109 \}[,\n]", output).group(1)
+    assert f'            GetData(value, "PLC", LW, {addresses}[selector], 1)\n' in output
+
+    linear = SWITCH(selector, "linear")(*[CASE(i)(value.set(i)) for i in range(10)])
+    assert len(linear.statements) == 10
+    with pytest.raises(ValueError):
+        SWITCH(selector, "table")(CASE(0)(value.set(selector)), CASE(1)(value.set(1)))
+
+
+def test_switch_tables_are_numbered_per_macro():
+    outputs = []
+    for name in ("first_tables", "second_tables"):
+        macro = Macro(name)
+        with macro:
+            selector = vshort("selector")
+            value = vint("value")
+            macro.write(
+                # Could be a table, written as a comparison tree
+                SWITCH(selector, "binary")(*[CASE(i)(value.set(i)) for i in range(6)]),
+                SWITCH(selector)(*[CASE(i)(value.set(10 * i)) for i in range(6)]),
+                SWITCH(selector)(*[CASE(i)(value.set(20 * i)) for i in (0, 1, 2, 4)]),
+            )
+        outputs.append(render_macro(macro))
+
+    assert outputs[0].replace("first_tables", "second_tables") == outputs[1]
+    assert " p_switch_table1[6] = { 0, 10, 20, 30, 40, 50 }" in outputs[0]
+    assert " p_switch_table2[5] = { 0, 20, 40, 0, 80 }" in outputs[0]
+    assert "    bool p_switch_cases2[5] = { 1, 1, 1, 0, 1 }" in outputs[0]
+    assert "p_switch_table3" not in outputs[0]
+
+
+
+def test_switch_tables_of_a_macro_not_ended_stay_apart():
+    selector = vshort("selector")
+    value = vint("value")
+    macro = Macro("not_ended")
+
+    macro.begin()
+    macro.write(
+        SWITCH(selector)(*[CASE(i)(value.set(10 * i)) for i in range(6)]),
+        SWITCH(selector)(*[CASE(i)(value.set(20 * i)) for i in range(6)]),
+    )
+    output = ''.join(macro.compile())
+
+    first = re.search(r"[ ,](p_switch_table_\d+)\[6\] = \{ 0, 10, 20, 30, 40, 50 \}[,\n]", output).group(1)
+    second = re.search(r"[ ,](p_switch_table_\d+)\[6\] = \{ 0, 20, 40, 60, 80, 100 \}[,\n]", output).group(1)
+    assert first != second
+    assert f"value = {first}[selector]" in output and f"value = {second}[selector]" in output
+
+def test_indirect_tag_computes_evenly_spaced_addresses():
+    macro = Macro("indirect")
+    indirect_tag = Tag("indirect", "Local HMI", "LW, 10", DataType.F32)
+    spaced = [Tag(f"spaced{i}", "PLC", f"LW, {100 + 2 * i}", DataType.F32) for i in range(4)]
+    uneven = [Tag(f"uneven{i}", "PLC", f"LW, {a}", DataType.F32) for i, a in enumerate((100, 102, 106))]
+
+    with macro:
+        value = vfloat("value")
+        computed = INDIRECT_TAG(indirect_tag, value, spaced)
+        fallback = INDIRECT_TAG(indirect_tag, value, uneven)
+        macro.write(
+            computed.read_from_actual(),
+            computed.write_to_actual(),
+            fallback.read_from_actual(),
+        )
+
+    output = render_macro(macro)
+
+    assert computed.progression() == ("PLC", "LW", 100, 2)
+    assert fallback.progression() is None
+    assert (
+        "    if indirect_selection >= 0 then\n"
+        "        if indirect_selection <= 3 then\n"
+        '            GetData(value, "PLC", LW, indirect_selection * 2 + 100, 1)\n'
+    ) in output
+    assert '            SetData(value, "PLC", LW, indirect_selection * 2 + 100, 1)\n' in output
+    assert '    else if indirect_selection == 2 then\n        GetData(value, "PLC", LW, 106, 1)\n' in output
+
+
+def test_scheduler_packs_task_commands_into_words():
+    command_words = Tag("commands", "Local HMI", "LW, 300", DataType.U16)
+    tasks = [TASK(f"task{i}", Tag(f"task{i}_tag", "Local HMI", f"LB, {i}", DataType.Bit), COMMENT(f"Run {i}")) for i in range(40)]
+    macro = Macro("packed_scheduler")
+
+    with macro:
+        scheduler = SCHEDULER(*tasks, command_words=command_words)
+        macro.write(scheduler, tasks[17].enable())
+
+    output = render_macro(macro)
+
+    assert "    unsigned short p_commands[3], p_commands_word = 0\n" in output
+    assert output.count("GetData(p_commands[") == 1
+    assert '    GetData(p_commands[0], "Local HMI", LW, 300, 3)\n' in output
+    assert "task17_tag" not in output
+    assert "        if GETBIT(p_commands[1], 1) then\n" in output
+    assert (
+        '    GetData(p_commands_word, "Local HMI", LW, 301, 1)\n'
+        "    SETBITON(p_commands_word, 1)\n"
+        '    SetData(p_commands_word, "Local HMI", LW, 301, 1)\n'
+    ) in output
+    assert "            SETBITOFF(p_commands_word, 1)\n" in output
+
+
+
+def test_task_commands_follow_the_scheduler_created_after_them():
+    tasks = [TASK(f"task{i}", Tag(f"task{i}_tag", "Local HMI", f"LB, {i}", DataType.Bit), COMMENT(f"Run {i}")) for i in range(2)]
+    other = TASK("other", Tag("other_tag", "Local HMI", "LB, 10", DataType.Bit), COMMENT("Run other"))
+    macro = Macro("late_scheduler")
+
+    with macro:
+        enable = tasks[1].enable()
+        macro.write(
+            enable,
+            SCHEDULER(*tasks, command_words=Tag("commands", "Local HMI", "LW, 300", DataType.U16)),
+            SCHEDULER(other, command_words=Tag("others", "Local HMI", "LW, 310", DataType.U16)),
+        )
+
+    output = render_macro(macro)
+
+    assert "task1_tag" not in output
+    assert (
+        '    GetData(p_commands_word, "Local HMI", LW, 300, 1)\n'
+        "    SETBITON(p_commands_word, 1)\n"
+        '    SetData(p_commands_word, "Local HMI", LW, 300, 1)\n'
+    ) in output
+    # Each scheduler edits its own copy of the command word
+    assert "            SETBITOFF(p_others_word, 0)\n" in output
+
+def test_async_scheduler_parks_and_backs_off_while_idle():
+    delay_tag = Tag("delay", "Local HMI", "LW, 400", DataType.S32)
+    parked_tag = Tag("parked", "Local HMI", "LB, 2", DataType.Bit)
+    task = TASK("task", Tag("task_tag", "Local HMI", "LB, 1", DataType.Bit), COMMENT("Run"))
+    macro = Macro("idle_scheduler")
+
+    with macro:
+        scheduler = ASYNC_SCHEDULER("scheduler", 100, task, park=True, parked_tag=parked_tag, delay_tag=delay_tag)
+        macro.write(scheduler, task.enable())
+
+    output = render_macro(macro)
+    loop = render_macro(scheduler.loop_macro("idle_scheduler"))
+
+    assert (
+        "    if p_scheduler_done then\n"
+        "        p_scheduler_delay = 100\n"
+        "    else\n"
+        "        p_scheduler_delay = p_scheduler_delay * 2\n"
+        "    end if\n"
+    ) in output
+    assert "    if p_scheduler_delay > 1600 then\n" in output
+    assert (
+        "    if p_scheduler_done then\n"
+        '        ASYNC_TRIG_MACRO("scheduler_loop")\n'
+        "    else\n"
+        "        // Park until a task is enabled\n"
+        '        SetData(on, "Local HMI", LB, 2, 1)\n'
+        "    end if\n"
+    ) in output
+    # Only a parked scheduler is woken up, a running one already retriggers itself
+    assert (
+        '    SetData(on, "Local HMI", LB, 1, 1)\n'
+        "    // Wake up the scheduler if it is parked\n"
+        '    GetData(p_task_parked, "Local HMI", LB, 2, 1)\n'
+        "    if p_task_parked then\n"
+        '        SetData(off, "Local HMI", LB, 2, 1)\n'
+        '        ASYNC_TRIG_MACRO("scheduler_loop")\n'
+        "    end if\n"
+    ) in output
+    assert '    GetData(p_scheduler_delay, "Local HMI", LW, 400, 1)\n    DELAY(p_scheduler_delay)\n' in loop
+    with pytest.raises(ValueError, match="needs a parked_tag"):
+        ASYNC_SCHEDULER("unflagged", 100, park=True)
+
+
+def test_budgeted_scheduler_runs_tasks_by_priority_within_budget():
+    value = vshort("value")
+    tasks = [
+        TASK("cheap", Tag("cheap_tag", "Local HMI", "LB, 0", DataType.Bit), value.set(1)),
+        TASK("urgent", Tag("urgent_tag", "Local HMI", "LB, 1", DataType.Bit), value.set(2), priority=1),
+        TASK("slow", Tag("slow_tag", "Local HMI", "LB, 2", DataType.Bit), Tag("input", "Local HMI", "LW, 10", DataType.S16).read(value)),
+    ]
+    cursor_tag = Tag("cursor", "Local HMI", "LW, 500", DataType.S16)
+    macro = Macro("budgeted_scheduler")
+
+    with macro:
+        scheduler = BUDGETED_SCHEDULER("scheduler", 40, cursor_tag, *tasks)
+        macro.write(scheduler)
+
+    output = render_macro(macro)
+
+    # Reading the command, the body and disabling the task
+    assert scheduler.costs == {"cheap": 21, "urgent": 21, "slow": 30}
+    assert '    GetData(p_scheduler_cursor[0], "Local HMI", LW, 500, 2)\n' in output
+    assert output.index("PRIORITY 1") < output.index("PRIORITY 0")
+    assert output.index("TASK urgent") < output.index("TASK cheap") < output.index("TASK slow")
+    assert "    if ((not p_scheduler_stop) and p_scheduler_cursor[1] <= 1) then\n" in output
+    assert "            if (p_scheduler_spent == 0 or p_scheduler_spent <= 10) then\n" in output
+    assert (
+        "                // Out of budget, resume here on the next scan\n"
+        "                p_scheduler_cursor[1] = 1\n"
+        "                p_scheduler_stop = 1\n"
+    ) in output
+    assert '    SetData(p_scheduler_cursor[0], "Local HMI", LW, 500, 2)\n' in output
+
+
+def test_budgeted_scheduler_resumed_scan_skips_the_tasks_before_the_cursor():
+    value = vshort("value")
+    tasks = [
+        TASK(f"task{i}", Tag(f"task{i}_tag", "Local HMI", f"LB, {i}", DataType.Bit), value.set(i))
+        for i in range(3)
+    ]
+    macro = Macro("round_robin")
+
+    with macro:
+        macro.write(BUDGETED_SCHEDULER("scheduler", 40, Tag("cursor", "Local HMI", "LW, 500", DataType.S16), *tasks))
+
+    output = render_macro(macro)
+
+    # Every slot, the first one too, only runs when the scan starts at or before it
+    for i in range(3):
+        assert (
+            f"    if ((not p_scheduler_stop) and p_scheduler_cursor[0] <= {i}) then\n"
+            f'        GetData(p_task_cmd, "Local HMI", LB, {i}, 1)\n'
+        ) in output
+    assert "    if not p_scheduler_stop then\n        GetData" not in output
+
+
+def test_for_and_while_loops_nest_with_break_and_continue():
+    values = vint_arr("values", 10)
+    index = vint("index")
+    busy = vbool("busy")
+    macro = Macro("loops")
+
+    with macro:
+        loop = FOR(index, 9, 0, step=-3)(
+            IF(values[index] == 0)(CONTINUE()),
+            values[index].set(index),
+        )
+        macro.write(
+            loop,
+            WHILE(busy)(
+                IF(values[0] > 5)(BREAK()),
+                busy.set(False),
+            ),
+        )
+
+    output = render_macro(macro)
+
+    assert loop.iterations == 4
+    assert FOR(index, 0, values[1]).iterations is None
+    assert (
+        "    for index = 9 down 0 step 3\n"
+        "        if values[index] == 0 then\n"
+        "            continue\n"
+        "        end if\n"
+        "        values[index] = index\n"
+        "    next index\n"
+        "    while busy\n"
+        "        if values[0] > 5 then\n"
+        "            break\n"
+        "        end if\n"
+        "        busy = 0\n"
+        "    wend\n"
+    ) in output
+    assert "    bool busy\n" in output
+
+    outside = Macro("outside")
+    with outside:
+        outside.write(IF(busy)(BREAK()))
+    with pytest.raises(SyntaxError):
+        outside.compile()
+
+
+def test_sub_functions_are_defined_before_main_with_global_variables():
+    a = Parameter("a", "int")
+    b = Parameter("b", "int")
+    total = vint("total")
+    add = SUB("add", a, b, returns="int")(RETURN(a + b))
+    log = SUB("log", a)(total.set(add.eval(total, a)))
+    macro = Macro("subs", "With subs")
+
+    with macro:
+        macro.write(log.call(3), total.set(add.eval(1, 2)))
+
+    output = render_macro(macro)
+
+    # Callees first, whether they are called as statements or in expressions
+    assert macro.subs == [add, log]
+    assert (
+        "int total\n"
+        "\n"
+        "sub int add(int a, int b)\n"
+        "    return a + b\n"
+        "end sub\n"
+        "\n"
+        "sub log(int a)\n"
+        "    total = add(total, a)\n"
+        "end sub\n"
+        "\n"
+        "// With subs\n"
+        "macro_command main()\n"
+    ) in output
+    assert "    log(3)\n    total = add(1, 2)\n" in output
+    assert "    int total\n" not in output
+    with pytest.raises(TypeError):
+        log.call(1, 2)
+
+
+def test_release_builds_shorten_names_and_write_a_symbol_map(tmp_path):
+    values = vint_arr("p_drawing_values", 4, [1, 2, 3, 4])
+    selection = vshort("indirect_selection")
+    total = vint("total")
+    a = Parameter("amount", "int")
+    add = SUB("add_to_total", a)(total.set(total + a))
+    macro = Macro("release", "Release build", release=True)
+
+    with macro:
+        macro.write(
+            COMMENT("Sum the values"),
+            IF(selection > 0)(
+                add.call(values[selection]),
+            ),
+        )
+
+    output = render_macro(macro)
+
+    assert macro.symbol_map() == {"a": "amount", "b": "indirect_selection", "c": "p_drawing_values", "d": "total"}
+    assert "sub add_to_total(int a)\nd = d + a\nend sub\n" in output
+    assert "macro_command main()\nif b > 0 then\nadd_to_total(c[b])\nend if\nend macro_command\n" in output
+    assert output.startswith("int d, c[4] = { 1, 2, 3, 4 }\nshort b\n")
+    assert "//" not in output and "\n\n" not in output and "    " not in output
+
+    path = tmp_path / "release.json"
+    macro.write_symbols(path)
+    assert json.loads(path.read_text())["c"] == "p_drawing_values"
+
+    # The names are only shortened while the release build is written
+    assert str(values[selection]) == "p_drawing_values[indirect_selection]"
+    macro.release = False
+    assert "    if indirect_selection > 0 then\n" in render_macro(macro)
+
+
+def test_release_builds_shorten_the_slots_of_temporaries():
+    value = vshort("value")
+    macro = Macro("release_slots", release=True)
+
+    with macro:
+        first = ROUTINE("first", Tag("first_step", "Local HMI", "LW, 0", DataType.S16), [value.set(1)])
+        second = ROUTINE("second", Tag("second_step", "Local HMI", "LW, 1", DataType.S16), [value.set(2)])
+        macro.write(first, second)
+    macro.optimize(allocate_temporaries)
+
+    output = render_macro(macro)
+
+    assert macro.symbol_map() == {"a": "p_temp_short0", "b": "value"}
+    assert "macro_command main()\nshort a, b\n" in output
+    assert 'GetData(a, "Local HMI", LW, 0, 1)\n' in output
+    assert 'GetData(a, "Local HMI", LW, 1, 1)\n' in output
+
+
+def test_release_names_stay_in_their_build():
+    counter = vshort("counter", 0)
+    release = Macro("release", release=True)
+    plain = Macro("plain")
+
+    with release:
+        release.write(counter.set(counter + 1))
+    with plain:
+        plain.write(counter.set(counter + 1))
+
+    lines = release.iter_lines()
+    started = next(lines)
+    # Built while the release build is suspended
+    plain_output = ''.join(plain.iter_lines())
+    release_output = started + ''.join(lines)
+
+    assert "    short counter = 0\n" in plain_output
+    assert "    counter = counter + 1\n" in plain_output
+    assert release_output == "macro_command main()\nshort a = 0\na = a + 1\nend macro_command\n"